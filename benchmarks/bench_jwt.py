@@ -0,0 +1,167 @@
+"""Throughput of shibble.jwt against the implementation it replaced.
+
+    python benchmarks/bench_jwt.py
+"""
+import hashlib
+import hmac
+import itertools
+import json
+import sys
+import time
+import timeit
+
+import sqlalchemy
+from sqlalchemy.pool import StaticPool
+
+from shibble import jwt
+from shibble import models
+from shibble import replay
+
+KEY = 'a shared secret of a realistic length, 32+ bytes'
+PAYLOAD = {'iss': 'https://rapid.aaf.edu.au',
+           'aud': 'https://shibble.example.com',
+           'sub': 'https://idp.example.edu.au!https://sp!abcdef',
+           'jti': '9a1b7f2e3c4d5e6f',
+           'https://aaf.edu.au/attributes': {
+               'cn': 'John Smith',
+               'displayname': 'John Smith',
+               'mail': 'john.smith@example.edu.au',
+               'edupersontargetedid': 'https://idp!https://sp!abcdef'}}
+TOKEN = jwt.encode(dict(PAYLOAD), KEY)
+# a validly encoded token with a large payload and the wrong signature
+FORGED = jwt.encode(dict(PAYLOAD, padding=['x' * 64] * 60), 'wrong key')
+# garbage well over the size limit
+OVERSIZED = '.'.join([TOKEN.split('.')[0], 'A' * 1000000, 'A' * 43])
+
+
+def legacy_constant_time_compare(val1, val2):
+    if len(val1) != len(val2):
+        return False
+    result = 0
+    for x, y in zip(val1, val2):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def legacy_decode(token, key):
+    """The decode path before prepared keys: a new HMAC per call and a
+    pure Python comparison."""
+    signing_input, crypto_segment = str(token).rsplit('.', 1)
+    header_segment, payload_segment = signing_input.split('.', 1)
+    json.loads(jwt.base64url_decode(header_segment))
+    payload = json.loads(jwt.base64url_decode(payload_segment))
+    signature = jwt.base64url_decode(crypto_segment)
+    expected = hmac.new(key, signing_input, hashlib.sha256).digest()
+    if not legacy_constant_time_compare(signature, expected):
+        raise jwt.DecodeError("Signature verification failed")
+    return payload
+
+
+def legacy_encode(payload, key):
+    """The encode path before cached headers: the header is rebuilt and
+    both segments serialised with default separators on every call."""
+    segments = []
+    header = {"typ": "JWT", "alg": 'HS256'}
+    segments.append(jwt.base64url_encode(json.dumps(header)))
+    segments.append(jwt.base64url_encode(json.dumps(payload)))
+    signing_input = '.'.join(segments)
+    signature = hmac.new(key, signing_input, hashlib.sha256).digest()
+    segments.append(jwt.base64url_encode(signature))
+    return '.'.join(segments)
+
+
+def reject(decode, token):
+    try:
+        decode(token, KEY)
+    except (jwt.DecodeError, ValueError, TypeError):
+        return
+    raise AssertionError('token was accepted')
+
+
+def best_of(function, number, repeat=5):
+    """Return the best time per call in seconds."""
+    return min(timeit.repeat(function, number=number,
+                             repeat=repeat)) / number
+
+
+def bench(number=20000):
+    tokens = [TOKEN] * 100
+    payloads = [PAYLOAD] * 100
+    return {
+        'encode_legacy': best_of(lambda: legacy_encode(PAYLOAD, KEY), number),
+        'encode': best_of(lambda: jwt.encode(PAYLOAD, KEY), number),
+        'encode_many_per_token': best_of(
+            lambda: jwt.encode_many(payloads, KEY), number // 100) / 100,
+        'decode_legacy': best_of(lambda: legacy_decode(TOKEN, KEY), number),
+        'decode': best_of(lambda: jwt.decode(TOKEN, KEY), number),
+        'decode_many_per_token': best_of(
+            lambda: jwt.decode_many(tokens, KEY), number // 100) / 100,
+        'reject_forged_legacy': best_of(
+            lambda: reject(legacy_decode, FORGED), number),
+        'reject_forged': best_of(lambda: reject(jwt.decode, FORGED), number),
+        'reject_oversized_legacy': best_of(
+            lambda: reject(legacy_decode, OVERSIZED), number // 1000),
+        'reject_oversized': best_of(
+            lambda: reject(jwt.decode, OVERSIZED), number),
+    }
+
+
+def sql_replay_store():
+    """A SQLReplayStore on a fresh in-memory database."""
+    engine = sqlalchemy.create_engine(
+        'sqlite://', poolclass=StaticPool,
+        connect_args={'check_same_thread': False})
+    models.Base.metadata.create_all(engine)
+    return replay.SQLReplayStore(engine)
+
+
+def bench_replay(number=20000, sql_number=2000):
+    """Cost of the replay stores, each token has its own jti."""
+    exp = int(time.time()) + 3600
+    tokens = jwt.encode_many(
+        [dict(PAYLOAD, jti=str(i), exp=exp) for i in range(number)], KEY)
+    jtis = itertools.count()
+
+    def decode_all(replay_store, count=number):
+        for token in tokens[:count]:
+            jwt.decode(token, KEY, replay_store=replay_store)
+
+    def check_and_add(store, count=number):
+        for i in range(count):
+            store.check_and_add(str(next(jtis)), exp)
+
+    def per_token(run, make_store, count=number, repeat=3):
+        # a fresh store each run, otherwise every token is a replay, set
+        # up outside of the timing
+        best = None
+        for i in range(repeat):
+            store = make_store()
+            start = time.time()
+            run(store, count)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best / count
+
+    return {
+        'decode_no_replay_store': per_token(decode_all, lambda: None),
+        'decode_replay_store': per_token(decode_all,
+                                         replay.MemoryReplayStore),
+        'replay_check_and_add': per_token(check_and_add,
+                                          replay.MemoryReplayStore),
+        'decode_sql_replay_store': per_token(decode_all, sql_replay_store,
+                                             sql_number),
+        'sql_replay_check_and_add': per_token(check_and_add,
+                                              sql_replay_store, sql_number),
+    }
+
+
+def main(argv):
+    results = bench()
+    results.update(bench_replay())
+    for name, seconds in sorted(results.items()):
+        print('%-24s %8.2f us/token  %10.0f tokens/s' % (
+            name, seconds * 1e6, 1 / seconds))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,417 @@
+"""Drive the full WSGI stack with simulated Shibboleth users.
+
+    python benchmarks/loadtest.py [--users 200] [--concurrency 20]
+                                  [--ldap-latency 0.005]
+                                  [--ldap-failure-rate 0]
+                                  [--dbus-latency 0.05]
+                                  [--dbus-failure-rate 0]
+                                  [--database-uri sqlite:///...]
+                                  [--output results.json]
+
+The app is loaded through paste.deploy from a generated config, so
+requests go through the Beaker session filter, ConfigMiddleware, bottle
+and the SQLAlchemy plugin exactly as in production, and the provisioning
+workers create the accounts. LDAP and the D-Bus services are replaced by
+in-process fakes with the given mean latency (in seconds) and failure
+rate, so nothing outside the process is needed.
+
+Each simulated user makes a first login, accepts the terms, long-polls
+/account_status/wait as the creating-account page does until the account
+is created, and logs in again. The
+throughput and the p50/p95/p99 latencies are reported for every route
+and for each of those flows.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import wsgiref.util
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+import ldap
+from paste.deploy import loadapp
+
+from shibble import utils
+
+CONFIG_TEMPLATE = """\
+[DEFAULT]
+support_url = https://support.example.com
+
+[ldap]
+connection_string = ldap://fake/
+bind_dn = cn=admin,dc=localdomain
+bind_pw = password
+user_dn = ou=Users,dc=localdomain
+home_dir_path = /home
+group_id = 2000
+uid_min = 2000
+
+[filter-app:main]
+use = egg:beaker#beaker_session
+session.type = memory
+session.cookie_expires = true
+next = shibble
+
+[app:shibble]
+use = call:shibble.wsgiapp:make_app
+database_uri = %(database_uri)s
+target = https://example.com/
+rapid_connect_secret = loadtest
+rapid_connect_audience = https://shibble.example.com
+provisioning_workers = %(workers)d
+provisioning_poll_interval = 1
+account_status_timeout = %(long_poll_timeout)s
+"""
+
+FLOWS = ('first_login', 'terms_acceptance', 'status_polling',
+         'returning_login')
+
+
+class SimulatedFailure(Exception):
+    pass
+
+
+class Backend(object):
+    """Latency and failures of a fake service."""
+
+    def __init__(self, latency=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.failures = 0
+
+    def call(self, exception=SimulatedFailure):
+        self.calls += 1
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            raise exception('simulated failure')
+
+
+class FakeDirectory(object):
+    """The posixAccount entries of an LDAP directory, kept in memory."""
+
+    def __init__(self, backend, accounts=0, uid_min=2000):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.entries = {}
+        for i in range(accounts):
+            self.entries['uid=existing-%d' % i] = {
+                'uid': ['existing-%d' % i],
+                'uidNumber': [str(uid_min + i)],
+                'createTimestamp': ['20000101000000Z']}
+
+    def connect(self):
+        self.backend.call(ldap.SERVER_DOWN)
+        return FakeLDAPConnection(self)
+
+    def search(self, filterstr):
+        match = re.search(r'\(uid=([^)]*)\)', filterstr)
+        since = re.search(r'createTimestamp>=(\d{14}Z)', filterstr)
+        with self.lock:
+            entries = list(self.entries.items())
+        if match:
+            entries = [(dn, attrs) for dn, attrs in entries
+                       if attrs['uid'] == [match.group(1)]]
+        elif since:
+            entries = [(dn, attrs) for dn, attrs in entries
+                       if attrs['createTimestamp'][0] >= since.group(1)]
+        return entries
+
+    def add(self, dn, modlist):
+        attrs = dict((name, value if isinstance(value, list) else [value])
+                     for name, value in modlist)
+        attrs['createTimestamp'] = [time.strftime('%Y%m%d%H%M%SZ',
+                                                  time.gmtime())]
+        with self.lock:
+            if dn in self.entries:
+                raise ldap.ALREADY_EXISTS(dn)
+            self.entries[dn] = attrs
+
+
+class FakeLDAPConnection(object):
+    """The python-ldap calls made by shibble.utils."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._results = {}
+        self._msgids = iter(xrange(1, sys.maxint))
+
+    def simple_bind_s(self, who, cred):
+        pass
+
+    def whoami_s(self):
+        self.directory.backend.call(ldap.SERVER_DOWN)
+        return 'dn:cn=admin,dc=localdomain'
+
+    def unbind_s(self):
+        pass
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        self.directory.backend.call(ldap.SERVER_DOWN)
+        return self.directory.search(filterstr)
+
+    def search(self, base, scope, filterstr, attrlist=None):
+        self.directory.backend.call(ldap.SERVER_DOWN)
+        msgid = next(self._msgids)
+        self._results[msgid] = self.directory.search(filterstr)
+        return msgid
+
+    def result(self, msgid, all=1):
+        entries = self._results[msgid]
+        if entries:
+            return ldap.RES_SEARCH_ENTRY, [entries.pop(0)]
+        del self._results[msgid]
+        return ldap.RES_SEARCH_RESULT, []
+
+    def add_s(self, dn, modlist):
+        self.directory.backend.call(ldap.SERVER_DOWN)
+        self.directory.add(dn, modlist)
+
+
+def install_fakes(directory, dbus_backend):
+    """Point shibble.utils at the fake LDAP and D-Bus services."""
+    def create_home_dir(username):
+        dbus_backend.call()
+        return True
+
+    def create_nextcloud_mount(username, password):
+        dbus_backend.call()
+        return True
+
+    utils.get_ldap_connection = directory.connect
+    utils.create_home_dir = create_home_dir
+    utils.create_nextcloud_mount = create_nextcloud_mount
+    utils._ldap_pool = None
+    utils._uid_allocator = None
+    utils._user_exists_cache = None
+
+
+class Client(object):
+    """A browser behind the Shibboleth SP, keeping the session cookie."""
+
+    def __init__(self, app, shib_attrs, stats):
+        self.app = app
+        self.shib_attrs = shib_attrs
+        self.stats = stats
+        self.cookie = None
+
+    def request(self, method, path, form=None, query=None):
+        environ = dict(self.shib_attrs)
+        environ['REQUEST_METHOD'] = method
+        environ['PATH_INFO'] = path
+        environ['QUERY_STRING'] = urllib.urlencode(query or {})
+        body = urllib.urlencode(form or {})
+        environ['wsgi.input'] = StringIO(body)
+        if form:
+            environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+            environ['CONTENT_LENGTH'] = str(len(body))
+        if self.cookie:
+            environ['HTTP_COOKIE'] = self.cookie
+        wsgiref.util.setup_testing_defaults(environ)
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            response['headers'] = headers
+
+        start = time.time()
+        app_iter = self.app(environ, start_response)
+        try:
+            body = ''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        elapsed = time.time() - start
+
+        for name, value in response['headers']:
+            if name.lower() == 'set-cookie':
+                self.cookie = value.split(';', 1)[0]
+        status = response['status']
+        self.stats.record('route', '%s %s' % (method, path), elapsed,
+                          status >= 500)
+        return status, body
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, kind, name, seconds, failed=False):
+        with self.lock:
+            samples = self.samples.setdefault((kind, name), ([], [0]))
+            samples[0].append(seconds)
+            samples[1][0] += bool(failed)
+
+    def summary(self, wall_time):
+        summary = {}
+        for (kind, name), (times, failed) in sorted(self.samples.items()):
+            times = sorted(times)
+            summary.setdefault(kind, {})[name] = {
+                'count': len(times),
+                'errors': failed[0],
+                'throughput': len(times) / wall_time,
+                'p50': percentile(times, 50),
+                'p95': percentile(times, 95),
+                'p99': percentile(times, 99),
+            }
+        return summary
+
+
+def percentile(sorted_times, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_times:
+        return None
+    rank = int(round(percent / 100.0 * len(sorted_times) + 0.5)) - 1
+    return sorted_times[max(0, min(rank, len(sorted_times) - 1))]
+
+
+def timed(stats, flow, function, *args):
+    start = time.time()
+    failed = True
+    try:
+        failed = not function(*args)
+    finally:
+        stats.record('flow', flow, time.time() - start, failed)
+    return not failed
+
+
+def simulate_user(app, stats, number, retry_interval, poll_timeout):
+    shib_attrs = {
+        'persistent-id': 'https://idp.example.edu.au!https://sp!%d' % number,
+        'displayName': 'Load Test %d' % number,
+        'mail': 'loadtest%d@example.edu.au' % number,
+    }
+    client = Client(app, shib_attrs, stats)
+
+    def first_login():
+        return client.request('GET', '/')[0] == 200
+
+    def accept_terms():
+        return client.request('POST', '/', {'agree': 'true'})[0] == 200
+
+    def poll_status():
+        # as creating_account.html does: the server holds each request
+        # until the state differs from the last one seen
+        deadline = time.time() + poll_timeout
+        state = 'registered'
+        while time.time() < deadline:
+            status, body = client.request('GET', '/account_status/wait',
+                                          query={'state': state})
+            if status != 200:
+                time.sleep(retry_interval)
+                continue
+            new_state = json.loads(body)['state']
+            if new_state in ('created', 'error'):
+                return new_state == 'created'
+            if new_state == state:
+                # a busy server answers without waiting
+                time.sleep(retry_interval)
+            state = new_state
+        return False
+
+    def returning_login():
+        # the index page, or a redirect to the target
+        return client.request('GET', '/')[0] in (200, 303)
+
+    for flow, step in zip(FLOWS, (first_login, accept_terms, poll_status,
+                                  returning_login)):
+        if not timed(stats, flow, step):
+            break
+
+
+def load_app(tmp_dir, database_uri, workers, long_poll_timeout):
+    config_file = os.path.join(tmp_dir, 'loadtest.ini')
+    with open(config_file, 'w') as f:
+        f.write(CONFIG_TEMPLATE % {'database_uri': database_uri,
+                                   'workers': workers,
+                                   'long_poll_timeout': long_poll_timeout})
+    return loadapp('config:' + config_file)
+
+
+def print_summary(summary, wall_time):
+    print('%-32s %6s %6s %8s %9s %9s %9s' % (
+        '', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for kind in ('route', 'flow'):
+        for name, row in sorted(summary.get(kind, {}).items()):
+            print('%-32s %6d %6d %8.1f %9.1f %9.1f %9.1f' % (
+                '%s %s' % (kind, name), row['count'], row['errors'],
+                row['throughput'], row['p50'] * 1000, row['p95'] * 1000,
+                row['p99'] * 1000))
+    print('%.1f s wall time' % wall_time)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=2,
+                        help='provisioning worker threads')
+    parser.add_argument('--existing-accounts', type=int, default=10000,
+                        help='accounts already in the fake directory')
+    parser.add_argument('--ldap-latency', type=float, default=0.005)
+    parser.add_argument('--ldap-failure-rate', type=float, default=0.0)
+    parser.add_argument('--dbus-latency', type=float, default=0.05)
+    parser.add_argument('--dbus-failure-rate', type=float, default=0.0)
+    parser.add_argument('--retry-interval', type=float, default=2,
+                        help='seconds before polling again after an error')
+    parser.add_argument('--long-poll-timeout', type=float, default=25,
+                        help='seconds the server holds a status request')
+    parser.add_argument('--poll-timeout', type=float, default=60,
+                        help='seconds a user waits for their account')
+    parser.add_argument('--database-uri',
+                        help='defaults to a temporary SQLite file')
+    parser.add_argument('--output', help='write the summary as JSON')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    ldap_backend = Backend(args.ldap_latency, args.ldap_failure_rate)
+    dbus_backend = Backend(args.dbus_latency, args.dbus_failure_rate)
+    install_fakes(FakeDirectory(ldap_backend, args.existing_accounts),
+                  dbus_backend)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        database_uri = args.database_uri or \
+            'sqlite:///' + os.path.join(tmp_dir, 'loadtest.sqlite3')
+        app = load_app(tmp_dir, database_uri, args.workers,
+                       args.long_poll_timeout)
+        stats = Stats()
+        pool = ThreadPool(args.concurrency)
+        start = time.time()
+        pool.map(lambda number: simulate_user(app, stats, number,
+                                              args.retry_interval,
+                                              args.poll_timeout),
+                 range(args.users), chunksize=1)
+        pool.close()
+        wall_time = time.time() - start
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    summary = stats.summary(wall_time)
+    print_summary(summary, wall_time)
+    print('ldap: %d calls, %d failures; dbus: %d calls, %d failures' % (
+        ldap_backend.calls, ldap_backend.failures, dbus_backend.calls,
+        dbus_backend.failures))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(summary, wall_time=wall_time), f, indent=2,
+                      separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
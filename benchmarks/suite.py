@@ -0,0 +1,311 @@
+"""Micro-benchmarks of the request hot paths, compared with a baseline.
+
+    python benchmarks/suite.py [--output results.json]
+                               [--baseline benchmarks/baseline.json]
+                               [--threshold 1.25] [--only PREFIX]
+                               [--startup-budget 3]
+
+Every benchmark reports the best seconds per call of several runs. The
+results are printed as a table and, with `--output`, written as JSON in
+the same format as the baseline. With `--baseline` each result is shown
+as a ratio of the stored one and the exit status is 1 if any is slower
+than `--threshold` times its baseline. Refresh the stored baseline on
+the reference machine with
+
+    python benchmarks/suite.py --output benchmarks/baseline.json
+
+LDAP is replaced by synthetic directories and the database by an
+in-memory SQLite one, so nothing outside the process is touched. The
+startup benchmark runs `make_app` in new interpreters, and also fails
+when it takes longer than `--startup-budget` seconds.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+import wsgiref.util
+from datetime import datetime
+
+import bottle
+import sqlalchemy
+from paste.deploy.config import CONFIG
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from shibble import cache
+from shibble import jwt
+from shibble import models
+from shibble import uidalloc
+from shibble import utils
+from shibble import views
+
+FORMAT_VERSION = 1
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORY_SIZES = (1000, 10000, 100000)
+
+SHIB_ENVIRON = {
+    'persistent-id': 'https://idp.example.edu.au!https://sp!abcdef',
+    'cn': 'John Smith',
+    'displayName': 'John Smith',
+    'givenName': 'John',
+    'sn': 'Smith',
+    'mail': 'John.Smith@example.edu.au',
+    'eppn': 'jsmith@example.edu.au',
+    'o': 'Example University',
+    'affiliation': 'staff@example.edu.au;member@example.edu.au',
+    'Shib-Identity-Provider': 'https://idp.example.edu.au/idp/shibboleth',
+    'shared-token': 'aBcDeFgHiJkLmNoPqRsTuVwXyZ0',
+}
+JWT_KEY = 'a shared secret of a realistic length, 32+ bytes'
+JWT_PAYLOAD = {'iss': 'https://rapid.aaf.edu.au',
+               'aud': 'https://shibble.example.com',
+               'jti': '9a1b7f2e3c4d5e6f',
+               'https://aaf.edu.au/attributes': {
+                   'cn': 'John Smith',
+                   'displayname': 'John Smith',
+                   'mail': 'john.smith@example.edu.au',
+                   'edupersontargetedid': 'https://idp!https://sp!abcdef'}}
+
+
+def best_of(function, number, repeat=5):
+    """Return the best time per call in seconds."""
+    return min(timeit.repeat(function, number=number,
+                             repeat=repeat)) / number
+
+
+def bench_attrmap(number=20000):
+    attr_map = views.ShibbolethAttrMap
+    return {
+        'attrmap.parse': best_of(lambda: attr_map.parse(SHIB_ENVIRON),
+                                 number),
+        'attrmap.get_attr': best_of(lambda: attr_map.get_attr('fullname'),
+                                    number * 10),
+    }
+
+
+def bench_jwt(number=20000):
+    token = jwt.encode(JWT_PAYLOAD, JWT_KEY)
+    return {
+        'jwt.encode': best_of(lambda: jwt.encode(JWT_PAYLOAD, JWT_KEY),
+                              number),
+        'jwt.decode': best_of(lambda: jwt.decode(token, JWT_KEY), number),
+    }
+
+
+def synthetic_directory(size, minimum=2000):
+    """Return a `search` over `size` accounts, one uid in 100 free."""
+    uids = [minimum + i for i in range(size + size // 100) if i % 100 != 7]
+
+    def search(since):
+        # nothing is created while the benchmark runs
+        return uids if since is None else []
+    return search
+
+
+def bench_uid(sizes=DIRECTORY_SIZES, number=2000):
+    results = {}
+    saved = utils._uid_allocator
+    try:
+        for size in sizes:
+            search = synthetic_directory(size)
+
+            def first_uid():
+                utils._uid_allocator = uidalloc.UIDAllocator(search)
+                utils.get_next_uid()
+
+            results['uid.seed_%d' % size] = best_of(first_uid, 1)
+            utils._uid_allocator = uidalloc.UIDAllocator(search)
+            results['uid.get_next_uid_%d' % size] = best_of(
+                utils.get_next_uid, number)
+    finally:
+        utils._uid_allocator = saved
+    return results
+
+
+class Session(dict):
+    """The parts of a Beaker session used by the views."""
+
+    def save(self):
+        pass
+
+
+def bind_request(environ, session):
+    environ = dict(environ, **{'beaker.session': session})
+    wsgiref.util.setup_testing_defaults(environ)
+    bottle.request.bind(environ)
+
+
+def bench_views(number=2000):
+    engine = sqlalchemy.create_engine(
+        'sqlite://', poolclass=StaticPool,
+        connect_args={'check_same_thread': False})
+    models.Base.metadata.create_all(engine)
+    make_session = sessionmaker(bind=engine)
+    shib_attrs = views.ShibbolethAttrMap.parse(SHIB_ENVIRON)
+    user_id = shib_attrs['id']
+
+    db = make_session()
+    shib_user = models.User(user_id)
+    shib_user.displayname = shib_attrs['fullname']
+    shib_user.email = shib_attrs['mail']
+    shib_user.terms = datetime.now()
+    shib_user.state = 'created'
+    db.add(shib_user)
+    utils.update_db_user(db, shib_user, shib_attrs)
+    db.commit()
+    db.close()
+    # the LDAP account is known, as it is for any returning user
+    saved_exists_cache = utils._user_exists_cache
+    utils._user_exists_cache = cache.TTLCache()
+    utils._user_exists_cache.set(user_id, True)
+
+    def request(view):
+        # one session per request, as the SQLAlchemy plugin does
+        db = make_session()
+        try:
+            view(db)
+            db.commit()
+        finally:
+            db.close()
+
+    def account_status_cold():
+        utils.USER_STATE_CACHE.invalidate(user_id)
+        request(views.account_status)
+
+    bottle.TEMPLATE_PATH.append(os.path.join(
+        os.path.dirname(views.__file__), 'templates'))
+    CONFIG.push_process_config({'support_url': 'https://support.example.com',
+                                'target': 'https://example.com'})
+    try:
+        bind_request(SHIB_ENVIRON, Session(user_id=user_id))
+        return {
+            'views.root': best_of(lambda: request(views.root), number),
+            'views.account_status': best_of(
+                lambda: request(views.account_status), number),
+            'views.account_status_cold': best_of(account_status_cold,
+                                                 number),
+        }
+    finally:
+        CONFIG.pop_process_config()
+        utils._user_exists_cache = saved_exists_cache
+        engine.dispose()
+
+
+COLD_START = """
+import json
+import sys
+import time
+
+start = time.time()
+from shibble import wsgiapp
+app = wsgiapp.make_app({'__file__': sys.argv[1],
+                        'support_url': 'https://support.example.com'},
+                       'sqlite://', provisioning_workers='0')
+print(json.dumps({'seconds': time.time() - start}))
+"""
+
+
+def cold_start():
+    """Return the seconds a new interpreter takes to run make_app."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        config_file = os.path.join(tmp_dir, 'shibble.conf')
+        with open(config_file, 'w') as f:
+            f.write('[ldap]\nuser_dn = ou=Users,dc=localdomain\n')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + filter(None, [env.get('PYTHONPATH')]))
+        output = subprocess.check_output(
+            [sys.executable, '-W', 'ignore', '-c', COLD_START, config_file],
+            env=env, cwd=tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return json.loads(output.splitlines()[-1])['seconds']
+
+
+def bench_startup(repeat=3):
+    # the best of a few runs, to ride out a busy machine
+    return {'startup.make_app': min(cold_start() for i in range(repeat))}
+
+
+BENCHMARKS = (bench_attrmap, bench_jwt, bench_startup, bench_uid,
+              bench_views)
+
+
+def run(only=None):
+    results = {}
+    for bench in BENCHMARKS:
+        if only and not bench.__name__[len('bench_'):].startswith(only):
+            continue
+        results.update(bench())
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return `(name, seconds, ratio)` rows and the regressed names."""
+    rows = []
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        ratio = None
+        if name in baseline:
+            ratio = seconds / baseline[name]
+            if ratio > threshold:
+                regressions.append(name)
+        rows.append((name, seconds, ratio))
+    return rows, regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with this results file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio counted as a regression')
+    parser.add_argument('--only', help='run the benchmarks of one group, '
+                        'e.g. jwt or uid')
+    parser.add_argument('--startup-budget', type=float, default=3,
+                        help='seconds allowed for a new worker to import '
+                        'shibble and run make_app')
+    args = parser.parse_args(argv[1:])
+
+    results = run(args.only)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    rows, regressions = compare(results, baseline, args.threshold)
+    startup = results.get('startup.make_app')
+    over_budget = startup is not None and startup > args.startup_budget
+
+    for name, seconds, ratio in rows:
+        line = '%-28s %12.2f us' % (name, seconds * 1e6)
+        if ratio is not None:
+            line += '  %5.2fx%s' % (
+                ratio, '  REGRESSION' if name in regressions else '')
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'version': FORMAT_VERSION,
+                       'python': platform.python_version(),
+                       'results': results},
+                      f, indent=2, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+    if over_budget:
+        print('make_app took %.2fs, over the %.2fs budget' % (
+            startup, args.startup_budget))
+    if regressions:
+        print('%d benchmarks regressed more than %.2fx: %s' % (
+            len(regressions), args.threshold, ', '.join(regressions)))
+    if regressions or over_budget:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
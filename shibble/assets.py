@@ -0,0 +1,236 @@
+"""Fingerprinted, precompressed static assets.
+
+The build step copies every file of the static directory to a build
+directory under a name containing a hash of its content, e.g.
+`base.3f2a9c1d0e4b.css`, next to `.gz` and `.br` compressed variants of
+the text ones and a `manifest.json` mapping the plain names to the
+fingerprinted ones:
+
+    python -m shibble.assets [static_dir] [build_dir]
+
+`AssetIndex` reads the metadata of every file once, at startup, and
+answers requests from memory. Fingerprinted names never change content
+so they are cached by browsers for a year, plain names are revalidated
+with their ETag. `.br` variants need the optional `brotli` package.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import sys
+import time
+from email.utils import formatdate
+from os import path
+
+from bottle import HTTPError, HTTPResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LOG = logging.getLogger('shibble.assets')
+
+STATIC_DIR = path.join(path.dirname(__file__), 'static')
+BUILD_DIR = path.join(STATIC_DIR, 'build')
+MANIFEST = 'manifest.json'
+
+# in order of preference when the client accepts several
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json',
+                'image/svg+xml')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, no-cache'
+
+
+def _digest(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def fingerprinted_name(name, digest):
+    base, ext = path.splitext(name)
+    return '%s.%s%s' % (base, digest[:12], ext)
+
+
+def _content_type(name):
+    content_type, encoding = mimetypes.guess_type(name)
+    content_type = content_type or 'application/octet-stream'
+    if content_type.startswith('text/') or \
+            content_type == 'application/javascript':
+        content_type += '; charset=UTF-8'
+    return content_type
+
+
+def _compressible(name):
+    return _content_type(name).startswith(COMPRESSIBLE)
+
+
+def _compress(source, target, coding):
+    with open(source, 'rb') as f:
+        data = f.read()
+    if coding == 'gzip':
+        with open(target, 'wb') as f:
+            # a fixed mtime keeps the output identical between builds
+            with gzip.GzipFile(path.basename(source), 'wb', 9, f, 0) as gz:
+                gz.write(data)
+    else:
+        with open(target, 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+    if path.getsize(target) >= len(data):
+        # not worth sending
+        os.remove(target)
+
+
+def build(static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+    """Write the fingerprinted assets and their manifest to `build_dir`."""
+    if path.isdir(build_dir):
+        shutil.rmtree(build_dir)
+    os.makedirs(build_dir)
+    manifest = {}
+    for name in sorted(os.listdir(static_dir)):
+        source = path.join(static_dir, name)
+        if not path.isfile(source):
+            continue
+        fingerprinted = fingerprinted_name(name, _digest(source))
+        target = path.join(build_dir, fingerprinted)
+        shutil.copy2(source, target)
+        if _compressible(name):
+            for coding, suffix in ENCODINGS:
+                if coding == 'br' and brotli is None:
+                    continue
+                _compress(target, target + suffix, coding)
+        manifest[name] = fingerprinted
+    with open(path.join(build_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, separators=(',', ': '),
+                  sort_keys=True)
+        f.write('\n')
+    return manifest
+
+
+class Asset(object):
+    """What is needed to answer a request for one file."""
+
+    def __init__(self, filename, immutable=False):
+        stat = os.stat(filename)
+        self.filename = filename
+        self.size = stat.st_size
+        self.content_type = _content_type(filename)
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.digest = _digest(filename)
+        self.cache_control = IMMUTABLE if immutable else REVALIDATE
+        # coding -> (filename, size)
+        self.variants = {}
+        for coding, suffix in ENCODINGS:
+            if path.isfile(filename + suffix):
+                self.variants[coding] = (filename + suffix,
+                                         path.getsize(filename + suffix))
+
+
+def accepted_encodings(header):
+    """Return the codings of an Accept-Encoding header by quality."""
+    accepted = {}
+    for item in (header or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        if coding:
+            accepted[coding.strip().lower()] = quality
+    return accepted
+
+
+class AssetIndex(object):
+    """The files served under /static, read once from disk.
+
+    The plain names are served from `static_dir`, the fingerprinted names
+    and their compressed variants from `build_dir` when it has been
+    built.
+    """
+
+    def __init__(self, static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+        self.assets = {}
+        self.manifest = {}
+        for name in os.listdir(static_dir):
+            filename = path.join(static_dir, name)
+            if path.isfile(filename):
+                self.assets[name] = Asset(filename)
+        manifest = path.join(build_dir, MANIFEST)
+        if path.isfile(manifest):
+            with open(manifest) as f:
+                self.manifest = json.load(f)
+            for fingerprinted in self.manifest.values():
+                self.assets[fingerprinted] = Asset(
+                    path.join(build_dir, fingerprinted), immutable=True)
+        else:
+            LOG.warning('No asset manifest in %s, serving the static files '
+                        'without fingerprints or compression', build_dir)
+
+    def url(self, name):
+        """Return the fingerprinted name of an asset, if it was built."""
+        return self.manifest.get(name, name)
+
+    def _choose(self, asset, accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        best = None, asset.filename, asset.size
+        best_quality = 0
+        for coding, suffix in ENCODINGS:
+            if coding not in asset.variants:
+                continue
+            quality = accepted.get(coding, accepted.get('*', 0))
+            if quality > best_quality:
+                best = (coding,) + asset.variants[coding]
+                best_quality = quality
+        return best
+
+    def response(self, name, environ):
+        """Return the HTTPResponse for a request of the asset `name`."""
+        asset = self.assets.get(name)
+        if asset is None:
+            return HTTPError(404, 'File does not exist.')
+        coding, filename, size = self._choose(
+            asset, environ.get('HTTP_ACCEPT_ENCODING'))
+        etag = '"%s%s"' % (asset.digest[:16],
+                           '-' + coding if coding else '')
+        headers = {'Content-Type': asset.content_type,
+                   'Cache-Control': asset.cache_control,
+                   'ETag': etag,
+                   'Last-Modified': asset.last_modified}
+        if asset.variants:
+            headers['Vary'] = 'Accept-Encoding'
+        if coding:
+            headers['Content-Encoding'] = coding
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return HTTPResponse(status=304, **headers)
+
+        headers['Content-Length'] = str(size)
+        body = ''
+        if environ.get('REQUEST_METHOD') != 'HEAD':
+            # bottle hands file bodies to wsgi.file_wrapper, so the server
+            # can send them with sendfile
+            body = open(filename, 'rb')
+        return HTTPResponse(body, **headers)
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    static_dir = argv[1] if len(argv) > 1 else STATIC_DIR
+    build_dir = argv[2] if len(argv) > 2 else path.join(static_dir, 'build')
+    start = time.time()
+    manifest = build(static_dir, build_dir)
+    LOG.info('Built %d assets in %s in %.1fs%s', len(manifest), build_dir,
+             time.time() - start,
+             '' if brotli else ', install brotli for .br variants')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,121 @@
+"""Mapping of identity provider attributes to shibble's names.
+
+Maps are compiled once into a list of (source key, name, normaliser)
+tuples and a reverse index, so parsing a request is a single pass over
+the keys the map needs.
+
+New maps, or replacements for the built-in ones, can be declared in the
+config file::
+
+    [attribute_map:shibboleth]
+    id = persistent-id
+    mail = mail lower
+    affiliation = affiliation split
+
+Each option is the name used by shibble, the value is the source key
+followed by any normalisers to apply in order. Values are always
+strings, `split` normalises a multi-valued `a;b` attribute to its
+distinct values, sorted and joined by `;`. Sources giving unicode values,
+such as JSON, should apply `utf8` first.
+"""
+
+
+def _split(value):
+    # sorted so that the IdP's ordering doesn't change the user's digest
+    values = set(v.strip() for v in str(value).split(';'))
+    return ';'.join(sorted(v for v in values if v))
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+NORMALISERS = {
+    'str': str,
+    'utf8': _utf8,
+    'lower': lambda value: str(value.lower()),
+    'strip': lambda value: str(value.strip()),
+    'split': _split,
+}
+
+
+def _compose(names):
+    functions = [NORMALISERS[name] for name in names]
+    if not functions:
+        return str
+    if len(functions) == 1:
+        return functions[0]
+
+    def normalise(value):
+        for function in functions:
+            value = function(value)
+        return value
+    return normalise
+
+
+class AttributeMap(object):
+    def __init__(self, data, normalisers=None):
+        """`data` maps source keys to names, `normalisers` maps source keys
+        to a list of normaliser names, values are passed through `str`
+        by default.
+        """
+        normalisers = normalisers or {}
+        self.data = dict(data)
+        self._reverse = dict((v, k) for k, v in self.data.items())
+        self._extract = tuple(
+            (k, v, _compose(normalisers.get(k, [])))
+            for k, v in sorted(self.data.items()))
+
+    @classmethod
+    def from_config(cls, options, defaults=None):
+        """Build a map from an `[attribute_map:...]` config section."""
+        defaults = defaults or {}
+        data = {}
+        normalisers = {}
+        for name, value in options.items():
+            if name in defaults and defaults[name] == value:
+                # ConfigParser merges the DEFAULT section into every section
+                continue
+            spec = value.split()
+            data[spec[0]] = name
+            normalisers[spec[0]] = spec[1:]
+            for normaliser in spec[1:]:
+                if normaliser not in NORMALISERS:
+                    raise ValueError("Unknown attribute normaliser '%s' for "
+                                     "'%s'." % (normaliser, name))
+        return cls(data, normalisers)
+
+    def parse(self, environ):
+        metadata = {}
+        get = environ.get
+        for key, name, normalise in self._extract:
+            value = get(key)
+            if value:
+                metadata[name] = normalise(value)
+        return metadata
+
+    def get_attr(self, name):
+        return self._reverse.get(name)
+
+
+_maps = {}
+
+
+def register(name, attr_map):
+    _maps[name] = attr_map
+    return attr_map
+
+
+def get(name):
+    return _maps[name]
+
+
+def load_config(conf):
+    """Register the maps declared in `[attribute_map:<name>]` sections."""
+    for section, options in conf.items():
+        if section.startswith('attribute_map:'):
+            name = section.split(':', 1)[1]
+            register(name, AttributeMap.from_config(
+                options, defaults=conf.get('DEFAULT')))
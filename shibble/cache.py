@@ -0,0 +1,65 @@
+"""In-process caches."""
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    """A bounded mapping with least recently used eviction whose entries
+    expire `ttl` seconds after being set.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[1] > time.time()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[1] <= now:
+                self.misses += 1
+                return default
+            # move to the most recently used end
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
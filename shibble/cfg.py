@@ -1,8 +1,7 @@
 #!/usr/bin/env python
 
 import ConfigParser
-
-from oslo_config import cfg
+import threading
 
 
 class AttrDict(dict):
@@ -22,5 +21,36 @@ class Config(AttrDict):
             self[section] = AttrDict(conf.items(section))
 
 
+class LazyOsloConfig(object):
+    """oslo.config's global CONF, imported and parsed on first use.
+
+    Calling it only records the arguments, they are passed on to the real
+    CONF when one of its attributes is first looked up.
+    """
+
+    def __init__(self):
+        self._args = None
+        self._conf = None
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            self._args = (args, kwargs)
+            self._conf = None
+
+    def _load(self):
+        with self._lock:
+            if self._conf is None:
+                from oslo_config import cfg
+                if self._args is not None:
+                    args, kwargs = self._args
+                    cfg.CONF(*args, **kwargs)
+                self._conf = cfg.CONF
+            return self._conf
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
 CONF = Config()
-OSLO_CONF = cfg.CONF
+OSLO_CONF = LazyOsloConfig()
@@ -0,0 +1,130 @@
+"""Database engines and their connection pools.
+
+Every connection a request or provisioning worker waits for is timed, by
+pool, along with the checkouts that found the pool exhausted and those
+that gave up waiting:
+
+    engine = db.create_engine(database_uri, **db.pool_settings(conf))
+    db.warm_up(engine)
+"""
+import threading
+import time
+
+import sqlalchemy
+from paste.deploy.converters import asbool
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from shibble import metrics
+
+POOL_CHECKOUT_SECONDS = metrics.Histogram(
+    'shibble_db_pool_checkout_seconds',
+    'Time spent getting a database connection from the pool.', label='pool')
+POOL_EXHAUSTED = metrics.Counter(
+    'shibble_db_pool_exhausted_total',
+    'Checkouts that found every database connection in use.', label='pool')
+POOL_TIMEOUTS = metrics.Counter(
+    'shibble_db_pool_timeouts_total',
+    'Checkouts that gave up waiting for a database connection.',
+    label='pool')
+
+# name -> engine, for the pool gauges
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool timing how long its checkouts wait.
+
+    The pool is named by its `logging_name`, which SQLAlchemy keeps when
+    it recreates the pool on `engine.dispose()`.
+    """
+
+    def _do_get(self):
+        name = self.logging_name
+        if self._max_overflow > -1 and \
+                self.checkedout() >= self.size() + self._max_overflow:
+            POOL_EXHAUSTED.inc(label_value=name)
+        start = time.time()
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            POOL_TIMEOUTS.inc(label_value=name)
+            raise
+        finally:
+            POOL_CHECKOUT_SECONDS.observe(time.time() - start, name)
+
+
+def pool_settings(conf, prefix='db_'):
+    """Read the pool options starting with `prefix` from a paste config."""
+    return {
+        'pool_size': int(conf.get(prefix + 'pool_size', 5)),
+        'max_overflow': int(conf.get(prefix + 'max_overflow', 10)),
+        'pool_recycle': int(conf.get(prefix + 'pool_recycle', 3600)),
+        'pool_pre_ping': asbool(conf.get(prefix + 'pool_pre_ping', False)),
+        'pool_timeout': float(conf.get(prefix + 'pool_timeout', 30)),
+    }
+
+
+def create_engine(database_uri, name='primary', **settings):
+    """Return an engine with an instrumented pool of connections.
+
+    `settings` are those returned by `pool_settings`.
+    """
+    connect_args = {}
+    if database_uri.startswith('sqlite'):
+        # pooled connections are handed to whichever thread checks them
+        # out, never to two at once
+        connect_args['check_same_thread'] = False
+    engine = sqlalchemy.create_engine(database_uri,
+                                      poolclass=InstrumentedQueuePool,
+                                      pool_logging_name=name,
+                                      connect_args=connect_args,
+                                      **settings)
+    metrics.instrument_engine(engine)
+    with _engines_lock:
+        _engines[name] = engine
+    return engine
+
+
+def warm_up(engine, connections=None):
+    """Open `connections`, by default the whole pool, ahead of requests."""
+    if connections is None:
+        connections = engine.pool.size()
+    opened = []
+    try:
+        for i in range(connections):
+            opened.append(engine.connect())
+    finally:
+        # back to the pool, still open
+        for connection in opened:
+            connection.close()
+    return len(opened)
+
+
+@metrics.collector
+def collect_metrics():
+    """Expose how full each pool is."""
+    with _engines_lock:
+        pools = [(name, engine.pool)
+                 for name, engine in sorted(_engines.items())]
+    connections = []
+    limits = []
+    for name, pool in pools:
+        connections.extend([
+            ({'pool': name, 'state': 'in_use'}, pool.checkedout()),
+            ({'pool': name, 'state': 'idle'}, pool.checkedin()),
+            # the overflow counter starts below zero, at -pool_size
+            ({'pool': name, 'state': 'overflow'}, max(pool.overflow(), 0)),
+        ])
+        if pool._max_overflow > -1:
+            limits.append(({'pool': name},
+                           pool.size() + pool._max_overflow))
+    return [
+        ('shibble_db_pool_connections',
+         'Database connections checked out, idle in the pool, or opened '
+         'beyond its size.', 'gauge', connections),
+        ('shibble_db_pool_max_connections',
+         'Connections a pool opens before checkouts have to wait.', 'gauge',
+         limits),
+    ]
@@ -0,0 +1,195 @@
+"""Asymmetric JWT keys, loaded from a directory of JWKS and PEM files.
+
+Keys are indexed by `kid`. A JWKS file (`*.json` or `*.jwks`) holds a
+`{"keys": [...]}` set of public RSA or P-256 EC keys, each with its own
+`kid`. A PEM file holds a single public or private key, its `kid` is the
+file name without the `.pem` extension. Parsed keys are kept between
+requests and the whole set is swapped at once when the files change.
+
+RS256 and ES256 need the `cryptography` package.
+"""
+import base64
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives.asymmetric.utils import (
+        decode_dss_signature, encode_dss_signature)
+except ImportError:
+    default_backend = None
+
+LOG = logging.getLogger('shibble.jwk')
+
+ALGORITHMS = ('RS256', 'ES256')
+
+
+class JWKError(LookupError):
+    pass
+
+
+def _b64_to_int(value):
+    value = str(value)
+    value += '=' * (-len(value) % 4)
+    return int(base64.urlsafe_b64decode(value).encode('hex'), 16)
+
+
+def _int_to_bytes(value, length):
+    return ('%0*x' % (length * 2, value)).decode('hex')
+
+
+class Key(object):
+    """An RS256 or ES256 key. Only keys with a private half can sign."""
+
+    def __init__(self, kid, public_key, private_key=None):
+        if default_backend is None:
+            raise NotImplementedError("RS256 and ES256 need the "
+                                      "cryptography package")
+        self.kid = kid
+        self.public_key = public_key
+        self.private_key = private_key
+        if isinstance(public_key, rsa.RSAPublicKey):
+            self.algorithm = 'RS256'
+        elif isinstance(public_key, ec.EllipticCurvePublicKey) and \
+                public_key.curve.name == 'secp256r1':
+            self.algorithm = 'ES256'
+        else:
+            raise JWKError("Unsupported key type for '%s'" % kid)
+
+    @classmethod
+    def from_pem(cls, kid, data):
+        backend = default_backend()
+        if '-----BEGIN PUBLIC KEY-----' in data:
+            return cls(kid, serialization.load_pem_public_key(data, backend))
+        private_key = serialization.load_pem_private_key(data, None, backend)
+        return cls(kid, private_key.public_key(), private_key)
+
+    @classmethod
+    def from_jwk(cls, jwk):
+        backend = default_backend()
+        kid = jwk.get('kid')
+        if jwk.get('kty') == 'RSA':
+            numbers = rsa.RSAPublicNumbers(_b64_to_int(jwk['e']),
+                                           _b64_to_int(jwk['n']))
+        elif jwk.get('kty') == 'EC' and jwk.get('crv') == 'P-256':
+            numbers = ec.EllipticCurvePublicNumbers(
+                _b64_to_int(jwk['x']), _b64_to_int(jwk['y']),
+                ec.SECP256R1())
+        else:
+            raise JWKError("Unsupported key type for '%s'" % kid)
+        return cls(kid, numbers.public_key(backend))
+
+    def sign(self, msg):
+        if self.private_key is None:
+            raise JWKError("No private key for '%s'" % self.kid)
+        if self.algorithm == 'RS256':
+            return self.private_key.sign(msg, padding.PKCS1v15(),
+                                         hashes.SHA256())
+        # JWS wants the raw r || s pair rather than DER
+        r, s = decode_dss_signature(
+            self.private_key.sign(msg, ec.ECDSA(hashes.SHA256())))
+        return _int_to_bytes(r, 32) + _int_to_bytes(s, 32)
+
+    def verify(self, msg, signature):
+        try:
+            if self.algorithm == 'RS256':
+                self.public_key.verify(signature, msg, padding.PKCS1v15(),
+                                       hashes.SHA256())
+            else:
+                if len(signature) != 64:
+                    return False
+                signature = encode_dss_signature(
+                    int(signature[:32].encode('hex'), 16),
+                    int(signature[32:].encode('hex'), 16))
+                self.public_key.verify(signature, msg,
+                                       ec.ECDSA(hashes.SHA256()))
+        except InvalidSignature:
+            return False
+        return True
+
+
+class KeySet(object):
+    """The keys in `directory`, indexed by `kid`.
+
+    The directory is checked for changes at most every `check_interval`
+    seconds. Changed files are all parsed before the new set replaces the
+    old one, if any of them fails to load the old set is kept.
+    """
+
+    extensions = ('.json', '.jwks', '.pem')
+
+    def __init__(self, directory, check_interval=5):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._files = None
+        self._checked_at = 0
+
+    def _list_files(self):
+        files = []
+        for name in sorted(os.listdir(self.directory)):
+            if os.path.splitext(name)[1] in self.extensions:
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((name, stat.st_mtime, stat.st_size))
+        return tuple(files)
+
+    def _load(self, files):
+        keys = {}
+        for name, mtime, size in files:
+            with open(os.path.join(self.directory, name)) as f:
+                data = f.read()
+            base, ext = os.path.splitext(name)
+            if ext == '.pem':
+                loaded = [Key.from_pem(base, data)]
+            else:
+                loaded = [Key.from_jwk(jwk)
+                          for jwk in json.loads(data)['keys']]
+            for key in loaded:
+                if key.kid in keys:
+                    raise JWKError("Duplicate kid '%s' in %s" % (key.kid,
+                                                                 name))
+                keys[key.kid] = key
+        return keys
+
+    def reload(self, force=False):
+        """Reload the keys if the files have changed."""
+        now = time.time()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            try:
+                files = self._list_files()
+                if files == self._files:
+                    return
+                keys = self._load(files)
+            except Exception:
+                LOG.exception('Failed to load the keys in %s, keeping the '
+                              'previous set', self.directory)
+                return
+            self._keys = keys
+            self._files = files
+            LOG.info('Loaded %d keys from %s', len(keys), self.directory)
+
+    def get(self, kid):
+        self.reload()
+        try:
+            return self._keys[kid]
+        except KeyError:
+            raise JWKError("Unknown key '%s'" % kid)
+
+    __getitem__ = get
+
+    def kids(self):
+        self.reload()
+        return sorted(self._keys)
@@ -6,6 +6,7 @@ http://self-issued.info/docs/draft-jones-json-web-token-01.html
 import base64
 import hashlib
 import hmac
+import sys
 
 from datetime import datetime
 from calendar import timegm
@@ -16,7 +17,13 @@ try:
 except ImportError:
     import simplejson as json
 
-__all__ = ['encode', 'decode', 'DecodeError']
+from shibble import lazy
+
+# loads `cryptography`, only needed for RS256 and ES256 keys
+jwk = lazy.LazyModule('shibble.jwk')
+
+__all__ = ['encode', 'encode_many', 'decode', 'decode_many', 'DecodeError',
+           'ReplayedToken']
 
 
 class DecodeError(Exception):
@@ -27,25 +34,74 @@ class ExpiredSignature(Exception):
     pass
 
 
-signing_methods = {
-    'HS256': lambda msg, key: hmac.new(key, msg, hashlib.sha256).digest(),
-    'HS384': lambda msg, key: hmac.new(key, msg, hashlib.sha384).digest(),
-    'HS512': lambda msg, key: hmac.new(key, msg, hashlib.sha512).digest(),
+class ReplayedToken(DecodeError):
+    pass
+
+
+hash_methods = {
+    'HS256': hashlib.sha256,
+    'HS384': hashlib.sha384,
+    'HS512': hashlib.sha512,
 }
 
+# tokens longer than this are rejected before being decoded
+MAX_TOKEN_SIZE = 8192
 
-def constant_time_compare(val1, val2):
-    """
-    Returns True if the two strings are equal, False otherwise.
+# (key, algorithm) -> keyed HMAC object, copied for each token
+_prepared_keys = {}
+_MAX_PREPARED_KEYS = 64
+
+
+def prepare_key(key, algorithm):
+    """Return an HMAC object for `key`, built once per (key, algorithm).
 
-    The time taken is independent of the number of characters that match.
+    Callers must `.copy()` it before feeding it a message.
     """
-    if len(val1) != len(val2):
-        return False
-    result = 0
-    for x, y in zip(val1, val2):
-        result |= ord(x) ^ ord(y)
-    return result == 0
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    try:
+        return _prepared_keys[(key, algorithm)]
+    except KeyError:
+        pass
+    try:
+        digestmod = hash_methods[algorithm]
+    except KeyError:
+        raise NotImplementedError("Algorithm not supported")
+    prepared = hmac.new(key, digestmod=digestmod)
+    if len(_prepared_keys) >= _MAX_PREPARED_KEYS:
+        _prepared_keys.clear()
+    _prepared_keys[(key, algorithm)] = prepared
+    return prepared
+
+
+def sign(msg, key, algorithm):
+    mac = prepare_key(key, algorithm).copy()
+    mac.update(msg)
+    return mac.digest()
+
+
+signing_methods = dict(
+    (algorithm, lambda msg, key, algorithm=algorithm:
+        sign(msg, key, algorithm))
+    for algorithm in hash_methods)
+
+
+try:
+    constant_time_compare = hmac.compare_digest
+except AttributeError:
+    def constant_time_compare(val1, val2):
+        """
+        Returns True if the two strings are equal, False otherwise.
+
+        The time taken is independent of the number of characters that
+        match.
+        """
+        if len(val1) != len(val2):
+            return False
+        result = 0
+        for x, y in zip(val1, val2):
+            result |= ord(x) ^ ord(y)
+        return result == 0
 
 
 def base64url_decode(input):
@@ -59,56 +115,195 @@ def base64url_encode(input):
     return base64.urlsafe_b64encode(input).replace('=', '')
 
 
+# header segment -> parsed header, tokens from one issuer share a header
+_headers = {}
+_MAX_HEADERS = 32
+
+
+def _parse_header(header_segment):
+    try:
+        return _headers[header_segment]
+    except KeyError:
+        pass
+    try:
+        header = json.loads(base64url_decode(header_segment))
+    except TypeError:
+        raise DecodeError("Invalid header padding")
+    except ValueError as e:
+        raise DecodeError("Invalid header string: %s" % e)
+    if not isinstance(header, Mapping):
+        raise DecodeError("Invalid header string: not an object")
+    if len(_headers) >= _MAX_HEADERS:
+        _headers.clear()
+    _headers[header_segment] = header
+    return header
+
+
 def header(jwt):
     header_segment = jwt.split('.', 1)[0]
     try:
-        return json.loads(base64url_decode(header_segment))
-    except (ValueError, TypeError):
+        return dict(_parse_header(header_segment))
+    except DecodeError:
         raise DecodeError("Invalid header encoding")
 
 
-def encode(payload, key, algorithm='HS256'):
-    segments = []
+def _dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+# (algorithm, kid) -> encoded header segment
+_header_segments = {}
+
+
+def _is_jwk(key, *class_names):
+    """Whether `key` is an instance of one of the `shibble.jwk` classes.
+
+    There can't be any before the module is loaded, so this doesn't load
+    it.
+    """
+    module = sys.modules.get('shibble.jwk')
+    return module is not None and isinstance(
+        key, tuple(getattr(module, name) for name in class_names))
+
+
+def _header_segment(algorithm, kid=None):
+    try:
+        return _header_segments[(algorithm, kid)]
+    except KeyError:
+        pass
+    if algorithm not in hash_methods and algorithm not in jwk.ALGORITHMS:
+        raise NotImplementedError("Algorithm not supported")
+    header = {"typ": "JWT", "alg": algorithm}
+    if kid is not None:
+        header["kid"] = kid
+    segment = base64url_encode(_dumps(header))
+    if len(_header_segments) >= _MAX_HEADERS:
+        _header_segments.clear()
+    _header_segments[(algorithm, kid)] = segment
+    return segment
+
 
+def _payload_segment(payload):
     # Check that we get a mapping
     if not isinstance(payload, Mapping):
         raise TypeError("Expecting a mapping object, as json web token only"
                         "support json objects.")
 
-    # Header
-    header = {"typ": "JWT", "alg": algorithm}
-    segments.append(base64url_encode(json.dumps(header)))
+    # Convert datetimes without changing the caller's payload
+    converted = None
+    for claim in ('exp', 'nbf', 'iat'):
+        if isinstance(payload.get(claim), datetime):
+            if converted is None:
+                converted = dict(payload)
+            converted[claim] = timegm(payload[claim].utctimetuple())
+    return base64url_encode(_dumps(converted or payload))
+
 
-    # Payload
-    if isinstance(payload.get('exp'), datetime):
-        payload['exp'] = timegm(payload['exp'].utctimetuple())
-    segments.append(base64url_encode(json.dumps(payload)))
+def encode(payload, key, algorithm=None):
+    """Sign `payload`.
 
-    # Segments
-    signing_input = '.'.join(segments)
+    `key` is a shared secret for the HS algorithms, HS256 by default, or a
+    `jwk.Key` with a private half for RS256 and ES256, whose `kid` is put
+    in the header. The algorithm of a `jwk.Key` is its own.
+    """
+    if _is_jwk(key, 'Key'):
+        if algorithm not in (None, key.algorithm):
+            raise NotImplementedError("Algorithm not supported by key")
+        signing_input = '%s.%s' % (_header_segment(key.algorithm, key.kid),
+                                   _payload_segment(payload))
+        signature = key.sign(signing_input)
+    else:
+        algorithm = algorithm or 'HS256'
+        if algorithm not in hash_methods:
+            raise NotImplementedError("Algorithm not supported")
+        signing_input = '%s.%s' % (_header_segment(algorithm),
+                                   _payload_segment(payload))
+        signature = sign(signing_input, key, algorithm)
+    return '%s.%s' % (signing_input, base64url_encode(signature))
+
+
+def encode_many(payloads, key, algorithm=None):
+    """Sign a batch of payloads with the same key, return the tokens."""
+    if _is_jwk(key, 'Key'):
+        return [encode(payload, key, algorithm) for payload in payloads]
+    algorithm = algorithm or 'HS256'
+    header_segment = _header_segment(algorithm)
+    prepared = prepare_key(key, algorithm)
+    tokens = []
+    for payload in payloads:
+        signing_input = '%s.%s' % (header_segment, _payload_segment(payload))
+        mac = prepared.copy()
+        mac.update(signing_input)
+        tokens.append('%s.%s' % (signing_input,
+                                 base64url_encode(mac.digest())))
+    return tokens
+
+
+def _verify(signing_input, signature, key, header):
+    algorithm = header.get('alg')
+    if not isinstance(algorithm, basestring):
+        raise DecodeError("Algorithm not supported")
+    if _is_jwk(key, 'Key', 'KeySet'):
+        if algorithm not in jwk.ALGORITHMS:
+            raise DecodeError("Algorithm not supported")
+        try:
+            if isinstance(key, jwk.KeySet):
+                key = key.get(header.get('kid'))
+            # the header must not pick a weaker use of the key
+            if key.algorithm != algorithm:
+                raise DecodeError("Algorithm not supported by key")
+            return key.verify(signing_input, signature)
+        except (TypeError, jwk.JWKError) as e:
+            raise DecodeError("Invalid key: %s" % e)
+    if algorithm not in hash_methods:
+        raise DecodeError("Algorithm not supported")
     try:
-        if isinstance(key, unicode):
-            key = key.encode('utf-8')
-        signature = signing_methods[algorithm](signing_input, key)
-    except KeyError:
-        raise NotImplementedError("Algorithm not supported")
-    segments.append(base64url_encode(signature))
-    return '.'.join(segments)
+        expected = sign(signing_input, key, algorithm)
+    except TypeError as e:
+        raise DecodeError("Invalid key: %s" % e)
+    return constant_time_compare(signature, expected)
+
+
+def decode(jwt, key='', verify=True, verify_expiration=True, leeway=0,
+           max_size=MAX_TOKEN_SIZE, replay_store=None, audience=None,
+           issuer=None):
+    """Decode and verify a token.
 
+    `key` is a shared secret for the HS algorithms, or a `jwk.Key` or
+    `jwk.KeySet` for RS256 and ES256, the set is searched by the `kid`
+    in the header.
 
-def decode(jwt, key='', verify=True, verify_expiration=True, leeway=0):
+    When given, `audience` must be (one of) the token's `aud` and `issuer`
+    its `iss`. A token with an `nbf` isn't accepted before that time.
+
+    With a `replay_store` (see `shibble.replay`) tokens must carry a `jti`
+    and each one is only accepted once.
+
+    Tokens longer than `max_size` are rejected before any decoding and the
+    signature is checked before the payload is parsed, so forged tokens
+    are cheap to reject.
+    """
     try:
-        signing_input, crypto_segment = str(jwt).rsplit('.', 1)
+        jwt = str(jwt)
+    except ValueError:
+        raise DecodeError("Not enough segments")
+    if max_size and len(jwt) > max_size:
+        raise DecodeError("Token is too large")
+    try:
+        signing_input, crypto_segment = jwt.rsplit('.', 1)
         header_segment, payload_segment = signing_input.split('.', 1)
     except ValueError:
         raise DecodeError("Not enough segments")
 
-    try:
-        header = json.loads(base64url_decode(header_segment))
-    except TypeError:
-        raise DecodeError("Invalid header padding")
-    except ValueError as e:
-        raise DecodeError("Invalid header string: %s" % e)
+    header = _parse_header(header_segment)
+
+    if verify:
+        try:
+            signature = base64url_decode(crypto_segment)
+        except TypeError:
+            raise DecodeError("Invalid crypto padding")
+        if not _verify(signing_input, signature, key, header):
+            raise DecodeError("Signature verification failed")
 
     try:
         payload = json.loads(base64url_decode(payload_segment))
@@ -117,23 +312,46 @@ def decode(jwt, key='', verify=True, verify_expiration=True, leeway=0):
     except ValueError as e:
         raise DecodeError("Invalid payload string: %s" % e)
 
-    try:
-        signature = base64url_decode(crypto_segment)
-    except TypeError:
-        raise DecodeError("Invalid crypto padding")
-
     if verify:
-        try:
-            if isinstance(key, unicode):
-                key = key.encode('utf-8')
-            expected = signing_methods[header['alg']](signing_input, key)
-            if not constant_time_compare(signature, expected):
-                raise DecodeError("Signature verification failed")
-        except KeyError:
-            raise DecodeError("Algorithm not supported")
+        if not isinstance(payload, Mapping):
+            raise DecodeError("Invalid payload string: not an object")
 
+        utc_timestamp = timegm(datetime.utcnow().utctimetuple())
         if 'exp' in payload and verify_expiration:
-            utc_timestamp = timegm(datetime.utcnow().utctimetuple())
             if payload['exp'] < (utc_timestamp - leeway):
                 raise ExpiredSignature("Signature has expired")
+        if 'nbf' in payload and verify_expiration:
+            if payload['nbf'] > (utc_timestamp + leeway):
+                raise DecodeError("Token is not yet valid")
+
+        if audience is not None:
+            aud = payload.get('aud')
+            if not isinstance(aud, list):
+                aud = [aud]
+            if audience not in aud:
+                raise DecodeError("Invalid audience")
+        if issuer is not None and payload.get('iss') != issuer:
+            raise DecodeError("Invalid issuer")
+
+        if replay_store is not None:
+            jti = payload.get('jti')
+            if not jti:
+                raise DecodeError("Token has no jti")
+            exp = payload.get('exp')
+            if isinstance(exp, (int, long, float)):
+                exp += leeway
+            else:
+                exp = None
+            if not replay_store.check_and_add(jti, exp):
+                raise ReplayedToken("Token has already been used")
     return payload
+
+
+def decode_many(jwts, key='', **kwargs):
+    """Decode a batch of tokens signed with the same key.
+
+    Return the payloads in order, raising on the first invalid token.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return [decode(jwt, key, **kwargs) for jwt in jwts]
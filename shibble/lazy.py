@@ -0,0 +1,36 @@
+"""Modules imported on first use rather than when shibble is loaded.
+
+    ldap = lazy.LazyModule('ldap')
+
+`ldap` only imports python-ldap when one of its attributes is first
+looked up, so workers that never talk to the directory don't pay for it.
+"""
+import importlib
+import threading
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            with self.__dict__['_lock']:
+                module = self.__dict__['_module']
+                if module is None:
+                    module = importlib.import_module(self.__dict__['_name'])
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] else 'not loaded'
+        return '<lazy module %r, %s>' % (self.__dict__['_name'], state)
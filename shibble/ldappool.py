@@ -0,0 +1,150 @@
+"""A thread-safe pool of bound LDAP connections."""
+import collections
+import logging
+import threading
+import time
+
+from shibble import lazy
+
+ldap = lazy.LazyModule('ldap')
+
+LOG = logging.getLogger('shibble.ldappool')
+
+
+class ConnectionPool(object):
+    """Hand out bound LDAP connections, reusing them between calls.
+
+    `connect` is called to open and bind a new connection. At most
+    `max_size` connections are checked out at once, further callers block
+    until one is returned. Connections idle for more than `check_after`
+    seconds are pinged before being handed out and replaced if the server
+    has dropped them, `run` also retries an operation once when a more
+    recently used one turns out to be dropped. Connections idle for more
+    than `idle_timeout` seconds are closed.
+    """
+
+    def __init__(self, connect, max_size=10, idle_timeout=300,
+                 check_after=10):
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        # (connection, last used), most recently used on the right
+        self._idle = collections.deque()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.size,
+                    'idle': len(self._idle),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'reconnects': self.reconnects}
+
+    def _close(self, conn):
+        with self._lock:
+            self.size -= 1
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _evict_idle(self, now):
+        expired = []
+        with self._lock:
+            while self._idle and now - self._idle[0][1] > self.idle_timeout:
+                expired.append(self._idle.popleft()[0])
+        for conn in expired:
+            self._close(conn)
+
+    def _alive(self, conn):
+        try:
+            conn.whoami_s()
+            return True
+        except ldap.LDAPError:
+            return False
+
+    def _checkout_idle(self):
+        now = time.time()
+        self._evict_idle(now)
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, last_used = self._idle.pop()
+            if now - last_used <= self.check_after or self._alive(conn):
+                with self._lock:
+                    self.hits += 1
+                return conn
+            LOG.info('Replacing dropped LDAP connection')
+            with self._lock:
+                self.reconnects += 1
+            self._close(conn)
+
+    def _get(self, reuse=True):
+        self._slots.acquire()
+        try:
+            conn = self._checkout_idle() if reuse else None
+            if conn is not None:
+                return conn, True
+            conn = self.connect()
+            with self._lock:
+                self.misses += 1
+                self.size += 1
+            return conn, False
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _put(self, conn, discard=False):
+        """Return a connection, closing it instead if `discard` is set."""
+        try:
+            if discard:
+                self._close(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.time()))
+        finally:
+            self._slots.release()
+
+    def run(self, operation):
+        """Return `operation(conn)`, run on a pooled connection.
+
+        Blocks while the pool is exhausted. If the server had dropped a
+        reused connection, the operation is retried once on a new one. On
+        any other error the connection is discarded, as it may still have
+        results pending.
+        """
+        reuse = True
+        while True:
+            conn, reused = self._get(reuse)
+            try:
+                result = operation(conn)
+            except ldap.SERVER_DOWN:
+                self._put(conn, discard=True)
+                if not reused:
+                    raise
+                LOG.info('Retrying on a new LDAP connection, the server '
+                         'dropped an idle one')
+                with self._lock:
+                    self.reconnects += 1
+                reuse = False
+            except Exception:
+                self._put(conn, discard=True)
+                raise
+            else:
+                self._put(conn)
+                return result
+
+    def close(self):
+        """Close all the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for conn, last_used in idle:
+            self._close(conn)
@@ -0,0 +1,267 @@
+"""Counters and latency histograms, rendered in the Prometheus text format.
+
+Each thread updates its own shard of a metric without taking a lock, the
+shards are only summed when `/metrics` is scraped. Shards of threads
+that have exited are folded into a shared one at that point, so thread
+churn doesn't grow memory.
+
+    with metrics.stage('ldap_add'):
+        l.add_s(dn, ldif)
+
+    @metrics.stage('create_home_dir')
+    def create_home_dir(username):
+        ...
+"""
+import bisect
+import functools
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# seconds, from a cached lookup up to a slow D-Bus call
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+
+def collector(function):
+    """Register a function returning extra samples at scrape time.
+
+    It returns `(name, help, type, samples)` tuples, `samples` being a
+    list of `(labels, value)` pairs with `labels` a dict.
+    """
+    with _registry_lock:
+        _collectors.append(function)
+    return function
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._shards_lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def _merge(self, total, value):
+        raise NotImplementedError
+
+    def collect(self):
+        """Return the values of every thread, summed per label value."""
+        with self._shards_lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    # a dead thread can't write to its shard any more
+                    self._fold(self._retired, shard)
+            self._shards = live
+            totals = {}
+            self._fold(totals, self._retired)
+            for thread, shard in live:
+                self._fold(totals, shard)
+        return totals
+
+    def _fold(self, totals, shard):
+        for label_value, value in shard.items():
+            if label_value not in totals:
+                totals[label_value] = self._new_value()
+            totals[label_value] = self._merge(totals[label_value], value)
+
+    def _labels(self, label_value, **extra):
+        labels = {}
+        if self.label is not None:
+            labels[self.label] = label_value
+        labels.update(extra)
+        return labels
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, label_value=None):
+        shard = self._shard()
+        shard[label_value] = shard.get(label_value, 0) + amount
+
+    def _new_value(self):
+        return 0
+
+    def _merge(self, total, value):
+        return total + value
+
+    def samples(self):
+        return [(self.name, self._labels(label_value), value)
+                for label_value, value in sorted(self.collect().items())]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, label)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, label_value=None):
+        shard = self._shard()
+        counts = shard.get(label_value)
+        if counts is None:
+            # one count per bucket, then +Inf, then the sum
+            counts = shard[label_value] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _new_value(self):
+        return [0] * (len(self.buckets) + 2)
+
+    def _merge(self, total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self):
+        samples = []
+        for label_value, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                self._labels(label_value, le=str(bound)),
+                                cumulative))
+            samples.append((self.name + '_sum', self._labels(label_value),
+                            counts[-1]))
+            samples.append((self.name + '_count', self._labels(label_value),
+                            cumulative))
+        return samples
+
+
+STAGE_SECONDS = Histogram('shibble_stage_seconds',
+                          'Time spent in each stage of a request or signup.',
+                          label='stage')
+STAGE_ERRORS = Counter('shibble_stage_errors_total',
+                       'Stages that raised an exception.', label='stage')
+
+
+class stage(object):
+    """Time a block, or every call of a function, as `name`.
+
+    Exceptions other than those in `ignore` are counted as errors.
+    """
+
+    def __init__(self, name, ignore=()):
+        self.name = name
+        self.ignore = ignore
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        STAGE_SECONDS.observe(time.time() - self.start, self.name)
+        if exc_type is not None and not issubclass(exc_type, self.ignore):
+            STAGE_ERRORS.inc(label_value=self.name)
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(self.name, self.ignore):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+def instrument_engine(engine):
+    """Time the queries run on `engine`."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        start = conn.info['metrics_query_start'].pop()
+        STAGE_SECONDS.observe(time.time() - start, 'db_query')
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        starts = context.connection.info.get('metrics_query_start')
+        if starts:
+            start = starts.pop()
+            STAGE_SECONDS.observe(time.time() - start, 'db_query')
+        STAGE_ERRORS.inc(label_value='db_query')
+
+
+# commits of every session, including the flush they start with
+@event.listens_for(Session, 'before_commit')
+def _commit_started(db):
+    db.info['metrics_commit_start'] = time.time()
+
+
+@event.listens_for(Session, 'after_commit')
+def _commit_finished(db):
+    start = db.info.pop('metrics_commit_start', None)
+    if start is not None:
+        STAGE_SECONDS.observe(time.time() - start, 'db_commit')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _commit_failed(db):
+    start = db.info.pop('metrics_commit_start', None)
+    if start is not None:
+        STAGE_SECONDS.observe(time.time() - start, 'db_commit')
+        STAGE_ERRORS.inc(label_value='db_commit')
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (key, _escape(labels[key]))
+                                  for key in sorted(labels))
+    return '%s %s' % (name, repr(float(value)))
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_metrics)
+        collectors = list(_collectors)
+    families = [(metric.name, metric.help, metric.type, metric.samples())
+                for metric in metrics]
+    for function in collectors:
+        for name, help, type, samples in function():
+            families.append((name, help, type,
+                             [(name, labels, value)
+                              for labels, value in samples]))
+    lines = []
+    for name, help, type, samples in families:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, type))
+        for sample in samples:
+            lines.append(_format_sample(*sample))
+    return '\n'.join(lines) + '\n'
@@ -1,7 +1,10 @@
 import logging
+from datetime import datetime
 
 from sqlalchemy import Column, Integer, String, PickleType, DateTime, Enum
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
 
 from shibble import cfg
 
@@ -17,9 +20,11 @@ class User(Base):
     displayname = Column(String(250))
     email = Column(String(250))
     password = Column(String(32))
-    state = Column(Enum("new", "registered", "created"))
+    # error once the account couldn't be created after every attempt
+    state = Column(Enum("new", "registered", "created", "error"))
     terms = Column(DateTime())
     shibboleth_attributes = Column(PickleType)
+    attributes_digest = Column(String(40))
 
     def __init__(self, user_id):
         self.user_id = user_id
@@ -29,6 +34,66 @@ class User(Base):
         return "<Shibboleth User '%d', '%s')>" % (self.id, self.displayname)
 
 
+class ProvisioningJob(Base):
+    __tablename__ = 'provisioning_job'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String(64), index=True)
+    state = Column(Enum("pending", "running", "done", "failed"))
+    attempts = Column(Integer)
+    created = Column(DateTime())
+    updated = Column(DateTime())
+    error = Column(String(250))
+    # a failed job isn't claimed again before then
+    retry_at = Column(DateTime())
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.state = "pending"
+        self.attempts = 0
+        self.created = self.updated = datetime.now()
+
+    def __repr__(self):
+        return "<Provisioning Job '%d', '%s', '%s')>" % (
+            self.id, self.user_id, self.state)
+
+
+class UsedToken(Base):
+    __tablename__ = 'used_token'
+    jti = Column(String(255), primary_key=True)
+    exp = Column(Integer, index=True)
+
+    def __init__(self, jti, exp):
+        self.jti = jti
+        self.exp = exp
+
+    def __repr__(self):
+        return "<Used Token '%s', '%d')>" % (self.jti, self.exp)
+
+
+def on_commit(db, callback, *args):
+    """Call `callback(*args)` once the session's transaction commits.
+
+    The helpers below only flush, the request (or worker) commits once
+    when it is done. Side effects outside the database, like caches and
+    notifications, are deferred with this so a rollback discards them.
+    """
+    db.info.setdefault('on_commit', []).append((callback, args))
+
+
+@event.listens_for(Session, 'after_commit')
+def _run_commit_callbacks(db):
+    for callback, args in db.info.pop('on_commit', []):
+        try:
+            callback(*args)
+        except Exception:
+            LOG.exception('Commit callback %r failed', callback)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_commit_callbacks(db):
+    db.info.pop('on_commit', None)
+
+
 def create_shibboleth_user(db, shib_attrs):
     """Create a new user from the Shibboleth attributes
 
@@ -39,7 +104,7 @@ def create_shibboleth_user(db, shib_attrs):
     # add shibboleth user
     shibuser = User(shib_attrs["id"])
     db.add(shibuser)
-    db.commit()
+    db.flush()
     return shibuser
 
 
@@ -50,11 +115,11 @@ def update_shibboleth_user(db, shib_user, shib_attrs):
     shib_user.displayname = shib_attrs["fullname"]
     shib_user.email = shib_attrs["mail"]
     shib_user.shibboleth_attributes = shib_attrs
-    db.commit()
+    db.flush()
 
 
 def update_user_state(db, shib_attrs, state):
     shib_user = db.query(User).filter_by(
         user_id=shib_attrs["id"]).first()
     shib_user.state = state
-    db.commit()
+    db.flush()
@@ -0,0 +1,59 @@
+"""In-process notification of user state changes."""
+import contextlib
+import threading
+
+
+class Waiter(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.state = None
+
+    def wait(self, timeout):
+        """Wait for a state change, return False if `timeout` passed."""
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+
+class StateNotifier(object):
+    """Wake up requests waiting for a user's state to change.
+
+    Only changes made in this process are seen, waiters should fall back
+    to reading the database once their timeout passes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+
+    @contextlib.contextmanager
+    def subscribe(self, user_id):
+        """Register a waiter for `user_id` for the length of a `with`
+        block. Subscribe before reading the current state so that changes
+        made in between aren't missed.
+        """
+        waiter = Waiter()
+        with self._lock:
+            self._waiters.setdefault(user_id, []).append(waiter)
+        try:
+            yield waiter
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(user_id, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    self._waiters.pop(user_id, None)
+
+    def notify(self, user_id, state):
+        with self._lock:
+            waiters = self._waiters.pop(user_id, [])
+        for waiter in waiters:
+            waiter.state = state
+            waiter.event.set()
+
+    def waiting(self):
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+
+USER_STATES = StateNotifier()
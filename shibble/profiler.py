@@ -0,0 +1,190 @@
+"""Opt-in WSGI middleware writing profiles of some requests to a directory.
+
+A request is profiled when it is picked at random, with probability
+`rate`, or when it turns out to be slower than `slower_than` seconds. In
+the second case every request has to be watched, use the `sampler` mode
+for that: a background thread snapshots the stacks of the watched
+requests every `interval` seconds, which costs little. The `cprofile`
+mode records every call, so is best kept to a low `rate`. Either way a
+request is profiled until the server closes its body, so streamed
+responses are profiled as a whole.
+
+Profiles are named after the route and the time of the request, cProfile
+ones (`.prof`) open with pstats or snakeviz and sampled ones (`.folded`)
+are collapsed stacks for flamegraph.pl or speedscope. No more than
+`max_profiles` are written by each process.
+"""
+import cProfile
+import collections
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+LOG = logging.getLogger('shibble.profiler')
+
+MODES = ('cprofile', 'sampler')
+
+
+class StackSampler(object):
+    """Count the stacks of the registered threads every `interval`."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='shibble-stack-sampler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def start(self):
+        """Start sampling the calling thread."""
+        stacks = collections.Counter()
+        with self._lock:
+            self._active[threading.current_thread().ident] = stacks
+            self._ensure_started()
+        self._wake.set()
+        return stacks
+
+    def stop(self, ident=None):
+        """Stop sampling a thread, by default the calling one, and return
+        its stack counts."""
+        if ident is None:
+            ident = threading.current_thread().ident
+        with self._lock:
+            stacks = self._active.pop(ident)
+            if not self._active:
+                self._wake.clear()
+        return stacks
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                active = list(self._active.items())
+            for ident, stacks in active:
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[self._stack(frame)] += 1
+
+    @staticmethod
+    def _stack(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+
+class ProfiledBody(object):
+    """A response body calling `finish` once the server closes it."""
+
+    def __init__(self, body, finish):
+        self.body = body
+        self._finish = finish
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            finish, self._finish = self._finish, None
+            if finish is not None:
+                finish()
+
+
+class ProfilerMiddleware(object):
+    def __init__(self, app, directory, rate=0.0, slower_than=None,
+                 mode='cprofile', interval=0.005, max_profiles=1000):
+        if mode not in MODES:
+            raise ValueError("Unknown profile mode '%s', use one of %s" %
+                             (mode, ', '.join(MODES)))
+        self.app = app
+        self.directory = directory
+        self.rate = rate
+        self.slower_than = slower_than
+        self.mode = mode
+        self.max_profiles = max_profiles
+        self.sampler = StackSampler(interval)
+        self._written = 0
+        self._written_lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __call__(self, environ, start_response):
+        sampled = self.rate and random.random() < self.rate
+        if not sampled and self.slower_than is None:
+            return self.app(environ, start_response)
+
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+        else:
+            profile = self.sampler.start()
+        ident = threading.current_thread().ident
+        start = time.time()
+
+        def finish():
+            elapsed = time.time() - start
+            if self.mode == 'cprofile':
+                profile.disable()
+            else:
+                self.sampler.stop(ident)
+            if sampled or elapsed >= self.slower_than:
+                self._save(profile, environ, elapsed)
+
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            finish()
+            raise
+        return ProfiledBody(body, finish)
+
+    def _label(self, environ):
+        route = environ.get('bottle.route')
+        path = route.rule if route is not None else environ.get('PATH_INFO')
+        return re.sub(r'[^A-Za-z0-9]+', '_', path or '').strip('_') or 'root'
+
+    def _save(self, profile, environ, elapsed):
+        with self._written_lock:
+            if self._written >= self.max_profiles:
+                return
+            self._written += 1
+            number = self._written
+        # e.g. account_status_wait-20160203T040506-1234-7-31ms
+        name = '%s-%s-%d-%d-%dms' % (
+            self._label(environ),
+            time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid(),
+            number, elapsed * 1000)
+        try:
+            if self.mode == 'cprofile':
+                path = os.path.join(self.directory, name + '.prof')
+                profile.dump_stats(path)
+            else:
+                path = os.path.join(self.directory, name + '.folded')
+                with open(path, 'w') as f:
+                    for stack, count in sorted(profile.items()):
+                        f.write('%s %d\n' % (';'.join(stack), count))
+        except (IOError, OSError):
+            LOG.exception('Failed to write the profile of %s',
+                          environ.get('PATH_INFO'))
+            return
+        LOG.info('Wrote the profile of a %.0f ms request to %s',
+                 elapsed * 1000, path)
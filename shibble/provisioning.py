@@ -0,0 +1,186 @@
+"""Background provisioning of local accounts.
+
+Accepting the terms only records a job in the database. The LDAP, oddjob
+and NextCloud work is done by a pool of worker threads started from
+`make_app`, which move the user from `registered` to `created`.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import sessionmaker
+
+from shibble import utils
+from shibble.models import ProvisioningJob, User, on_commit
+
+LOG = logging.getLogger('shibble.provisioning')
+
+# woken whenever this process queues a job, other processes are picked
+# up by the poll interval
+_jobs_ready = threading.Condition()
+
+
+def notify_workers():
+    with _jobs_ready:
+        _jobs_ready.notify()
+
+
+def enqueue(db, shib_attrs):
+    """Queue the creation of the local account for a registered user.
+
+    The workers are woken once `db` commits. Return the new job.
+    """
+    job = ProvisioningJob(shib_attrs["id"])
+    db.add(job)
+    db.flush()
+    on_commit(db, notify_workers)
+    return job
+
+
+class WorkerPool(object):
+    """A pool of threads draining the provisioning job table.
+
+    Jobs are claimed with a conditional update so that several processes
+    can share the same table. A job left `running` for longer than
+    `job_timeout` seconds (e.g. the worker process died) is claimed again.
+    A failed job is retried after `retry_delay` seconds, doubled after
+    each attempt. After `max_attempts` the job fails and the user is moved
+    to the `error` state.
+    """
+
+    def __init__(self, engine, workers=2, poll_interval=5, job_timeout=300,
+                 max_attempts=5, retry_delay=30):
+        self.sessionmaker = sessionmaker(bind=engine)
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name='shibble-provisioning-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopping.set()
+        with _jobs_ready:
+            _jobs_ready.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                worked = self.run_once()
+            except Exception:
+                LOG.exception('Provisioning worker failed')
+                worked = False
+            if not worked and not self._stopping.is_set():
+                with _jobs_ready:
+                    _jobs_ready.wait(self.poll_interval)
+
+    def run_once(self):
+        """Claim and process a single job.
+
+        Return False if there was nothing to do.
+        """
+        db = self.sessionmaker()
+        try:
+            self._fail_abandoned(db)
+            job = self._claim(db)
+            if job is None:
+                return False
+            self._process(db, job)
+            return True
+        finally:
+            db.close()
+
+    def _stale(self):
+        stale = datetime.now() - timedelta(seconds=self.job_timeout)
+        return and_(ProvisioningJob.state == 'running',
+                    ProvisioningJob.updated < stale)
+
+    def _claimable(self):
+        return or_(and_(ProvisioningJob.state == 'pending',
+                        or_(ProvisioningJob.retry_at.is_(None),
+                            ProvisioningJob.retry_at <= datetime.now())),
+                   and_(self._stale(),
+                        ProvisioningJob.attempts < self.max_attempts))
+
+    def _claim(self, db):
+        candidates = db.query(ProvisioningJob.id).filter(
+            self._claimable()).order_by(ProvisioningJob.id).limit(5).all()
+        for job_id, in candidates:
+            claimed = db.query(ProvisioningJob).filter(
+                ProvisioningJob.id == job_id, self._claimable()).update(
+                    {'state': 'running',
+                     'updated': datetime.now(),
+                     'attempts': ProvisioningJob.attempts + 1},
+                    synchronize_session=False)
+            db.commit()
+            if claimed:
+                return db.query(ProvisioningJob).get(job_id)
+        return None
+
+    def _fail_abandoned(self, db):
+        """Fail the jobs whose last attempt never finished."""
+        abandoned = and_(self._stale(),
+                         ProvisioningJob.attempts >= self.max_attempts)
+        jobs = db.query(ProvisioningJob.id, ProvisioningJob.user_id).filter(
+            abandoned).limit(5).all()
+        for job_id, user_id in jobs:
+            failed = db.query(ProvisioningJob).filter(
+                ProvisioningJob.id == job_id, abandoned).update(
+                    {'state': 'failed',
+                     'updated': datetime.now(),
+                     'error': 'Timed out'},
+                    synchronize_session=False)
+            if failed:
+                LOG.error('Giving up on the local account for %s, its last '
+                          'attempt timed out', user_id)
+                self._user_failed(db, user_id)
+            db.commit()
+
+    def _user_failed(self, db, user_id):
+        shib_user = db.query(User).filter_by(user_id=user_id).first()
+        if shib_user and shib_user.state == 'registered':
+            utils.update_user_state(db, {'id': user_id}, 'error')
+
+    def _process(self, db, job):
+        shib_user = db.query(User).filter_by(user_id=job.user_id).first()
+        if not shib_user or shib_user.state != 'registered':
+            LOG.warning('Dropping provisioning job for %s, user is not '
+                        'waiting for an account', job.user_id)
+            job.state = 'done'
+        else:
+            try:
+                utils.create_user(db, shib_user.shibboleth_attributes,
+                                  shib_user.password)
+            except Exception as e:
+                db.rollback()
+                job.error = str(e)[:250]
+                if job.attempts < self.max_attempts:
+                    delay = self.retry_delay * 2 ** (job.attempts - 1)
+                    LOG.exception('Failed to create the local account for '
+                                  '%s, retrying in %ds', job.user_id, delay)
+                    job.state = 'pending'
+                    job.retry_at = datetime.now() + timedelta(seconds=delay)
+                else:
+                    LOG.exception('Failed to create the local account for '
+                                  '%s, giving up after %d attempts',
+                                  job.user_id, job.attempts)
+                    job.state = 'failed'
+                    self._user_failed(db, job.user_id)
+            else:
+                job.state = 'done'
+                job.error = None
+        job.updated = datetime.now()
+        db.commit()
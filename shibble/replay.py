@@ -0,0 +1,129 @@
+"""Stores of JWT ids already seen, to reject replayed tokens.
+
+Pass a store to `jwt.decode(..., replay_store=store)`. The in-process
+store only protects a single process, use `SQLReplayStore` when several
+workers accept the same tokens.
+"""
+import heapq
+import threading
+import time
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from shibble import jwt
+from shibble.models import UsedToken
+
+
+class UnrecordableToken(jwt.DecodeError):
+    """A token whose id can't be recorded, so can't be accepted once."""
+
+
+class ReplayStore(object):
+    """Interface of a replay store."""
+
+    def check_and_add(self, jti, exp=None):
+        """Record `jti` until the `exp` timestamp.
+
+        Return False if it was already recorded and hasn't expired, raise
+        UnrecordableToken if it can't be recorded.
+        """
+        raise NotImplementedError
+
+
+class MemoryReplayStore(ReplayStore):
+    """Ids kept in a dict, so lookups are O(1), and a heap by expiry.
+
+    Every expired id is dropped as new ones are added. Tokens without an
+    `exp` are remembered for `default_ttl` seconds. No more than `maxsize`
+    unexpired ids are kept. When full, new tokens are rejected, and
+    counted in `overflows`, rather than forgetting an id that could then
+    be replayed. Size the store so that this doesn't happen.
+    """
+
+    def __init__(self, maxsize=100000, default_ttl=3600):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._seen = {}
+        # (exp, jti), with stale entries for ids recorded again once they
+        # had expired
+        self._expiries = []
+        self._lock = threading.Lock()
+        self.replays = 0
+        self.overflows = 0
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _evict_expired(self, now):
+        seen = self._seen
+        expiries = self._expiries
+        while expiries and expiries[0][0] <= now:
+            exp, jti = heapq.heappop(expiries)
+            if seen.get(jti) == exp:
+                del seen[jti]
+
+    def check_and_add(self, jti, exp=None):
+        now = time.time()
+        if exp is None:
+            exp = now + self.default_ttl
+        with self._lock:
+            self._evict_expired(now)
+            seen_exp = self._seen.get(jti)
+            if seen_exp is not None and seen_exp > now:
+                self.replays += 1
+                return False
+            if seen_exp is None and len(self._seen) >= self.maxsize:
+                self.overflows += 1
+                raise UnrecordableToken("Too many tokens to remember")
+            self._seen[jti] = exp
+            heapq.heappush(self._expiries, (exp, jti))
+            return True
+
+
+class SQLReplayStore(ReplayStore):
+    """Ids kept in the `used_token` table, shared by every worker.
+
+    The primary key on the id makes the check atomic across processes.
+    Expired rows are deleted every `cleanup_every` insertions. Ids that
+    don't fit the column are rejected.
+    """
+
+    max_jti_length = UsedToken.__table__.c.jti.type.length
+
+    def __init__(self, engine, default_ttl=3600, cleanup_every=1000):
+        self.sessionmaker = sessionmaker(bind=engine)
+        self.default_ttl = default_ttl
+        self.cleanup_every = cleanup_every
+        self._inserts = 0
+        self._inserts_lock = threading.Lock()
+
+    def check_and_add(self, jti, exp=None):
+        if not isinstance(jti, basestring) or \
+                len(jti) > self.max_jti_length:
+            raise UnrecordableToken("Token jti isn't a string of at most "
+                                    "%d characters" % self.max_jti_length)
+        now = int(time.time())
+        if exp is None:
+            exp = now + self.default_ttl
+        with self._inserts_lock:
+            self._inserts += 1
+            cleanup = self._inserts % self.cleanup_every == 0
+        db = self.sessionmaker()
+        try:
+            if cleanup:
+                db.query(UsedToken).filter(UsedToken.exp <= now).delete()
+            db.add(UsedToken(jti, exp))
+            try:
+                db.commit()
+                return True
+            except IntegrityError:
+                db.rollback()
+            # only an expired id may be used again
+            reused = db.query(UsedToken).filter(
+                UsedToken.jti == jti, UsedToken.exp <= now).update(
+                    {'exp': exp}, synchronize_session=False)
+            db.commit()
+            return bool(reused)
+        finally:
+            db.close()
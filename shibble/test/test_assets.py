@@ -0,0 +1,133 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from bottle import HTTPError
+
+from shibble import assets
+
+CSS = 'body { background-color: #5fbae0; }\n' * 50
+
+
+class TestAssets(unittest.TestCase):
+    def setUp(self):
+        self.static_dir = tempfile.mkdtemp()
+        self.build_dir = path.join(self.static_dir, 'build')
+        with open(path.join(self.static_dir, 'base.css'), 'w') as f:
+            f.write(CSS)
+        with open(path.join(self.static_dir, 'throbber.gif'), 'wb') as f:
+            f.write('GIF89a' + os.urandom(64))
+
+    def tearDown(self):
+        shutil.rmtree(self.static_dir)
+
+    def index(self):
+        return assets.AssetIndex(self.static_dir, self.build_dir)
+
+    def test_build(self):
+        manifest = assets.build(self.static_dir, self.build_dir)
+
+        css = manifest['base.css']
+        self.assertRegexpMatches(css, r'^base\.[0-9a-f]{12}\.css$')
+        files = os.listdir(self.build_dir)
+        self.assertIn(css + '.gz', files)
+        # images are already compressed
+        self.assertIn(manifest['throbber.gif'], files)
+        self.assertNotIn(manifest['throbber.gif'] + '.gz', files)
+        with gzip.open(path.join(self.build_dir, css + '.gz')) as f:
+            self.assertEqual(f.read(), CSS)
+
+    def test_build_is_stable(self):
+        first = assets.build(self.static_dir, self.build_dir)
+        with open(path.join(self.static_dir, 'base.css'), 'a') as f:
+            f.write('p {}\n')
+        second = assets.build(self.static_dir, self.build_dir)
+
+        self.assertEqual(first['throbber.gif'], second['throbber.gif'])
+        self.assertNotEqual(first['base.css'], second['base.css'])
+        self.assertNotIn(first['base.css'], os.listdir(self.build_dir))
+
+    def test_unbuilt(self):
+        index = self.index()
+        self.assertEqual(index.url('base.css'), 'base.css')
+
+        response = index.response('base.css', {})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_header('Cache-Control'),
+                         'public, no-cache')
+        self.assertEqual(response.body.read(), CSS)
+        response.body.close()
+
+    def test_fingerprinted(self):
+        assets.build(self.static_dir, self.build_dir)
+        index = self.index()
+        name = index.url('base.css')
+
+        response = index.response(name, {'HTTP_ACCEPT_ENCODING': 'gzip'})
+
+        self.assertEqual(response.get_header('Cache-Control'),
+                         'public, max-age=31536000, immutable')
+        self.assertEqual(response.get_header('Content-Encoding'), 'gzip')
+        self.assertEqual(response.get_header('Vary'), 'Accept-Encoding')
+        self.assertEqual(response.get_header('Content-Type'),
+                         'text/css; charset=UTF-8')
+        self.assertEqual(int(response.get_header('Content-Length')),
+                         path.getsize(path.join(self.build_dir,
+                                                name + '.gz')))
+        response.body.close()
+
+    def test_identity(self):
+        assets.build(self.static_dir, self.build_dir)
+        index = self.index()
+        name = index.url('base.css')
+
+        for accept_encoding in (None, 'gzip;q=0', 'deflate'):
+            response = index.response(
+                name, {'HTTP_ACCEPT_ENCODING': accept_encoding})
+            self.assertEqual(response.get_header('Content-Encoding'), None)
+            self.assertEqual(response.get_header('Content-Length'),
+                             str(len(CSS)))
+            response.body.close()
+
+    def test_not_modified(self):
+        assets.build(self.static_dir, self.build_dir)
+        index = self.index()
+        name = index.url('base.css')
+        response = index.response(name, {'HTTP_ACCEPT_ENCODING': 'gzip'})
+        response.body.close()
+
+        response = index.response(
+            name, {'HTTP_ACCEPT_ENCODING': 'gzip',
+                   'HTTP_IF_NONE_MATCH': response.get_header('ETag')})
+
+        self.assertEqual(response.status_code, 304)
+        # the identity ETag doesn't match the gzip variant
+        etag = index.response(name, {}).get_header('ETag')
+        response = index.response(
+            name, {'HTTP_ACCEPT_ENCODING': 'gzip', 'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(response.status_code, 200)
+        response.body.close()
+
+    def test_head(self):
+        response = self.index().response('base.css',
+                                         {'REQUEST_METHOD': 'HEAD'})
+        self.assertEqual(response.body, '')
+        self.assertEqual(response.get_header('Content-Length'),
+                         str(len(CSS)))
+
+    def test_not_found(self):
+        index = self.index()
+        for name in ('missing.css', '../base.css', 'build'):
+            response = index.response(name, {})
+            self.assertTrue(isinstance(response, HTTPError))
+            self.assertEqual(response.status_code, 404)
+
+    def test_accepted_encodings(self):
+        self.assertEqual(
+            assets.accepted_encodings('gzip, deflate;q=0.5, br;q=x, *;q=0'),
+            {'gzip': 1.0, 'deflate': 0.5, '*': 0.0})
+        self.assertEqual(assets.accepted_encodings(None), {})
@@ -0,0 +1,82 @@
+import unittest
+
+from shibble import attrmap
+from shibble.attrmap import AttributeMap
+
+
+class TestAttributeMap(unittest.TestCase):
+    def setUp(self):
+        self.maps = dict(attrmap._maps)
+        self.attr_map = AttributeMap(
+            {'persistent-id': 'id',
+             'mail': 'mail',
+             'affiliation': 'affiliation'},
+            normalisers={'mail': ['lower'],
+                         'affiliation': ['split']})
+
+    def tearDown(self):
+        attrmap._maps.clear()
+        attrmap._maps.update(self.maps)
+
+    def test_parse(self):
+        environ = {"persistent-id": "1234",
+                   "mail": "Test@example.com",
+                   "affiliation": "staff;member",
+                   "other": "ignored"}
+        self.assertEqual(self.attr_map.parse(environ),
+                         {'id': '1234',
+                          'mail': 'test@example.com',
+                          'affiliation': 'member;staff'})
+
+    def test_split(self):
+        attr_map = AttributeMap(
+            {'affiliation': 'affiliation'},
+            normalisers={'affiliation': ['lower', 'split']})
+        self.assertEqual(
+            attr_map.parse({'affiliation': 'Staff; member;;staff'}),
+            {'affiliation': 'member;staff'})
+
+    def test_utf8(self):
+        attr_map = AttributeMap(
+            {'displayname': 'fullname', 'mail': 'mail'},
+            normalisers={'displayname': ['utf8'],
+                         'mail': ['utf8', 'lower']})
+        self.assertEqual(
+            attr_map.parse({'displayname': u'Jos\xe9 Garc\xeda',
+                            'mail': u'Jos\xe9@example.com'}),
+            {'fullname': 'Jos\xc3\xa9 Garc\xc3\xada',
+             'mail': 'jos\xc3\xa9@example.com'})
+
+    def test_parse_empty(self):
+        self.assertEqual(self.attr_map.parse({"mail": ""}), {})
+
+    def test_get_attr(self):
+        self.assertEqual(self.attr_map.get_attr('id'), 'persistent-id')
+        self.assertIsNone(self.attr_map.get_attr('missing'))
+
+    def test_from_config(self):
+        attr_map = AttributeMap.from_config(
+            {'id': 'targeted-id',
+             'mail': 'email strip lower',
+             'debug': 'false'},
+            defaults={'debug': 'false'})
+        self.assertEqual(attr_map.parse({'targeted-id': 'abc',
+                                         'email': ' A@Example.com '}),
+                         {'id': 'abc', 'mail': 'a@example.com'})
+        self.assertIsNone(attr_map.get_attr('debug'))
+
+    def test_from_config_unknown_normaliser(self):
+        self.assertRaises(ValueError, AttributeMap.from_config,
+                          {'mail': 'mail upper'})
+
+    def test_load_config(self):
+        conf = {'DEFAULT': {},
+                'ldap': {'user_dn': 'ou=Users'},
+                'attribute_map:test': {'id': 'uid'}}
+        attrmap.load_config(conf)
+        self.assertEqual(attrmap.get('test').parse({'uid': 'x'}),
+                         {'id': 'x'})
+
+    def test_load_config_restored(self):
+        # test_load_config's map doesn't leak into the other tests
+        self.assertNotIn('test', attrmap._maps)
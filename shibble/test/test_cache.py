@@ -0,0 +1,44 @@
+import unittest
+
+from mock import patch
+
+from shibble.cache import TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = TTLCache(maxsize=2, ttl=10)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIn('a', self.cache)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_false_values(self):
+        self.cache.set('a', False)
+        self.assertIs(self.cache.get('a', 'missing'), False)
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=100)
+        with patch('shibble.cache.time.time', return_value=1e10):
+            self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+
+    def test_lru_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_invalidate(self):
+        self.cache.set('a', 1)
+        self.cache.invalidate('a')
+        self.assertIsNone(self.cache.get('a'))
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import exc
+
+from shibble import db
+
+
+class TestPoolSettings(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(db.pool_settings({}), {
+            'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 3600,
+            'pool_pre_ping': False, 'pool_timeout': 30})
+
+    def test_prefix(self):
+        settings = db.pool_settings({'read_db_pool_size': '20',
+                                     'read_db_pool_pre_ping': 'true',
+                                     'db_pool_size': '3'},
+                                    prefix='read_db_')
+        self.assertEqual(settings['pool_size'], 20)
+        self.assertEqual(settings['pool_pre_ping'], True)
+
+
+class TestCreateEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        uri = 'sqlite:///' + os.path.join(self.tmp_dir, 'shibble.sqlite3')
+        self.engine = db.create_engine(uri, name='test', pool_size=2,
+                                       max_overflow=0, pool_timeout=0.05)
+
+    def tearDown(self):
+        self.engine.dispose()
+        del db._engines['test']
+        shutil.rmtree(self.tmp_dir)
+
+    def gauges(self):
+        families = dict((name, samples) for name, help, type, samples
+                        in db.collect_metrics())
+        return dict((labels['state'], value) for labels, value
+                    in families['shibble_db_pool_connections']
+                    if labels['pool'] == 'test')
+
+    def test_warm_up(self):
+        self.assertEqual(db.warm_up(self.engine), 2)
+        self.assertEqual(self.engine.pool.checkedin(), 2)
+        self.assertEqual(self.gauges(),
+                         {'in_use': 0, 'idle': 2, 'overflow': 0})
+
+    def test_exhausted(self):
+        checkouts = sum(
+            db.POOL_CHECKOUT_SECONDS.collect().get('test', [0])[:-1])
+        exhausted = db.POOL_EXHAUSTED.collect().get('test', 0)
+        timeouts = db.POOL_TIMEOUTS.collect().get('test', 0)
+        held = [self.engine.connect(), self.engine.connect()]
+        self.assertEqual(self.gauges()['in_use'], 2)
+
+        self.assertRaises(exc.TimeoutError, self.engine.connect)
+
+        self.assertEqual(db.POOL_EXHAUSTED.collect()['test'], exhausted + 1)
+        self.assertEqual(db.POOL_TIMEOUTS.collect()['test'], timeouts + 1)
+        counts = db.POOL_CHECKOUT_SECONDS.collect()['test']
+        self.assertEqual(sum(counts[:-1]), checkouts + 3)
+        # the failed checkout waited for the whole timeout
+        self.assertTrue(counts[-1] >= 0.05)
+        for connection in held:
+            connection.close()
+
+    def test_dispose_keeps_instrumentation(self):
+        self.engine.dispose()
+        self.assertTrue(isinstance(self.engine.pool,
+                                   db.InstrumentedQueuePool))
+        self.assertEqual(self.engine.pool.logging_name, 'test')
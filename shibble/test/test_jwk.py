@@ -0,0 +1,146 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from shibble import jwk
+from shibble import jwt
+
+if jwk.default_backend is not None:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+
+def _int_to_b64(value):
+    data = ('%x' % value)
+    if len(data) % 2:
+        data = '0' + data
+    return jwt.base64url_encode(data.decode('hex'))
+
+
+@unittest.skipIf(jwk.default_backend is None, "cryptography not installed")
+class TestKeySet(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        backend = jwk.default_backend()
+        self.rsa_key = rsa.generate_private_key(65537, 2048, backend)
+        self.ec_key = ec.generate_private_key(ec.SECP256R1(), backend)
+        self.payload = {'sub': '1324'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_pem(self, kid, key):
+        data = key.private_bytes(serialization.Encoding.PEM,
+                                 serialization.PrivateFormat.PKCS8,
+                                 serialization.NoEncryption())
+        with open(os.path.join(self.tmp_dir, kid + '.pem'), 'w') as f:
+            f.write(data)
+
+    def write_jwks(self, directory, name, keys):
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump({'keys': keys}, f)
+
+    def rsa_jwk(self, kid):
+        numbers = self.rsa_key.public_key().public_numbers()
+        return {'kty': 'RSA', 'kid': kid,
+                'n': _int_to_b64(numbers.n), 'e': _int_to_b64(numbers.e)}
+
+    def ec_jwk(self, kid):
+        numbers = self.ec_key.public_key().public_numbers()
+        return {'kty': 'EC', 'crv': 'P-256', 'kid': kid,
+                'x': _int_to_b64(numbers.x), 'y': _int_to_b64(numbers.y)}
+
+    def test_pem_round_trip(self):
+        self.write_pem('rsa', self.rsa_key)
+        self.write_pem('ec', self.ec_key)
+        keys = jwk.KeySet(self.tmp_dir)
+        self.assertEqual(keys.kids(), ['ec', 'rsa'])
+        for kid, algorithm in (('rsa', 'RS256'), ('ec', 'ES256')):
+            token = jwt.encode(self.payload, keys[kid], algorithm)
+            self.assertEqual(jwt.header(token)['kid'], kid)
+            self.assertEqual(jwt.header(token)['alg'], algorithm)
+            self.assertEqual(jwt.decode(token, keys), self.payload)
+
+    def test_jwks_verify(self):
+        self.write_pem('signer-rsa', self.rsa_key)
+        self.write_pem('signer-ec', self.ec_key)
+        signers = jwk.KeySet(self.tmp_dir)
+        rsa_token = jwt.encode(self.payload, signers['signer-rsa'], 'RS256')
+        ec_token = jwt.encode(self.payload, signers['signer-ec'], 'ES256')
+
+        verify_dir = os.path.join(self.tmp_dir, 'public')
+        os.mkdir(verify_dir)
+        self.write_jwks(verify_dir, 'keys.json',
+                        [self.rsa_jwk('signer-rsa'), self.ec_jwk('signer-ec')])
+        keys = jwk.KeySet(verify_dir)
+        self.assertEqual(jwt.decode(rsa_token, keys), self.payload)
+        self.assertEqual(jwt.decode(ec_token, keys), self.payload)
+        self.assertRaises(jwk.JWKError, jwt.encode, self.payload,
+                          keys['signer-rsa'], 'RS256')
+
+    def test_bad_signature(self):
+        self.write_pem('rsa', self.rsa_key)
+        keys = jwk.KeySet(self.tmp_dir)
+        token = jwt.encode(self.payload, keys['rsa'], 'RS256')
+        forged = token[:-4] + ('AAAA' if token[-4:] != 'AAAA' else 'BBBB')
+        self.assertRaises(jwt.DecodeError, jwt.decode, forged, keys)
+
+    def test_unknown_kid(self):
+        self.write_pem('rsa', self.rsa_key)
+        keys = jwk.KeySet(self.tmp_dir)
+        token = jwt.encode(self.payload, keys['rsa'], 'RS256')
+        os.remove(os.path.join(self.tmp_dir, 'rsa.pem'))
+        self.write_pem('other', self.rsa_key)
+        keys.reload(force=True)
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, keys)
+
+    def test_algorithm_confusion(self):
+        self.write_pem('rsa', self.rsa_key)
+        keys = jwk.KeySet(self.tmp_dir)
+        # a HS256 token can't be verified with a key set
+        token = jwt.encode(self.payload, 'secret')
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, keys)
+        # and an RS256 token can't be verified with a shared secret
+        token = jwt.encode(self.payload, keys['rsa'], 'RS256')
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, 'secret')
+
+    def test_algorithm_of_key(self):
+        self.write_pem('rsa', self.rsa_key)
+        self.write_pem('ec', self.ec_key)
+        keys = jwk.KeySet(self.tmp_dir)
+        # the key picks its algorithm, any other is refused
+        token = jwt.encode(self.payload, keys['ec'])
+        self.assertEqual(jwt.header(token)['alg'], 'ES256')
+        for key, algorithm in ((keys['rsa'], 'HS256'), (keys['rsa'], 'ES256'),
+                               (keys['ec'], 'HS256')):
+            self.assertRaises(NotImplementedError, jwt.encode, self.payload,
+                              key, algorithm)
+            self.assertRaises(NotImplementedError, jwt.encode_many,
+                              [self.payload], key, algorithm)
+
+    def test_reload_keeps_parsed_keys(self):
+        self.write_pem('rsa', self.rsa_key)
+        keys = jwk.KeySet(self.tmp_dir, check_interval=0)
+        key = keys['rsa']
+        with patch.object(jwk.Key, 'from_pem') as mock_from_pem:
+            self.assertIs(keys['rsa'], key)
+            self.assertFalse(mock_from_pem.called)
+
+    def test_reload_on_change(self):
+        self.write_pem('rsa', self.rsa_key)
+        keys = jwk.KeySet(self.tmp_dir, check_interval=0)
+        self.assertEqual(keys.kids(), ['rsa'])
+        self.write_pem('ec', self.ec_key)
+        self.assertEqual(keys.kids(), ['ec', 'rsa'])
+
+    def test_broken_file_keeps_old_set(self):
+        self.write_pem('rsa', self.rsa_key)
+        keys = jwk.KeySet(self.tmp_dir, check_interval=0)
+        self.assertEqual(keys.kids(), ['rsa'])
+        with open(os.path.join(self.tmp_dir, 'broken.json'), 'w') as f:
+            f.write('{"keys": [')
+        self.assertEqual(keys.kids(), ['rsa'])
@@ -0,0 +1,134 @@
+import unittest
+from datetime import datetime, timedelta
+
+from shibble import jwt
+
+
+class TestJWT(unittest.TestCase):
+    def setUp(self):
+        self.payload = {'sub': '1324', 'aud': 'https://example.com'}
+        self.key = 'secret'
+
+    def test_round_trip(self):
+        for algorithm in ('HS256', 'HS384', 'HS512'):
+            token = jwt.encode(self.payload, self.key, algorithm)
+            self.assertEqual(jwt.decode(token, self.key), self.payload)
+            self.assertEqual(jwt.header(token)['alg'], algorithm)
+
+    def test_unicode_key(self):
+        token = jwt.encode(self.payload, u'secret')
+        self.assertEqual(jwt.decode(token, 'secret'), self.payload)
+
+    def test_bad_signature(self):
+        token = jwt.encode(self.payload, self.key)
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, 'other')
+        self.assertEqual(jwt.decode(token, 'other', verify=False),
+                         self.payload)
+
+    def test_expired(self):
+        self.payload['exp'] = datetime.utcnow() - timedelta(seconds=60)
+        token = jwt.encode(self.payload, self.key)
+        self.assertRaises(jwt.ExpiredSignature, jwt.decode, token,
+                          self.key)
+        jwt.decode(token, self.key, leeway=120)
+
+    def test_unsupported_algorithm(self):
+        self.assertRaises(NotImplementedError, jwt.encode, self.payload,
+                          self.key, 'none')
+        token = jwt.encode(self.payload, self.key)
+        header, rest = token.split('.', 1)
+        token = jwt.base64url_encode('{"alg": "none"}') + '.' + rest
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, self.key)
+
+    def test_not_enough_segments(self):
+        self.assertRaises(jwt.DecodeError, jwt.decode, 'abc', self.key)
+
+    def test_prepared_key_reused(self):
+        prepared = jwt.prepare_key(self.key, 'HS256')
+        self.assertIs(jwt.prepare_key(u'secret', 'HS256'), prepared)
+        self.assertIsNot(jwt.prepare_key(self.key, 'HS512'), prepared)
+
+    def test_decode_many(self):
+        tokens = [jwt.encode({'n': i}, self.key) for i in range(3)]
+        self.assertEqual(jwt.decode_many(tokens, self.key),
+                         [{'n': 0}, {'n': 1}, {'n': 2}])
+        tokens.append(jwt.encode({'n': 3}, 'other'))
+        self.assertRaises(jwt.DecodeError, jwt.decode_many, tokens,
+                          self.key)
+
+    def test_constant_time_compare(self):
+        self.assertTrue(jwt.constant_time_compare('abc', 'abc'))
+        self.assertFalse(jwt.constant_time_compare('abc', 'abd'))
+        self.assertFalse(jwt.constant_time_compare('abc', 'ab'))
+
+    def test_max_size(self):
+        self.payload['padding'] = 'x' * 100
+        token = jwt.encode(self.payload, self.key)
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, self.key,
+                          max_size=100)
+        self.assertEqual(jwt.decode(token, self.key, max_size=0),
+                         self.payload)
+
+    def test_forged_payload_not_parsed(self):
+        token = jwt.encode(self.payload, self.key)
+        header, payload, signature = token.split('.')
+        token = '.'.join([header, jwt.base64url_encode('not json'),
+                          signature])
+        with self.assertRaises(jwt.DecodeError) as cm:
+            jwt.decode(token, self.key)
+        self.assertEqual(str(cm.exception), "Signature verification failed")
+
+    def test_header_cached(self):
+        token = jwt.encode(self.payload, self.key)
+        header = jwt.header(token)
+        header['alg'] = 'none'
+        self.assertEqual(jwt.header(token)['alg'], 'HS256')
+        self.assertEqual(jwt.decode(token, self.key), self.payload)
+
+    def test_invalid_header(self):
+        self.assertRaises(jwt.DecodeError, jwt.decode,
+                          jwt.base64url_encode('[1]') + '.e30.', self.key)
+
+    def test_encode_keeps_payload(self):
+        exp = datetime.utcnow() + timedelta(seconds=60)
+        self.payload['exp'] = exp
+        token = jwt.encode(self.payload, self.key)
+        self.assertEqual(self.payload['exp'], exp)
+        self.assertIsInstance(jwt.decode(token, self.key)['exp'], int)
+
+    def test_encode_compact(self):
+        token = jwt.encode({'a': 1, 'b': [1, 2]}, self.key)
+        header, payload, signature = token.split('.')
+        self.assertEqual(jwt.base64url_decode(payload), '{"a":1,"b":[1,2]}')
+        self.assertNotIn(' ', jwt.base64url_decode(header))
+
+    def test_encode_many(self):
+        payloads = [{'n': i} for i in range(3)]
+        tokens = jwt.encode_many(payloads, self.key)
+        self.assertEqual(tokens,
+                         [jwt.encode(payload, self.key)
+                          for payload in payloads])
+        self.assertEqual(jwt.decode_many(tokens, self.key), payloads)
+
+    def test_not_before(self):
+        self.payload['nbf'] = datetime.utcnow() + timedelta(seconds=60)
+        token = jwt.encode(self.payload, self.key)
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, self.key)
+        jwt.decode(token, self.key, leeway=120)
+
+    def test_audience(self):
+        token = jwt.encode(self.payload, self.key)
+        jwt.decode(token, self.key, audience='https://example.com')
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, self.key,
+                          audience='https://other.example.com')
+        self.payload['aud'] = ['https://other.example.com',
+                               'https://example.com']
+        token = jwt.encode(self.payload, self.key)
+        jwt.decode(token, self.key, audience='https://example.com')
+
+    def test_issuer(self):
+        self.payload['iss'] = 'https://rapid.aaf.edu.au'
+        token = jwt.encode(self.payload, self.key)
+        jwt.decode(token, self.key, issuer='https://rapid.aaf.edu.au')
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, self.key,
+                          issuer='https://rapid.test.aaf.edu.au')
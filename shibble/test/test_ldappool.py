@@ -0,0 +1,86 @@
+import unittest
+
+import ldap
+from mock import Mock, patch
+
+from shibble.ldappool import ConnectionPool
+
+
+def checkout(conn):
+    return conn
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.connect = Mock(side_effect=lambda: Mock())
+        self.pool = ConnectionPool(self.connect, max_size=2)
+
+    def test_reuse(self):
+        conn = self.pool.run(checkout)
+        conn2 = self.pool.run(checkout)
+        self.assertIs(conn, conn2)
+        self.assertEqual(self.connect.call_count, 1)
+        stats = self.pool.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['idle'], 1)
+
+    def test_concurrent_checkouts(self):
+        conn, conn2 = self.pool.run(
+            lambda conn: (conn, self.pool.run(checkout)))
+        self.assertIsNot(conn, conn2)
+        self.assertEqual(self.pool.stats()['size'], 2)
+
+    def test_liveness_check(self):
+        self.pool.check_after = 0
+        self.pool.idle_timeout = 1e11
+        conn = self.pool.run(checkout)
+        conn.whoami_s.side_effect = ldap.SERVER_DOWN()
+        with patch('shibble.ldappool.time.time', return_value=1e10):
+            conn2 = self.pool.run(checkout)
+        self.assertIsNot(conn, conn2)
+        self.assertEqual(self.pool.stats()['reconnects'], 1)
+
+    def test_idle_eviction(self):
+        conn = self.pool.run(checkout)
+        self.pool.idle_timeout = 0
+        with patch('shibble.ldappool.time.time', return_value=1e10):
+            conn2 = self.pool.run(checkout)
+        self.assertIsNot(conn, conn2)
+        conn.unbind_s.assert_called_once_with()
+        self.assertEqual(self.pool.stats()['size'], 1)
+
+    def test_retries_dropped(self):
+        dropped = self.pool.run(checkout)
+        dropped.search_s.side_effect = ldap.SERVER_DOWN()
+
+        result = self.pool.run(lambda conn: conn.search_s('dn'))
+
+        self.assertEqual(self.connect.call_count, 2)
+        dropped.unbind_s.assert_called_once_with()
+        self.assertEqual(self.pool.stats()['reconnects'], 1)
+        conn = self.pool.run(checkout)
+        self.assertIs(result, conn.search_s.return_value)
+
+    def test_server_down(self):
+        # a new connection failing means the server is down, not retried
+        operation = Mock(side_effect=ldap.SERVER_DOWN())
+        self.assertRaises(ldap.SERVER_DOWN, self.pool.run, operation)
+        self.assertEqual(operation.call_count, 1)
+        operation.call_args[0][0].unbind_s.assert_called_once_with()
+
+        self.pool.run(checkout)
+        self.assertRaises(ldap.SERVER_DOWN, self.pool.run, operation)
+        self.assertEqual(operation.call_count, 3)
+        self.assertEqual(self.pool.stats()['size'], 0)
+
+    def test_error_discards(self):
+        # the connection may have results pending
+        operation = Mock(side_effect=ldap.LDAPError())
+        self.assertRaises(ldap.LDAPError, self.pool.run, operation)
+        self.assertEqual(operation.call_count, 1)
+        operation.call_args[0][0].unbind_s.assert_called_once_with()
+        stats = self.pool.stats()
+        self.assertEqual(stats['size'], 0)
+        self.assertEqual(stats['idle'], 0)
@@ -0,0 +1,106 @@
+import threading
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from shibble import metrics
+from shibble.models import Base, User
+
+
+def stage_count(stage):
+    counts = metrics.STAGE_SECONDS.collect().get(stage)
+    return sum(counts[:-1]) if counts else 0
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.counter = metrics.Counter('test_total', 'A test counter.',
+                                       label='kind')
+        self.histogram = metrics.Histogram('test_seconds', 'A test.',
+                                           buckets=(0.1, 1))
+
+    def tearDown(self):
+        metrics._metrics.remove(self.counter)
+        metrics._metrics.remove(self.histogram)
+
+    def test_counter(self):
+        self.counter.inc(label_value='a')
+        self.counter.inc(2, label_value='a')
+        self.counter.inc(label_value='b')
+        self.assertEqual(self.counter.collect(), {'a': 3, 'b': 1})
+
+    def test_histogram(self):
+        for value in (0.05, 0.1, 0.5, 3):
+            self.histogram.observe(value)
+        self.assertEqual(self.histogram.samples(), [
+            ('test_seconds_bucket', {'le': '0.1'}, 2),
+            ('test_seconds_bucket', {'le': '1'}, 3),
+            ('test_seconds_bucket', {'le': '+Inf'}, 4),
+            ('test_seconds_sum', {}, 3.65),
+            ('test_seconds_count', {}, 4)])
+
+    def test_threads(self):
+        def work():
+            for i in range(100):
+                self.counter.inc(label_value='a')
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.counter.inc(label_value='a')
+
+        self.assertEqual(self.counter.collect(), {'a': 401})
+        # the shards of the exited threads have been folded together
+        self.assertEqual(len(self.counter._shards), 1)
+        self.assertEqual(self.counter.collect(), {'a': 401})
+
+    def test_stage(self):
+        @metrics.stage('test_stage', ignore=(KeyError,))
+        def fail(exception):
+            raise exception
+
+        before = metrics.STAGE_ERRORS.collect().get('test_stage', 0)
+        self.assertRaises(ValueError, fail, ValueError)
+        self.assertRaises(KeyError, fail, KeyError)
+
+        self.assertEqual(metrics.STAGE_ERRORS.collect()['test_stage'],
+                         before + 1)
+        self.assertEqual(stage_count('test_stage'), 2)
+
+    def test_render(self):
+        self.counter.inc(label_value='a"b')
+        text = metrics.render()
+        self.assertIn('# TYPE test_total counter\n'
+                      'test_total{kind="a\\"b"} 1.0\n', text)
+        self.assertIn('# TYPE test_seconds histogram\n', text)
+        self.assertIn('# TYPE shibble_stage_seconds histogram\n', text)
+
+    def test_collector(self):
+        def collect():
+            return [('test_gauge', 'A gauge.', 'gauge',
+                     [({'pool': 'ldap'}, 3)])]
+        metrics.collector(collect)
+        try:
+            self.assertIn('# TYPE test_gauge gauge\n'
+                          'test_gauge{pool="ldap"} 3.0\n', metrics.render())
+        finally:
+            metrics._collectors.remove(collect)
+
+
+class TestInstrumentEngine(unittest.TestCase):
+    def test_queries_and_commits(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        metrics.instrument_engine(engine)
+        db = sessionmaker(bind=engine)()
+        queries = stage_count('db_query')
+        commits = stage_count('db_commit')
+
+        db.add(User('1324'))
+        db.commit()
+        db.query(User).all()
+
+        self.assertEqual(stage_count('db_commit'), commits + 1)
+        self.assertTrue(stage_count('db_query') >= queries + 2)
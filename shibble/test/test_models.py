@@ -3,9 +3,10 @@ from datetime import datetime
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from mock import Mock
 
 from shibble.models import (Base, User, create_shibboleth_user,
-                            update_shibboleth_user)
+                            on_commit, update_shibboleth_user)
 
 
 class TestModels(unittest.TestCase):
@@ -52,5 +53,21 @@ class TestModels(unittest.TestCase):
         self.assertEqual(dbuser.email, self.shib_attrs["mail"])
         self.assertEqual(dbuser.shibboleth_attributes, self.shib_attrs)
 
+    def test_on_commit(self):
+        callback = Mock()
+        on_commit(self.db, callback, 'a', 'b')
+        self.assertFalse(callback.called)
+        self.db.commit()
+        callback.assert_called_once_with('a', 'b')
+        self.db.commit()
+        callback.assert_called_once_with('a', 'b')
+
+    def test_on_commit_rollback(self):
+        callback = Mock()
+        on_commit(self.db, callback)
+        self.db.rollback()
+        self.db.commit()
+        self.assertFalse(callback.called)
+
     def test_keystone_authenticate(self):
         pass
@@ -0,0 +1,36 @@
+import threading
+import unittest
+
+from shibble.notify import StateNotifier
+
+
+class TestStateNotifier(unittest.TestCase):
+    def setUp(self):
+        self.notifier = StateNotifier()
+
+    def test_timeout(self):
+        with self.notifier.subscribe('1324') as waiter:
+            self.assertFalse(waiter.wait(0.01))
+        self.assertEqual(self.notifier.waiting(), 0)
+
+    def test_notify(self):
+        with self.notifier.subscribe('1324') as waiter:
+            self.assertEqual(self.notifier.waiting(), 1)
+            thread = threading.Thread(target=self.notifier.notify,
+                                      args=('1324', 'created'))
+            thread.start()
+            self.assertTrue(waiter.wait(5))
+            thread.join()
+        self.assertEqual(waiter.state, 'created')
+        self.assertEqual(self.notifier.waiting(), 0)
+
+    def test_notify_before_wait(self):
+        with self.notifier.subscribe('1324') as waiter:
+            self.notifier.notify('1324', 'created')
+            self.assertTrue(waiter.wait(0))
+        self.assertEqual(waiter.state, 'created')
+
+    def test_other_user(self):
+        with self.notifier.subscribe('1324') as waiter:
+            self.notifier.notify('4321', 'created')
+            self.assertFalse(waiter.wait(0.01))
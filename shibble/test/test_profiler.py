@@ -0,0 +1,127 @@
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+
+from mock import MagicMock, Mock
+
+from shibble.profiler import ProfilerMiddleware
+
+
+def slow_app(environ, start_response):
+    time.sleep(environ.get('sleep', 0))
+    start_response('200 OK', [])
+    return ['ok']
+
+
+def streaming_app(environ, start_response):
+    start_response('200 OK', [])
+    yield 'waiting'
+    while environ['pending']:
+        time.sleep(0.01)
+        environ['pending'] -= 1
+    yield 'done'
+
+
+class TestProfilerMiddleware(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def request(self, app, **environ):
+        environ.setdefault('PATH_INFO', '/account_status/wait')
+        # as a WSGI server would
+        body = app(environ, Mock())
+        try:
+            return list(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def test_disabled(self):
+        app = ProfilerMiddleware(slow_app, self.directory)
+        self.assertEqual(self.request(app), ['ok'])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_rate(self):
+        app = ProfilerMiddleware(slow_app, self.directory, rate=1)
+
+        self.assertEqual(self.request(app), ['ok'])
+
+        name, = os.listdir(self.directory)
+        self.assertTrue(name.startswith('account_status_wait-'))
+        self.assertTrue(name.endswith('.prof'))
+        stats = pstats.Stats(os.path.join(self.directory, name))
+        self.assertTrue(any(func[2] == 'slow_app' for func in stats.stats))
+
+    def test_route_label(self):
+        app = ProfilerMiddleware(slow_app, self.directory, rate=1)
+        self.request(app, PATH_INFO='/static/x.css',
+                     **{'bottle.route': Mock(rule='/static/:filepath')})
+        name, = os.listdir(self.directory)
+        self.assertTrue(name.startswith('static_filepath-'))
+
+    def test_slower_than(self):
+        app = ProfilerMiddleware(slow_app, self.directory, slower_than=0.05,
+                                 mode='sampler', interval=0.001)
+
+        self.request(app)
+        self.assertEqual(os.listdir(self.directory), [])
+
+        self.request(app, sleep=0.1)
+        name, = os.listdir(self.directory)
+        self.assertTrue(name.endswith('.folded'))
+        with open(os.path.join(self.directory, name)) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(any('slow_app' in line for line in lines))
+        # each line is a stack and the number of samples taken in it
+        self.assertTrue(sum(int(line.rsplit(' ', 1)[1])
+                            for line in lines) > 10)
+
+    def test_streamed_body(self):
+        app = ProfilerMiddleware(streaming_app, self.directory,
+                                 slower_than=0.05)
+
+        body = app({'PATH_INFO': '/account_status/wait', 'pending': 10},
+                   Mock())
+        self.assertEqual(list(body), ['waiting', 'done'])
+        # nothing is written before the server is done with the body
+        self.assertEqual(os.listdir(self.directory), [])
+        body.close()
+
+        name, = os.listdir(self.directory)
+        stats = pstats.Stats(os.path.join(self.directory, name))
+        self.assertTrue(any(func[2] == 'streaming_app'
+                            for func in stats.stats))
+
+    def test_close_body(self):
+        body = MagicMock()
+        app = ProfilerMiddleware(lambda environ, start_response: body,
+                                 self.directory, rate=1)
+        self.request(app)
+        body.close.assert_called_once_with()
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_error(self):
+        def failing_app(environ, start_response):
+            raise ValueError()
+        app = ProfilerMiddleware(failing_app, self.directory, rate=1,
+                                 mode='sampler')
+        self.assertRaises(ValueError, self.request, app)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(app.sampler._active, {})
+
+    def test_max_profiles(self):
+        app = ProfilerMiddleware(slow_app, self.directory, rate=1,
+                                 max_profiles=2)
+        for i in range(3):
+            self.request(app)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, ProfilerMiddleware, slow_app,
+                          self.directory, mode='perf')
@@ -0,0 +1,197 @@
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from mock import patch
+
+from shibble import provisioning
+from shibble import utils
+from shibble.models import Base, ProvisioningJob, User
+
+
+class TestProvisioning(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.db = sessionmaker(bind=self.engine)()
+        self.shib_attrs = {
+            'mail': 'test@example.com',
+            'fullname': 'john smith',
+            'id': '1324'
+        }
+        self.pool = provisioning.WorkerPool(self.engine, workers=0)
+        utils.USER_STATE_CACHE.clear()
+
+    def make_shib_user(self, state='registered'):
+        shibuser = User(self.shib_attrs['id'])
+        shibuser.state = state
+        shibuser.password = 'secret'
+        shibuser.shibboleth_attributes = self.shib_attrs
+        self.db.add(shibuser)
+        self.db.commit()
+        return shibuser
+
+    def test_enqueue(self):
+        provisioning.enqueue(self.db, self.shib_attrs)
+        self.db.commit()
+        job, = self.db.query(ProvisioningJob).all()
+        self.assertEqual(job.user_id, '1324')
+        self.assertEqual(job.state, 'pending')
+
+    def test_run_once_empty(self):
+        self.assertFalse(self.pool.run_once())
+
+    @patch("shibble.provisioning.utils.create_user")
+    def test_run_once(self, mock_create_user):
+        self.make_shib_user()
+        provisioning.enqueue(self.db, self.shib_attrs)
+        self.db.commit()
+
+        self.assertTrue(self.pool.run_once())
+
+        mock_create_user.assert_called_once()
+        self.assertEqual(mock_create_user.call_args[0][1:],
+                         (self.shib_attrs, 'secret'))
+        self.db.expire_all()
+        job, = self.db.query(ProvisioningJob).all()
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.attempts, 1)
+        self.assertFalse(self.pool.run_once())
+
+    def job(self):
+        self.db.expire_all()
+        job, = self.db.query(ProvisioningJob).all()
+        return job
+
+    def retry_now(self):
+        job = self.job()
+        job.retry_at = datetime.now()
+        self.db.commit()
+
+    @patch("shibble.provisioning.utils.create_user")
+    def test_run_once_failure(self, mock_create_user):
+        mock_create_user.side_effect = Exception('ldap is down')
+        self.make_shib_user()
+        provisioning.enqueue(self.db, self.shib_attrs)
+        self.db.commit()
+
+        self.assertTrue(self.pool.run_once())
+
+        job = self.job()
+        self.assertEqual(job.state, 'pending')
+        self.assertEqual(job.error, 'ldap is down')
+        self.assertTrue(job.retry_at > datetime.now())
+        # not retried before the delay
+        self.assertFalse(self.pool.run_once())
+
+        mock_create_user.side_effect = None
+        self.retry_now()
+        self.assertTrue(self.pool.run_once())
+        job = self.job()
+        self.assertEqual((job.state, job.attempts), ('done', 2))
+
+    @patch("shibble.provisioning.utils.create_user")
+    def test_backoff(self, mock_create_user):
+        mock_create_user.side_effect = Exception('ldap is down')
+        self.make_shib_user()
+        provisioning.enqueue(self.db, self.shib_attrs)
+        self.db.commit()
+        delays = []
+        for attempt in range(2):
+            self.retry_now()
+            start = datetime.now()
+            self.pool.run_once()
+            delays.append((self.job().retry_at - start).total_seconds())
+        self.assertTrue(29 < delays[0] <= 31)
+        self.assertTrue(59 < delays[1] <= 61)
+
+    @patch("shibble.provisioning.utils.create_user")
+    def test_gives_up(self, mock_create_user):
+        mock_create_user.side_effect = Exception('ldap is down')
+        self.make_shib_user()
+        provisioning.enqueue(self.db, self.shib_attrs)
+        self.db.commit()
+
+        for attempt in range(5):
+            self.retry_now()
+            self.assertTrue(self.pool.run_once())
+
+        job = self.job()
+        self.assertEqual((job.state, job.attempts), ('failed', 5))
+        self.assertEqual(self.db.query(User).one().state, 'error')
+        self.assertEqual(utils.get_user_state(self.db, '1324')[0], 'error')
+        self.assertFalse(self.pool.run_once())
+
+    def test_stale_running(self):
+        self.make_shib_user()
+        provisioning.enqueue(self.db, self.shib_attrs)
+        self.db.commit()
+        job = self.job()
+        job.state = 'running'
+        job.updated = datetime.now() - timedelta(seconds=600)
+        job.attempts = 4
+        self.db.commit()
+
+        with patch("shibble.provisioning.utils.create_user"):
+            self.assertTrue(self.pool.run_once())
+        self.assertEqual(self.job().state, 'done')
+
+    def test_stale_running_gives_up(self):
+        self.make_shib_user()
+        provisioning.enqueue(self.db, self.shib_attrs)
+        self.db.commit()
+        job = self.job()
+        job.state = 'running'
+        job.updated = datetime.now() - timedelta(seconds=600)
+        job.attempts = 5
+        self.db.commit()
+
+        self.assertFalse(self.pool.run_once())
+
+        job = self.job()
+        self.assertEqual((job.state, job.error), ('failed', 'Timed out'))
+        self.assertEqual(self.db.query(User).one().state, 'error')
+
+    @patch("shibble.utils.create_nextcloud_mount")
+    @patch("shibble.utils.create_home_dir")
+    @patch("shibble.utils.get_user_exists_cache")
+    @patch("shibble.utils.get_next_uid", return_value=2000)
+    @patch("shibble.utils.ldap_call")
+    @patch("shibble.utils.lookup_user")
+    @patch("shibble.utils.CONF")
+    def test_retry_after_ldap_add(self, mock_conf, mock_lookup_user,
+                                  mock_ldap_call, mock_next_uid,
+                                  mock_exists_cache, mock_home_dir,
+                                  mock_nextcloud):
+        # the LDAP add succeeds, then D-Bus fails once
+        mock_lookup_user.side_effect = [False, True]
+        mock_home_dir.side_effect = [Exception('oddjob is down'), True]
+        self.make_shib_user()
+        provisioning.enqueue(self.db, self.shib_attrs)
+        self.db.commit()
+
+        self.assertTrue(self.pool.run_once())
+        self.assertEqual(self.job().state, 'pending')
+        self.retry_now()
+        self.assertTrue(self.pool.run_once())
+
+        job = self.job()
+        self.assertEqual((job.state, job.attempts), ('done', 2))
+        self.assertEqual(self.db.query(User).one().state, 'created')
+        self.assertEqual(mock_ldap_call.call_count, 1)
+        self.assertEqual(mock_home_dir.call_count, 2)
+        mock_nextcloud.assert_called_once_with('1324', 'secret')
+
+    @patch("shibble.provisioning.utils.create_user")
+    def test_run_once_already_created(self, mock_create_user):
+        self.make_shib_user(state='created')
+        provisioning.enqueue(self.db, self.shib_attrs)
+        self.db.commit()
+
+        self.assertTrue(self.pool.run_once())
+
+        self.assertFalse(mock_create_user.called)
+        self.db.expire_all()
+        job, = self.db.query(ProvisioningJob).all()
+        self.assertEqual(job.state, 'done')
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from mock import patch
+from sqlalchemy import create_engine
+
+from shibble import jwt
+from shibble.models import Base
+from shibble.replay import (MemoryReplayStore, SQLReplayStore,
+                            UnrecordableToken)
+
+
+class TestMemoryReplayStore(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryReplayStore(maxsize=3)
+
+    def test_replay(self):
+        exp = time.time() + 60
+        self.assertTrue(self.store.check_and_add('a', exp))
+        self.assertFalse(self.store.check_and_add('a', exp))
+        self.assertTrue(self.store.check_and_add('b', exp))
+        self.assertEqual(self.store.replays, 1)
+
+    def test_expiry(self):
+        self.store.check_and_add('a', time.time() + 60)
+        self.store.check_and_add('b', time.time() + 120)
+        with patch('shibble.replay.time.time',
+                   return_value=time.time() + 90):
+            self.assertTrue(self.store.check_and_add('c'))
+            self.assertEqual(len(self.store), 2)
+            self.assertTrue(self.store.check_and_add('a'))
+            self.assertFalse(self.store.check_and_add('b'))
+
+    def test_long_lived_id(self):
+        # an id outliving the ones recorded after it doesn't keep them
+        self.store.check_and_add('a', time.time() + 600)
+        self.store.check_and_add('b', time.time() + 60)
+        self.store.check_and_add('c', time.time() + 60)
+        with patch('shibble.replay.time.time',
+                   return_value=time.time() + 90):
+            self.assertTrue(self.store.check_and_add('d'))
+            self.assertEqual(len(self.store), 2)
+            self.assertFalse(self.store.check_and_add('a'))
+
+    def test_full(self):
+        exp = time.time() + 60
+        for jti in 'abc':
+            self.store.check_and_add(jti, exp)
+
+        self.assertRaises(UnrecordableToken, self.store.check_and_add, 'd',
+                          exp)
+
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store.overflows, 1)
+        # no id was forgotten to make room
+        self.assertFalse(self.store.check_and_add('a', exp))
+        with patch('shibble.replay.time.time',
+                   return_value=time.time() + 90):
+            self.assertTrue(self.store.check_and_add('d'))
+
+
+class TestSQLReplayStore(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.store = SQLReplayStore(engine, cleanup_every=2)
+
+    def test_replay(self):
+        exp = int(time.time()) + 60
+        self.assertTrue(self.store.check_and_add('a', exp))
+        self.assertFalse(self.store.check_and_add('a', exp))
+        self.assertTrue(self.store.check_and_add('b', exp))
+
+    def test_expired_reuse(self):
+        self.assertTrue(self.store.check_and_add('a', 1))
+        self.assertTrue(self.store.check_and_add('a'))
+        self.assertFalse(self.store.check_and_add('a'))
+
+    def test_oversized_jti(self):
+        for jti in ('x' * 256, 1234):
+            self.assertRaises(UnrecordableToken, self.store.check_and_add,
+                              jti)
+        self.assertTrue(self.store.check_and_add('x' * 255))
+
+    def test_threads(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        engine = create_engine('sqlite:///' + os.path.join(tmp_dir, 'db'))
+        Base.metadata.create_all(engine)
+        self.store = SQLReplayStore(engine)
+
+        def add(i):
+            for j in range(10):
+                self.store.check_and_add('%d-%d' % (i, j))
+        threads = [threading.Thread(target=add, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.store._inserts, 40)
+
+
+class TestDecodeReplay(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryReplayStore()
+        self.payload = {
+            'jti': 'abc',
+            'exp': datetime.utcnow() + timedelta(seconds=60)}
+
+    def test_replayed(self):
+        token = jwt.encode(self.payload, 'secret')
+        jwt.decode(token, 'secret', replay_store=self.store)
+        self.assertRaises(jwt.ReplayedToken, jwt.decode, token, 'secret',
+                          replay_store=self.store)
+        # without a store the token is still accepted
+        jwt.decode(token, 'secret')
+
+    def test_missing_jti(self):
+        del self.payload['jti']
+        token = jwt.encode(self.payload, 'secret')
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, 'secret',
+                          replay_store=self.store)
+
+    def test_unrecordable(self):
+        token = jwt.encode(self.payload, 'secret')
+        store = MemoryReplayStore(maxsize=0)
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, 'secret',
+                          replay_store=store)
+
+    def test_forged_not_recorded(self):
+        token = jwt.encode(self.payload, 'other')
+        self.assertRaises(jwt.DecodeError, jwt.decode, token, 'secret',
+                          replay_store=self.store)
+        self.assertEqual(len(self.store), 0)
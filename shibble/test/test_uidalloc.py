@@ -0,0 +1,70 @@
+import unittest
+
+from mock import Mock, patch
+
+from shibble.uidalloc import UIDAllocator
+
+
+class TestUIDAllocator(unittest.TestCase):
+    def setUp(self):
+        self.uids = [1000, 2000, 2001, 2003, 2006]
+        self.new_uids = []
+        self.search = Mock(side_effect=self.fake_search)
+        self.allocator = UIDAllocator(self.search)
+
+    def fake_search(self, since):
+        if since is None:
+            return list(self.uids)
+        return list(self.new_uids)
+
+    def test_fill_gaps(self):
+        allocated = [self.allocator.allocate() for i in range(4)]
+        self.assertEqual(allocated, [2002, 2004, 2005, 2007])
+        self.assertEqual(self.allocator.high_water_mark, 2008)
+
+    def test_empty_directory(self):
+        self.uids = []
+        self.assertEqual(self.allocator.allocate(), 2000)
+        self.assertEqual(self.allocator.allocate(), 2001)
+
+    def test_seed_once(self):
+        self.allocator.allocate()
+        self.allocator.allocate()
+        self.assertEqual(self.search.call_count, 2)
+        self.assertIsNone(self.search.call_args_list[0][0][0])
+        self.assertIsNotNone(self.search.call_args_list[1][0][0])
+
+    def test_incremental_refresh(self):
+        self.assertEqual(self.allocator.allocate(), 2002)
+        # another worker took a gap and moved the high-water mark
+        self.new_uids = [2004, 2010]
+        allocated = [self.allocator.allocate() for i in range(6)]
+        self.assertEqual(allocated, [2005, 2007, 2008, 2009, 2011, 2012])
+
+    def test_release(self):
+        uid = self.allocator.allocate()
+        self.allocator.release(uid)
+        self.assertEqual(self.allocator.allocate(), uid)
+
+    def test_full_refresh(self):
+        self.allocator.full_refresh = 60
+        self.assertEqual(self.allocator.allocate(), 2002)
+        self.uids = [2000, 2003]
+        with patch('shibble.uidalloc.time.time', return_value=1e10):
+            self.assertEqual(self.allocator.allocate(), 2001)
+
+    def test_outlier(self):
+        self.uids = [2000, 2002, 4294967294]
+        self.assertEqual(self.allocator.allocate(), 2001)
+        self.assertEqual(self.allocator._free, [(2003, 4294967294)])
+        self.new_uids = [2004]
+        allocated = [self.allocator.allocate() for i in range(2)]
+        self.assertEqual(allocated, [2003, 2005])
+        self.assertEqual(self.allocator.high_water_mark, 4294967295)
+
+    def test_release_twice(self):
+        uid = self.allocator.allocate()
+        self.allocator.release(uid)
+        self.allocator.release(uid)
+        allocated = [self.allocator.allocate() for i in range(2)]
+        self.assertEqual(allocated, [uid, 2004])
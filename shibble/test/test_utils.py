@@ -0,0 +1,70 @@
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from shibble import utils
+from shibble.attrmap import AttributeMap
+from shibble.models import Base, User
+
+
+class TestUpdateDBUser(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.db = sessionmaker(bind=engine)()
+        self.shib_attrs = {
+            'mail': 'test@example.com',
+            'fullname': 'john smith',
+            'id': '1324'
+        }
+        self.shibuser = User('1324')
+        self.db.add(self.shibuser)
+        self.db.commit()
+
+    def test_update(self):
+        self.assertTrue(utils.update_db_user(self.db, self.shibuser,
+                                             self.shib_attrs))
+        dbuser, = self.db.query(User).all()
+        self.assertEqual(dbuser.displayname, 'john smith')
+        self.assertEqual(dbuser.email, 'test@example.com')
+        self.assertEqual(dbuser.shibboleth_attributes, self.shib_attrs)
+
+    def test_unchanged(self):
+        utils.update_db_user(self.db, self.shibuser, self.shib_attrs)
+        skipped = utils.ATTRIBUTE_UPDATES['skipped']
+
+        self.assertFalse(utils.update_db_user(self.db, self.shibuser,
+                                              dict(self.shib_attrs)))
+        self.assertEqual(utils.ATTRIBUTE_UPDATES['skipped'], skipped + 1)
+
+    def test_split_attribute(self):
+        attr_map = AttributeMap(
+            {'persistent-id': 'id', 'mail': 'mail', 'displayName': 'fullname',
+             'affiliation': 'affiliation'},
+            normalisers={'affiliation': ['split']})
+        environ = {'persistent-id': '1324', 'mail': 'test@example.com',
+                   'displayName': 'john smith',
+                   'affiliation': 'staff;member'}
+        shib_attrs = attr_map.parse(environ)
+
+        self.assertTrue(utils.update_db_user(self.db, self.shibuser,
+                                             shib_attrs))
+        self.db.commit()
+        self.db.expire_all()
+        dbuser, = self.db.query(User).all()
+        self.assertEqual(dbuser.shibboleth_attributes['affiliation'],
+                         'member;staff')
+        # the same values in another order are no change
+        environ['affiliation'] = 'member;staff'
+        self.assertFalse(utils.update_db_user(self.db, dbuser,
+                                              attr_map.parse(environ)))
+
+    def test_changed(self):
+        utils.update_db_user(self.db, self.shibuser, self.shib_attrs)
+        self.shib_attrs['fullname'] = 'John Smith'
+
+        self.assertTrue(utils.update_db_user(self.db, self.shibuser,
+                                             self.shib_attrs))
+        dbuser, = self.db.query(User).all()
+        self.assertEqual(dbuser.displayname, 'John Smith')
@@ -1,14 +1,26 @@
+import json
+import os
 import unittest
+from os import path
 import shutil
 import tempfile
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from mock import patch, call, MagicMock, Mock
 
-from shibble.views import ShibbolethAttrMap, root
-from shibble.models import Base, User
+import bottle
+from bottle import BaseResponse, HTTPResponse
+
+from shibble import jwt
+from shibble import utils
+from shibble import views
+from shibble.replay import MemoryReplayStore
+from shibble.views import (ShibbolethAttrMap, root, account_status,
+                           account_status_wait, rapid_connect)
+from shibble.models import Base, ProvisioningJob, User
 
 
 class MockIdentityService(object):
@@ -163,21 +175,16 @@ class TestRoot(unittest.TestCase):
 
     @patch("shibble.views.request")
     @patch("shibble.views.template")
-    @patch("shibble.views.create_shibboleth_user")
-    @patch("shibble.views.update_shibboleth_user")
     @patch("shibble.views.CONFIG")
     def test_agreed_terms_user(self,
                                mock_config,
-                               mock_update_shibboleth_user,
-                               mock_create_shibboleth_user,
                                mock_template, mock_request):
         """
         Given a known user who has not registered
         And has just accepted the terms of service
         When the user visits the site
-        Then an ldap user will be created
-        And the user will be redirected to the portal with
-         a token encoded in the response.
+        Then the creation of their local account will be queued
+        And the user will be shown the account creation page.
         """
         session = MagicMock()
         mock_request.environ = {"beaker.session": session,
@@ -185,30 +192,19 @@ class TestRoot(unittest.TestCase):
                                 "displayName": "john smith",
                                 "persistent-id": "1324"}
         mock_request.forms = {'agree': True}
-
-        # mock user
-        user = self.make_shib_user(state='new')
-        mock_create_shibboleth_user.return_value = user
-
-        # mock token
-        token_string = '{"access": {"serviceCatalog": ' \
-            '[], "token": {"id": "aaaaaa"}}}'
-        token = Mock()
-        token.to_json.return_value = token_string
-        # mock_identity_service.return_value = MockIdentityService(token)
+        self.db.add(self.make_shib_user(state='new'))
+        self.db.commit()
 
         response = root(self.db)
+        self.db.commit()
 
-        # confirm that the ldap user was created
-        self.assertEqual(
-            mock_update_shibboleth_user.call_args[0][2],
-            {'mail': 'test@example.com',
-             'fullname': 'john smith', 'id': '1324'}
-        )
-
+        user = self.db.query(User).one()
         self.assertEqual(user.state, "registered")
+        self.assertTrue(user.terms)
+        self.assertTrue(user.password)
+        job, = self.db.query(ProvisioningJob).all()
+        self.assertEqual((job.user_id, job.state), ('1324', 'pending'))
 
-        # confirm that the redirect is passed correctly
         self.assertEqual(response,
                          mock_template.return_value)
         self.assertEqual(
@@ -252,6 +248,31 @@ class TestRoot(unittest.TestCase):
         self.assertEqual(response,
                          mock_template.return_value)
 
+    @patch("shibble.views.request")
+    @patch("shibble.views.template")
+    @patch("shibble.views.CONFIG", {'support_url': 'https://example.com'})
+    def test_error_user(self, mock_template, mock_request):
+        """
+        Given a user whose account couldn't be created
+        When the user visits the site
+        Then they are shown an error
+        """
+        mock_request.environ = {"beaker.session": MagicMock(),
+                                "mail": "test@example.com",
+                                "displayName": "john smith",
+                                "persistent-id": "1324"}
+        mock_request.forms = {}
+        db = self.db_sessionmaker()
+        db.add(self.make_shib_user(state='error'))
+        db.commit()
+
+        response = root(self.db)
+
+        self.assertEqual(response, mock_template.return_value)
+        self.assertEqual(mock_template.call_args[0], ('error',))
+        self.assertEqual(mock_template.call_args[1]['errors'],
+                         ['Local account creation failed'])
+
     @patch("shibble.views.request")
     @patch("shibble.views.template")
     @patch("shibble.views.create_shibboleth_user")
@@ -335,3 +356,455 @@ class TestRoot(unittest.TestCase):
                  tenant_id=tenant_id,
                  token=token,
                  target=mock_request.query['return-path']))
+
+
+class TestAccountStatusWait(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.db = sessionmaker(bind=engine)()
+        shibuser = User("1324")
+        shibuser.state = 'registered'
+        self.db.add(shibuser)
+        self.db.commit()
+        utils.USER_STATE_CACHE.clear()
+
+    @patch("shibble.views.request")
+    @patch("shibble.views.CONFIG")
+    def test_changed(self, mock_config, mock_request):
+        mock_request.environ = {"beaker.session": {'user_id': '1324'}}
+        mock_request.query = {'state': 'new'}
+
+        response = account_status_wait(self.db)
+
+        self.assertEqual(json.loads(response), {'state': 'registered'})
+
+    @patch("shibble.views.notify.USER_STATES")
+    @patch("shibble.views.request")
+    @patch("shibble.views.CONFIG")
+    def test_notified(self, mock_config, mock_request, mock_notifier):
+        mock_request.environ = {"beaker.session": {'user_id': '1324'}}
+        mock_request.query = {'state': 'registered'}
+        mock_notifier.waiting.return_value = 0
+        waiter = mock_notifier.subscribe.return_value.__enter__.return_value
+        waiter.wait.return_value = True
+        waiter.state = 'created'
+
+        response = account_status_wait(self.db)
+
+        self.assertEqual(json.loads(response), {'state': 'created'})
+
+    @patch("shibble.views.request")
+    @patch("shibble.views.CONFIG", {'account_status_timeout': '0.05'})
+    def test_changed_elsewhere(self, mock_request):
+        mock_request.environ = {"beaker.session": {'user_id': '1324'}}
+        mock_request.query = {'state': 'registered'}
+        utils.get_user_state(self.db, '1324')
+        # another process, which neither updates this cache nor notifies
+        self.engine.execute(User.__table__.update().values(state='created'))
+
+        start = time.time()
+        response = account_status_wait(self.db)
+
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(json.loads(response), {'state': 'created'})
+
+    @patch("shibble.views.request")
+    @patch("shibble.views.CONFIG", {'account_status_timeout': '0.05'})
+    def test_timeout(self, mock_request):
+        mock_request.environ = {"beaker.session": {'user_id': '1324'}}
+        mock_request.query = {'state': 'registered'}
+
+        start = time.time()
+        response = account_status_wait(self.db)
+
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(json.loads(response), {'state': 'registered'})
+
+    @patch("shibble.views.request")
+    @patch("shibble.views.CONFIG", {'account_status_timeout': '5',
+                                    'account_status_max_waiters': '1'})
+    def test_max_waiters(self, mock_request):
+        mock_request.environ = {"beaker.session": {'user_id': '1324'}}
+        mock_request.query = {'state': 'registered'}
+
+        with views.notify.USER_STATES.subscribe('4321'):
+            start = time.time()
+            response = account_status_wait(self.db)
+
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(json.loads(response), {'state': 'registered'})
+
+
+class TestAccountStatus(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.db = sessionmaker(bind=engine)()
+        shibuser = User("1324")
+        shibuser.state = 'registered'
+        self.db.add(shibuser)
+        self.db.commit()
+        self.shibuser = shibuser
+        utils.USER_STATE_CACHE.clear()
+
+    @patch("shibble.views.request")
+    def test_cached(self, mock_request):
+        mock_request.environ = {"beaker.session": {'user_id': '1324'}}
+
+        self.assertEqual(json.loads(account_status(self.db)),
+                         {'state': 'registered'})
+        self.db.delete(self.shibuser)
+        self.db.commit()
+        self.assertEqual(json.loads(account_status(self.db)),
+                         {'state': 'registered'})
+
+    @patch("shibble.views.request")
+    def test_write_through(self, mock_request):
+        mock_request.environ = {"beaker.session": {'user_id': '1324'}}
+
+        account_status(self.db)
+        utils.update_user_state(self.db, {'id': '1324'}, 'created')
+        self.assertEqual(json.loads(account_status(self.db)),
+                         {'state': 'registered'})
+        self.db.commit()
+
+        self.assertEqual(json.loads(account_status(self.db)),
+                         {'state': 'created'})
+
+
+class TestRapidConnect(unittest.TestCase):
+    def setUp(self):
+        self.config = {'rapid_connect_secret': 'secret',
+                       'rapid_connect_audience': 'https://example.com',
+                       'support_url': 'https://support.example.com'}
+        self.claims = {
+            'iss': 'https://rapid.aaf.edu.au',
+            'aud': 'https://example.com',
+            'jti': 'abcdef',
+            'nbf': datetime.utcnow() - timedelta(seconds=10),
+            'exp': datetime.utcnow() + timedelta(seconds=60),
+            'https://aaf.edu.au/attributes': {
+                'edupersontargetedid': '1324',
+                'displayname': 'john smith',
+                'mail': 'Test@example.com'}}
+
+    def post(self, mock_request, token):
+        self.session = MagicMock()
+        self.session_data = {}
+        self.session.__setitem__.side_effect = \
+            self.session_data.__setitem__
+        mock_request.environ = {"beaker.session": self.session}
+        mock_request.forms = {'assertion': token}
+        mock_request.script_name = '/'
+        with patch("shibble.views.CONFIG", self.config):
+            return rapid_connect()
+
+    @patch("shibble.views.RAPID_CONNECT_REPLAY_STORE", MemoryReplayStore())
+    @patch("shibble.views.request")
+    def test_login(self, mock_request):
+        token = jwt.encode(self.claims, 'secret')
+
+        self.assertRaises(HTTPResponse, self.post, mock_request, token)
+
+        self.assertEqual(self.session_data['rapid_connect_attrs'],
+                         {'id': '1324', 'fullname': 'john smith',
+                          'mail': 'test@example.com'})
+
+    @patch("shibble.views.RAPID_CONNECT_REPLAY_STORE", MemoryReplayStore())
+    @patch("shibble.views.request")
+    def test_non_ascii(self, mock_request):
+        self.claims['https://aaf.edu.au/attributes']['displayname'] = \
+            u'Jos\xe9 Garc\xeda'
+        token = jwt.encode(self.claims, 'secret')
+
+        self.assertRaises(HTTPResponse, self.post, mock_request, token)
+
+        self.assertEqual(
+            self.session_data['rapid_connect_attrs']['fullname'],
+            u'Jos\xe9 Garc\xeda'.encode('utf-8'))
+
+    @patch("shibble.views.RAPID_CONNECT_REPLAY_STORE", MemoryReplayStore())
+    @patch("shibble.views.request")
+    @patch("shibble.views.template")
+    def test_rejected(self, mock_template, mock_request):
+        for claims, key in ((self.claims, 'wrong'),
+                            (dict(self.claims, aud='https://other.com'),
+                             'secret'),
+                            (dict(self.claims, iss='https://evil.com'),
+                             'secret')):
+            response = self.post(mock_request, jwt.encode(claims, key))
+            self.assertEqual(response, mock_template.return_value)
+            self.assertEqual(mock_template.call_args[0], ('error',))
+            self.assertNotIn('rapid_connect_attrs', self.session_data)
+
+    @patch("shibble.views.RAPID_CONNECT_REPLAY_STORE", MemoryReplayStore())
+    @patch("shibble.views.request")
+    @patch("shibble.views.template")
+    def test_replayed(self, mock_template, mock_request):
+        token = jwt.encode(self.claims, 'secret')
+        self.assertRaises(HTTPResponse, self.post, mock_request, token)
+
+        response = self.post(mock_request, token)
+
+        self.assertEqual(response, mock_template.return_value)
+        self.assertNotIn('rapid_connect_attrs', self.session_data)
+
+    @patch("shibble.views.RAPID_CONNECT_REPLAY_STORE", MemoryReplayStore())
+    @patch("shibble.views.request")
+    @patch("shibble.views.template")
+    def test_no_expiry(self, mock_template, mock_request):
+        del self.claims['exp']
+
+        response = self.post(mock_request, jwt.encode(self.claims, 'secret'))
+
+        self.assertEqual(response, mock_template.return_value)
+        self.assertNotIn('rapid_connect_attrs', self.session_data)
+
+    @patch("shibble.views.request")
+    def test_disabled(self, mock_request):
+        token = jwt.encode(self.claims, 'changeme')
+        for secret in (None, 'changeme'):
+            self.config['rapid_connect_secret'] = secret
+
+            response = self.post(mock_request, token)
+
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(self.session_data, {})
+
+    @patch("shibble.views.RAPID_CONNECT_REPLAY_STORE", MemoryReplayStore())
+    @patch("shibble.views.request")
+    def test_session_lifetime(self, mock_request):
+        # outlives the assertion, while the account is being created
+        self.config['rapid_connect_session_lifetime'] = '600'
+        start = time.time()
+
+        self.assertRaises(HTTPResponse, self.post, mock_request,
+                          jwt.encode(self.claims, 'secret'))
+
+        expires = self.session_data['rapid_connect_expires']
+        self.assertTrue(start + 600 <= expires <= time.time() + 600)
+
+    @patch("shibble.views.RAPID_CONNECT_REPLAY_STORE", MemoryReplayStore())
+    @patch("shibble.views.request")
+    def test_attributes_expire(self, mock_request):
+        self.assertRaises(HTTPResponse, self.post, mock_request,
+                          jwt.encode(self.claims, 'secret'))
+        session = MockSession(self.session_data)
+        self.assertEqual(views.get_rapid_connect_attrs(session)['id'], '1324')
+
+        session['rapid_connect_expires'] = time.time() - 1
+
+        self.assertEqual(views.get_rapid_connect_attrs(session), None)
+        self.assertEqual(session, {})
+        self.assertEqual(session.saves, 1)
+
+
+class TestCachedPage(unittest.TestCase):
+    def setUp(self):
+        views._page_cache.clear()
+        self.response = BaseResponse()
+
+    @patch("shibble.views.request")
+    @patch("shibble.views.template")
+    def test_rendered_once(self, mock_template, mock_request):
+        mock_template.return_value = u'<html>terms</html>'
+        mock_request.script_name = '/'
+        mock_request.headers = {}
+
+        with patch("shibble.views.response", self.response):
+            for i in range(2):
+                self.assertEqual(views.terms(None), u'<html>terms</html>')
+
+        mock_template.assert_called_once_with('terms_form')
+        self.assertTrue(self.response.get_header('ETag'))
+
+    @patch("shibble.views.request")
+    @patch("shibble.views.template")
+    def test_per_script_name(self, mock_template, mock_request):
+        mock_template.side_effect = lambda name: mock_request.script_name
+        mock_request.headers = {}
+
+        with patch("shibble.views.response", self.response):
+            mock_request.script_name = '/a/'
+            self.assertEqual(views.terms(None), '/a/')
+            mock_request.script_name = '/b/'
+            self.assertEqual(views.terms(None), '/b/')
+
+    @patch("shibble.views.request")
+    @patch("shibble.views.template")
+    def test_not_modified(self, mock_template, mock_request):
+        mock_template.return_value = u'<html>terms</html>'
+        mock_request.script_name = '/'
+        mock_request.headers = {}
+        with patch("shibble.views.response", self.response):
+            views.terms(None)
+            etag = self.response.get_header('ETag')
+
+            mock_request.headers = {'If-None-Match': '"other", ' + etag}
+            response = BaseResponse()
+            with patch("shibble.views.response", response):
+                self.assertEqual(views.terms(None), '')
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_header('ETag'), etag)
+
+
+class TestConfigureTemplates(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        bottle.TEMPLATES.clear()
+        bottle.TEMPLATE_PATH.append(path.join(path.dirname(views.__file__),
+                                              'templates'))
+
+    def tearDown(self):
+        views.TEMPLATE_SETTINGS.pop('bytecode_cache', None)
+        bottle.TEMPLATES.clear()
+        bottle.TEMPLATE_PATH.pop()
+        shutil.rmtree(self.cache_dir)
+
+    @patch("shibble.views.request")
+    def test_bytecode_cache(self, mock_request):
+        mock_request.script_name = '/'
+        cache_dir = path.join(self.cache_dir, 'templates')
+        views.configure_templates(cache_dir)
+
+        self.assertIn('Terms and Conditions',
+                      views.template('terms_form', title='Terms'))
+
+        # the page, its layout and the included terms
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+
+class MockSession(dict):
+    saves = 0
+
+    def save(self):
+        self.saves += 1
+
+
+class TestUpdateSession(unittest.TestCase):
+    def test_changed(self):
+        session = MockSession()
+        self.assertTrue(views.update_session(session, {'user_id': '1324'}))
+        self.assertEqual(session, {'user_id': '1324'})
+        self.assertEqual(session.saves, 1)
+
+    def test_unchanged(self):
+        session = MockSession(user_id='1324', csrfmiddlewaretoken='abc')
+
+        self.assertFalse(views.update_session(
+            session, {'user_id': '1324', 'csrfmiddlewaretoken': 'abc'}))
+        self.assertEqual(session.saves, 0)
+
+    def test_one_changed(self):
+        session = MockSession(user_id='1324', csrfmiddlewaretoken='abc')
+
+        views.update_session(session, {'user_id': '1324',
+                                       'csrfmiddlewaretoken': 'def'})
+
+        self.assertEqual(session['csrfmiddlewaretoken'], 'def')
+        self.assertEqual(session.saves, 1)
+
+    def test_beaker_writes(self):
+        from beaker.middleware import SessionMiddleware
+        from beaker.container import MemoryNamespaceManager
+
+        def app(environ, start_response):
+            views.update_session(environ['beaker.session'],
+                                 {'user_id': '1324'})
+            start_response('200 OK', [])
+            return ['']
+
+        app = SessionMiddleware(app, {'session.type': 'memory',
+                                      'session.save_accessed_time': False})
+        headers = []
+
+        def start_response(status, response_headers, exc_info=None):
+            headers[:] = response_headers
+
+        with patch.object(MemoryNamespaceManager, '__setitem__',
+                          autospec=True,
+                          side_effect=MemoryNamespaceManager.__setitem__) \
+                as mock_setitem:
+            app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}, start_response)
+            cookie = dict(headers)['Set-cookie'].split(';')[0]
+            for i in range(3):
+                app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+                     'HTTP_COOKIE': cookie}, start_response)
+
+        # only the first request changed the session
+        self.assertEqual(mock_setitem.call_count, 1)
+
+
+class TestReadReplica(unittest.TestCase):
+    def setUp(self):
+        self.databases = {}
+        for name, state in (('primary', 'created'),
+                            ('replica', 'registered')):
+            engine = create_engine('sqlite://')
+            Base.metadata.create_all(engine)
+            db = sessionmaker(bind=engine)()
+            shibuser = User('1324')
+            shibuser.state = state
+            db.add(shibuser)
+            db.commit()
+            self.databases[name] = db
+        self.session = MockSession(user_id='1324')
+        utils.USER_STATE_CACHE.clear()
+
+    def tearDown(self):
+        views.READ_YOUR_WRITES = 0
+        utils.USER_STATE_CACHE.clear()
+
+    def status(self):
+        utils.USER_STATE_CACHE.clear()
+        with patch('shibble.views.request') as mock_request:
+            mock_request.environ = {'beaker.session': self.session}
+            return json.loads(account_status(self.databases['primary'],
+                                             self.databases['replica']))
+
+    def test_replica(self):
+        # the replica hasn't caught up with the primary yet
+        self.assertEqual(self.status(), {'state': 'registered'})
+
+    def test_read_your_writes(self):
+        views.READ_YOUR_WRITES = 30
+        views.mark_written(self.session)
+
+        self.assertEqual(self.status(), {'state': 'created'})
+        self.assertEqual(self.session.saves, 1)
+
+        self.session['read_primary_until'] -= 31
+        self.assertEqual(self.status(), {'state': 'registered'})
+
+    def test_no_replica(self):
+        views.mark_written(self.session)
+
+        self.assertNotIn('read_primary_until', self.session)
+        db = self.databases['primary']
+        self.assertTrue(views.reader(self.session, db, None) is db)
+
+
+class TestMetricsText(unittest.TestCase):
+    def get(self, config, **environ):
+        with patch('shibble.views.CONFIG', config), \
+                patch('shibble.views.request') as mock_request, \
+                patch('shibble.views.response'):
+            mock_request.environ = environ
+            return views.metrics_text()
+
+    def test_local_only(self):
+        self.assertIn('# TYPE shibble_stage_seconds histogram',
+                      self.get({}, REMOTE_ADDR='127.0.0.1'))
+        response = self.get({}, REMOTE_ADDR='192.0.2.1',
+                            HTTP_X_FORWARDED_FOR='127.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+    def test_token(self):
+        config = {'metrics_token': 's3cret'}
+        self.assertIn('# TYPE shibble_stage_seconds histogram',
+                      self.get(config, REMOTE_ADDR='192.0.2.1',
+                               HTTP_AUTHORIZATION='Bearer s3cret'))
+        for environ in ({'REMOTE_ADDR': '127.0.0.1'},
+                        {'HTTP_AUTHORIZATION': 'Bearer wrong'}):
+            self.assertEqual(self.get(config, **environ).status_code, 403)
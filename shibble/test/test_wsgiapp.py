@@ -0,0 +1,50 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from os import path
+
+# only imported once they are used
+LAZY_MODULES = ('dbus', 'ldap', 'smtplib', 'email.mime.text', 'weberror',
+                'oslo_config', 'shibble.jwk', 'cryptography')
+
+COLD_START = """
+import json
+import sys
+
+from shibble import wsgiapp
+app = wsgiapp.make_app({'__file__': sys.argv[1],
+                        'support_url': 'https://support.example.com'},
+                       'sqlite://', provisioning_workers='0')
+print(json.dumps({'modules': sorted(sys.modules)}))
+"""
+
+
+class TestColdStart(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config_file = path.join(self.tmp_dir, 'shibble.conf')
+        with open(self.config_file, 'w') as f:
+            f.write('[ldap]\nuser_dn = ou=Users,dc=localdomain\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def cold_start(self):
+        env = dict(os.environ)
+        root = path.dirname(path.dirname(path.dirname(
+            path.abspath(__file__))))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + filter(None, [env.get('PYTHONPATH')]))
+        output = subprocess.check_output(
+            [sys.executable, '-W', 'ignore', '-c', COLD_START,
+             self.config_file], env=env, cwd=self.tmp_dir)
+        return json.loads(output.splitlines()[-1])
+
+    def test_lazy_modules(self):
+        modules = self.cold_start()['modules']
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, modules)
@@ -0,0 +1,111 @@
+"""Allocation of free uidNumbers for new local accounts."""
+import bisect
+import logging
+import threading
+import time
+from datetime import datetime
+
+LOG = logging.getLogger('shibble.uidalloc')
+
+
+class UIDAllocator(object):
+    """Hand out the lowest free uidNumber at or above `minimum`.
+
+    `search(since)` returns the uidNumbers of the accounts created since
+    the `since` UTC datetime, or of every account when `since` is None.
+    The directory is scanned once to find the high-water mark and the gaps
+    below it; later allocations only fetch the accounts created since the
+    previous refresh. The gaps are kept as a sorted list of `(start, end)`
+    ranges, so memory grows with the number of accounts rather than with
+    their uidNumbers, and an outlier such as 4294967294 is one range. A
+    full rescan every `full_refresh` seconds picks up accounts that were
+    deleted.
+    """
+
+    # overlap between incremental refreshes to cover clock skew with the
+    # directory server, seeing an account twice is harmless
+    refresh_margin = 60
+
+    def __init__(self, search, minimum=2000, full_refresh=3600):
+        self.search = search
+        self.minimum = minimum
+        self.full_refresh = full_refresh
+        self.high_water_mark = minimum
+        self._lock = threading.Lock()
+        # disjoint [start, end) ranges of free uids below the high-water
+        # mark, sorted
+        self._free = []
+        self._seeded_at = None
+        self._refreshed_at = None
+
+    def _find(self, uid):
+        """Return the index of the free range holding `uid`, or None."""
+        i = bisect.bisect_right(self._free, (uid, float('inf'))) - 1
+        if i >= 0 and uid < self._free[i][1]:
+            return i
+        return None
+
+    def _mark_used(self, uid):
+        if uid < self.minimum:
+            return
+        if uid >= self.high_water_mark:
+            if uid > self.high_water_mark:
+                self._free.append((self.high_water_mark, uid))
+            self.high_water_mark = uid + 1
+            return
+        i = self._find(uid)
+        if i is not None:
+            start, end = self._free[i]
+            self._free[i:i + 1] = [r for r in ((start, uid), (uid + 1, end))
+                                   if r[0] < r[1]]
+
+    def _seed(self, now):
+        uids = sorted(set(uid for uid in self.search(None)
+                          if uid >= self.minimum))
+        self.high_water_mark = self.minimum
+        self._free = []
+        for uid in uids:
+            self._mark_used(uid)
+        self._seeded_at = self._refreshed_at = now
+        LOG.info('Seeded uid allocator, high-water mark %d with %d gaps',
+                 self.high_water_mark,
+                 sum(end - start for start, end in self._free))
+
+    def _refresh(self, now):
+        since = datetime.utcfromtimestamp(self._refreshed_at -
+                                          self.refresh_margin)
+        for uid in self.search(since):
+            self._mark_used(uid)
+        self._refreshed_at = now
+
+    def refresh(self):
+        """Bring the allocator up to date with the directory."""
+        now = time.time()
+        with self._lock:
+            if (self._seeded_at is None or
+                    now - self._seeded_at > self.full_refresh):
+                self._seed(now)
+            else:
+                self._refresh(now)
+
+    def allocate(self):
+        """Return a free uidNumber and mark it as used."""
+        self.refresh()
+        with self._lock:
+            if self._free:
+                start, end = self._free[0]
+                if start + 1 < end:
+                    self._free[0] = (start + 1, end)
+                else:
+                    del self._free[0]
+                return start
+            uid = self.high_water_mark
+            self.high_water_mark += 1
+            return uid
+
+    def release(self, uid):
+        """Give back a uidNumber that ended up not being used."""
+        with self._lock:
+            if self.minimum <= uid < self.high_water_mark and \
+                    self._find(uid) is None:
+                bisect.insort(self._free, (uid, uid + 1))
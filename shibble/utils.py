@@ -1,21 +1,30 @@
 import logging
 import base64
+import hashlib
+import json
 import sha
 import random
-import smtplib
-import dbus
-
-from email.mime.text import MIMEText
-
-import ldap
-import ldap.modlist as modlist
+import threading
 
+from shibble import cache
 from shibble import cfg
-from shibble.models import User
+from shibble import lazy
+from shibble import ldappool
+from shibble import metrics
+from shibble import notify
+from shibble import uidalloc
+from shibble.models import User, on_commit
 
 LOG = logging.getLogger('shibble.utils')
 CONF = cfg.CONF
 
+# only imported by the workers that use them
+dbus = lazy.LazyModule('dbus')
+ldap = lazy.LazyModule('ldap')
+modlist = lazy.LazyModule('ldap.modlist')
+mime_text = lazy.LazyModule('email.mime.text')
+smtplib = lazy.LazyModule('smtplib')
+
 CONST_STRING = \
     """When we speak of free software, we are referring to freedom, not
     price. Our General Public Licenses are designed to make sure that you
@@ -47,7 +56,7 @@ Thanks
 
 
 def do_email_send(subject, body, recipient):
-    msg = MIMEText(body)
+    msg = mime_text.MIMEText(body)
     msg['From'] = CONF.mail.from_address
     msg['To'] = recipient
     msg['Reply-to'] = CONF.mail.reply_to
@@ -68,58 +77,134 @@ def get_ldap_connection():
     return l
 
 
-def get_next_uid():
-    idlist = []
-    nid = 2000
+_ldap_pool = None
+_ldap_pool_lock = threading.Lock()
+
+
+def get_ldap_pool():
+    """Return the process wide pool of LDAP connections."""
+    global _ldap_pool
+    with _ldap_pool_lock:
+        if _ldap_pool is None:
+            _ldap_pool = ldappool.ConnectionPool(
+                get_ldap_connection,
+                max_size=int(CONF.ldap.get('pool_size', 10)),
+                idle_timeout=int(CONF.ldap.get('pool_idle_timeout', 300)),
+                check_after=int(CONF.ldap.get('pool_check_after', 10)))
+        return _ldap_pool
 
+
+def ldap_call(operation):
+    """Return `operation(conn)` run on a pooled LDAP connection.
+
+    It is retried once if the server had dropped the connection.
+    """
+    return get_ldap_pool().run(operation)
+
+
+def search_uid_numbers(since=None):
+    """Return the uidNumbers of the accounts created since `since`."""
     search_filter = "(&(uidNumber=*)(objectClass=posixAccount))"
-    l = get_ldap_connection()
-    res = l.search_s(CONF.ldap.user_dn, ldap.SCOPE_SUBTREE, search_filter)
-    for i in res:
-        j = i[1]
-        idlist.append(int(j['uidNumber'][0]))
-    idlist.sort()
-    testid = nid
-    while True:
-        if idlist.count(testid) == 0:
-            nid = testid
-            break
-        testid = testid + 1
-    return nid
+    if since is not None:
+        search_filter = \
+            "(&(uidNumber=*)(objectClass=posixAccount)" \
+            "(createTimestamp>={}))".format(since.strftime('%Y%m%d%H%M%SZ'))
+    res = ldap_call(lambda conn: conn.search_s(
+        CONF.ldap.user_dn, ldap.SCOPE_SUBTREE, search_filter, ['uidNumber']))
+    return [int(attrs['uidNumber'][0]) for dn, attrs in res]
+
 
+_uid_allocator = None
+_uid_allocator_lock = threading.Lock()
 
+
+def get_uid_allocator():
+    """Return the process wide uidNumber allocator."""
+    global _uid_allocator
+    with _uid_allocator_lock:
+        if _uid_allocator is None:
+            _uid_allocator = uidalloc.UIDAllocator(
+                search_uid_numbers,
+                minimum=int(CONF.ldap.get('uid_min', 2000)),
+                full_refresh=int(CONF.ldap.get('uid_full_refresh', 3600)))
+        return _uid_allocator
+
+
+@metrics.stage('get_next_uid')
+def get_next_uid():
+    return get_uid_allocator().allocate()
+
+
+_user_exists_cache = None
+_user_exists_cache_lock = threading.Lock()
+
+
+def get_user_exists_cache():
+    """Return the process wide cache of LDAP account lookups."""
+    global _user_exists_cache
+    with _user_exists_cache_lock:
+        if _user_exists_cache is None:
+            _user_exists_cache = cache.TTLCache(
+                maxsize=int(CONF.ldap.get('exists_cache_size', 4096)),
+                ttl=int(CONF.ldap.get('exists_cache_ttl', 300)))
+        return _user_exists_cache
+
+
+@metrics.stage('user_exists')
 def user_exists(user):
-    l = get_ldap_connection()
+    """Return whether the user has an LDAP account, caching the answer.
+
+    Missing accounts are only cached for `exists_negative_cache_ttl`
+    seconds so that accounts created elsewhere show up quickly.
+    """
+    exists_cache = get_user_exists_cache()
+    exists = exists_cache.get(user)
+    if exists is None:
+        exists = lookup_user(user)
+        if exists:
+            exists_cache.set(user, True)
+        else:
+            exists_cache.set(
+                user, False,
+                ttl=int(CONF.ldap.get('exists_negative_cache_ttl', 30)))
+    return exists
+
+
+def lookup_user(user):
+    """Search LDAP for the user's account, bypassing the cache."""
     search_filter = "(&(uid={})(objectClass=posixAccount))".format(user)
-    try:
-        ldap_result_id = l.search(CONF.ldap.user_dn, ldap.SCOPE_SUBTREE,
-                                  search_filter, None)
+
+    def search(conn):
+        ldap_result_id = conn.search(CONF.ldap.user_dn, ldap.SCOPE_SUBTREE,
+                                     search_filter, None)
         exist = 0
         while 1:
-            result_type, result_data = l.result(ldap_result_id, 0)
+            result_type, result_data = conn.result(ldap_result_id, 0)
             if not result_data:
                 break
             else:
                 if result_type == ldap.RES_SEARCH_ENTRY:
                     exist = exist + 1
-        if exist == 1:
-            return True
-        else:
-            return False
-    #except ldap.LDAPError as e:
-    #    LOG.error('LDAP account search failed: {}'.format(e))
-    finally:
-        l.unbind_s()
+        return exist
+    if ldap_call(search) == 1:
+        return True
+    else:
+        return False
 
 
 def create_user(db, shib_attrs, password):
-    """Add a new user"""
+    """Add a new user
+
+    The home dir and NextCloud steps are repeated for an account already
+    in LDAP, so that a retry finishes what a failed attempt started.
+    """
     username = shib_attrs['id']
     mail = shib_attrs['mail']
     name = shib_attrs['fullname']
 
-    if user_exists(username):
+    if lookup_user(username):
         LOG.warning('User account already exists in LDAP')
+        get_user_exists_cache().set(username, True)
     else:
         user_dn = "uid={},{}".format(username, CONF.ldap.user_dn)
 
@@ -129,7 +214,8 @@ def create_user(db, shib_attrs, password):
                                 'shadowAccount']
         attrs['cn'] = username
         attrs['uid'] = username
-        attrs['uidNumber'] = str(get_next_uid())
+        uid_number = get_next_uid()
+        attrs['uidNumber'] = str(uid_number)
         attrs['gidNumber'] = CONF.ldap.group_id
         attrs['homeDirectory'] = '{}/{}'.format(CONF.ldap.home_dir_path, username)
         attrs['loginShell'] = '/bin/bash'
@@ -140,19 +226,22 @@ def create_user(db, shib_attrs, password):
         ldif = modlist.addModlist(attrs)
 
         try:
-            l = get_ldap_connection()
-            l.add_s(user_dn, ldif)
+            with metrics.stage('ldap_add'):
+                ldap_call(lambda conn: conn.add_s(user_dn, ldif))
+        except Exception:
+            get_uid_allocator().release(uid_number)
+            raise
 
-            LOG.info("Unix account created for {}".format(username))
+        get_user_exists_cache().set(username, True)
+        LOG.info("Unix account created for {}".format(username))
 
-            create_home_dir(username)
-            create_nextcloud_mount(username, password)
+    create_home_dir(username)
+    create_nextcloud_mount(username, password)
 
-            update_user_state(db, shib_attrs, 'created')
-        finally:
-            l.unbind_s()
+    update_user_state(db, shib_attrs, 'created')
 
 
+@metrics.stage('create_home_dir')
 def create_home_dir(username):
     bus = dbus.SystemBus()
     obj = bus.get_object('com.redhat.oddjob_mkhomedir', '/')
@@ -166,6 +255,7 @@ def create_home_dir(username):
     return True
 
 
+@metrics.stage('create_nextcloud_mount')
 def create_nextcloud_mount(username, password):
     bus = dbus.SystemBus()
     obj = bus.get_object('au.org.nectar.nextcloud_storage', '/')
@@ -187,23 +277,131 @@ def create_db_user(db, shib_attrs):
     # add shibboleth user
     shibuser = User(shib_attrs["id"])
     db.add(shibuser)
-    db.commit()
+    db.flush()
+    cache_user_state(shibuser, db)
     return shibuser
 
 
+# count of logins that did and didn't need the user's details written
+ATTRIBUTE_UPDATES = {'performed': 0, 'skipped': 0}
+
+
+def attributes_digest(shib_attrs):
+    return hashlib.sha1(json.dumps(shib_attrs, sort_keys=True)).hexdigest()
+
+
 def update_db_user(db, shib_user, shib_attrs):
     """Update a Shibboleth User with new details passed from
     Shibboleth.
+
+    Nothing is written when the attributes match the last ones seen,
+    return whether the user was updated.
     """
+    digest = attributes_digest(shib_attrs)
+    if shib_user.attributes_digest == digest:
+        ATTRIBUTE_UPDATES['skipped'] += 1
+        return False
     shib_user.displayname = shib_attrs["fullname"]
     shib_user.email = shib_attrs["mail"]
     shib_user.shibboleth_attributes = shib_attrs
-    db.commit()
+    shib_user.attributes_digest = digest
+    db.flush()
+    ATTRIBUTE_UPDATES['performed'] += 1
+    return True
 
 
 def update_user_state(db, shib_attrs, state):
     shib_user = db.query(User).filter_by(
         user_id=shib_attrs["id"]).first()
     shib_user.state = state
-    db.commit()
+    db.flush()
+    cache_user_state(shib_user, db)
+    on_commit(db, notify.USER_STATES.notify, shib_user.user_id, state)
+
+
+# user_id -> (state, terms), updated by every path that changes the state
+USER_STATE_CACHE = cache.TTLCache(maxsize=10000, ttl=300)
+# states that other processes may still change are only trusted briefly
+USER_STATE_TRANSIENT_TTL = 5
+# fraction of cache hits checked against the database
+USER_STATE_VERIFY_RATE = 0.0
+USER_STATE_STALENESS = {'checked': 0, 'stale': 0}
 
+
+def configure_user_state_cache(maxsize, ttl, transient_ttl, verify_rate):
+    global USER_STATE_TRANSIENT_TTL, USER_STATE_VERIFY_RATE
+    USER_STATE_CACHE.maxsize = maxsize
+    USER_STATE_CACHE.ttl = ttl
+    USER_STATE_TRANSIENT_TTL = transient_ttl
+    USER_STATE_VERIFY_RATE = verify_rate
+
+
+def cache_user_state(shib_user, db=None):
+    """Write the user's state through to the cache and return it.
+
+    When `db` is given the cache is only updated once it commits.
+    """
+    entry = (shib_user.state, shib_user.terms)
+    ttl = None
+    if shib_user.state != 'created':
+        ttl = USER_STATE_TRANSIENT_TTL
+    if db is None:
+        USER_STATE_CACHE.set(shib_user.user_id, entry, ttl)
+    else:
+        on_commit(db, USER_STATE_CACHE.set, shib_user.user_id, entry, ttl)
+    return entry
+
+
+def get_user_state(db, user_id, cached=True):
+    """Return the (state, terms) of a user, (None, None) if unknown."""
+    entry = None
+    if cached:
+        entry = USER_STATE_CACHE.get(user_id)
+    if entry is not None:
+        if USER_STATE_VERIFY_RATE and \
+                random.random() < USER_STATE_VERIFY_RATE:
+            USER_STATE_STALENESS['checked'] += 1
+            fresh = get_user_state(db, user_id, cached=False)
+            if fresh != entry:
+                USER_STATE_STALENESS['stale'] += 1
+                entry = fresh
+        return entry
+    shib_user = db.query(User).filter_by(user_id=user_id).first()
+    if not shib_user:
+        return None, None
+    return cache_user_state(shib_user)
+
+
+@metrics.collector
+def collect_metrics():
+    """Expose the LDAP pool, cache and attribute update counters."""
+    families = [
+        ('shibble_attribute_updates_total',
+         'Logins that did and didn\'t need the user\'s details written.',
+         'counter', [({'result': result}, count)
+                     for result, count in sorted(ATTRIBUTE_UPDATES.items())]),
+    ]
+    caches = [('user_state', USER_STATE_CACHE.stats())]
+    if _user_exists_cache is not None:
+        caches.append(('user_exists', _user_exists_cache.stats()))
+    for counter in ('hits', 'misses', 'evictions'):
+        families.append((
+            'shibble_cache_%s_total' % counter, 'Cache %s.' % counter,
+            'counter', [({'cache': name}, stats[counter])
+                        for name, stats in caches]))
+    if _ldap_pool is not None:
+        stats = _ldap_pool.stats()
+        families.extend([
+            ('shibble_ldap_pool_connections',
+             'Open LDAP connections, in use or idle.', 'gauge',
+             [({'state': 'open'}, stats['size']),
+              ({'state': 'idle'}, stats['idle'])]),
+            ('shibble_ldap_pool_checkouts_total',
+             'LDAP connection checkouts, by whether one was idle.',
+             'counter', [({'result': 'hit'}, stats['hits']),
+                         ({'result': 'miss'}, stats['misses'])]),
+            ('shibble_ldap_pool_reconnects_total',
+             'LDAP connections replaced after failing a liveness check.',
+             'counter', [({}, stats['reconnects'])]),
+        ])
+    return families
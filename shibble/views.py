@@ -1,113 +1,216 @@
+import os
 from os import path
 from datetime import datetime
+import hashlib
+import hmac
 import logging
 import json
 import functools
+import time
 
+import bottle
+import jinja2
 from bottle import route
 from bottle import request
+from bottle import response
 from bottle import redirect
 from bottle import static_file
-from bottle import jinja2_template as template
+from bottle import HTTPError
+from bottle import HTTPResponse
+from bottle import jinja2_template
 
 from paste.deploy.config import CONFIG
-from weberror import errormiddleware
 
+from shibble import attrmap
 from shibble import jwt
+from shibble import metrics
 from shibble import utils
 from shibble import models
+from shibble import notify
+from shibble import provisioning
 
 LOG = logging.getLogger('shibble.views')
 
 STATIC_FILES = path.join(path.dirname(__file__), 'static')
+# the static files, fingerprinted and compressed if they were built, set
+# up by make_app
+ASSETS = None
+
+RAPID_CONNECT_ISSUER = 'https://rapid.aaf.edu.au'
+# the secret of the sample config, never accepted
+RAPID_CONNECT_PLACEHOLDER_SECRET = 'changeme'
+# set up by make_app, shared by all the workers using the database
+RAPID_CONNECT_REPLAY_STORE = None
+# served the metrics without a metrics_token
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+# seconds a user's reads stay on the primary database after they change
+# their state, set up by make_app when there is a read replica
+READ_YOUR_WRITES = 0
+
+
+def static_url(name):
+    """Return the URL of a static file, fingerprinted if it was built."""
+    if ASSETS is not None:
+        name = ASSETS.url(name)
+    return '%sstatic/%s' % (request.script_name, name)
+
+
+# passed to jinja2 when each template is first compiled
+TEMPLATE_SETTINGS = {'globals': {'static_url': static_url}}
 
 # include the request in each template
-template = functools.partial(template, request=request)
-
-
-class ShibbolethAttrMap(object):
-    data = {'persistent-id': 'id',
-            'cn': 'cn',
-            'displayName': 'fullname',
-            'givenName': 'firstname',
-            'sn': 'surname',
-            'uid': 'uid',
-            'mail': 'mail',
-            'eppn': 'eppn',
-            'l': 'location',
-            'description': 'description',
-            'o': 'organisation',
-            'affiliation': 'affiliation',
-            'unscoped-affiliation': 'unscoped-affiliation',
-            'assurance': 'assurance',
-            'Shib-Identity-Provider': 'idp',
-            'shared-token': 'shared_token',
-            'homeOrganization': 'homeorganisation',
-            'homeOrganizationType': 'homeorganisationtype',
-            'telephoneNumber': 'telephonenumber'}
-
-    @classmethod
-    def parse(cls, environ):
-        metadata = {}
-        for k, v in cls.data.items():
-            if environ.get(k):
-                if k == "mail":
-                    metadata[v] = str(environ.get(k).lower())
-                else:
-                    metadata[v] = str(environ.get(k))
-        return metadata
-
-    @classmethod
-    def get_attr(cls, name):
-        for k, v in cls.data.items():
-            if name == v:
-                return k
-
-
-class RapidConnectAttrMap(object):
-    data = {'cn': 'cn',
-            'displayname': 'fullname',
-            'givenname': 'firstname',
-            'surname': 'surname',
-            'mail': 'mail',
-            'edupersontargetedid': 'id'}
-
-    @classmethod
-    def parse(cls, environ):
-        metadata = {}
-        for k, v in cls.data.items():
-            if environ.get(k):
-                if k == "mail":
-                    metadata[v] = str(environ.get(k).lower())
-                else:
-                    metadata[v] = str(environ.get(k))
-        return metadata
-
-    @classmethod
-    def get_attr(cls, name):
-        for k, v in cls.data.items():
-            if name == v:
-                return k
+_template = functools.partial(jinja2_template, request=request,
+                              template_settings=TEMPLATE_SETTINGS)
+
+
+def template(*args, **kwargs):
+    with metrics.stage('template'):
+        return _template(*args, **kwargs)
+
+
+def configure_templates(cache_dir=None):
+    """Keep compiled templates in `cache_dir`, shared by all the workers.
+
+    Must be called before the first template is rendered.
+    """
+    if cache_dir:
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        TEMPLATE_SETTINGS['bytecode_cache'] = \
+            jinja2.FileSystemBytecodeCache(cache_dir)
+
+
+# (body, etag) of pages that only depend on their arguments, by template,
+# script_name and arguments
+_page_cache = {}
+
+
+def cached_page(name, **data):
+    """Render a page that only depends on `data` and the script_name.
+
+    The page is rendered once and conditional requests for it are
+    answered with a 304.
+    """
+    key = (name, request.script_name, tuple(sorted(data.items())))
+    page = _page_cache.get(key)
+    if page is None or bottle.DEBUG:
+        body = template(name, **data)
+        etag = '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest()
+        page = _page_cache[key] = (body, etag)
+    body, etag = page
+    response.set_header('ETag', etag)
+    response.set_header('Cache-Control', 'private, no-cache')
+    if_none_match = request.headers.get('If-None-Match', '')
+    if etag in [tag.strip() for tag in if_none_match.split(',')]:
+        response.status = 304
+        return ''
+    return body
+
+
+ShibbolethAttrMap = attrmap.register('shibboleth', attrmap.AttributeMap(
+    {'persistent-id': 'id',
+     'cn': 'cn',
+     'displayName': 'fullname',
+     'givenName': 'firstname',
+     'sn': 'surname',
+     'uid': 'uid',
+     'mail': 'mail',
+     'eppn': 'eppn',
+     'l': 'location',
+     'description': 'description',
+     'o': 'organisation',
+     'affiliation': 'affiliation',
+     'unscoped-affiliation': 'unscoped-affiliation',
+     'assurance': 'assurance',
+     'Shib-Identity-Provider': 'idp',
+     'shared-token': 'shared_token',
+     'homeOrganization': 'homeorganisation',
+     'homeOrganizationType': 'homeorganisationtype',
+     'telephoneNumber': 'telephonenumber'},
+    normalisers={'mail': ['lower']}))
+
+
+RapidConnectAttrMap = attrmap.register('rapid_connect', attrmap.AttributeMap(
+    {'cn': 'cn',
+     'displayname': 'fullname',
+     'givenname': 'firstname',
+     'surname': 'surname',
+     'mail': 'mail',
+     'edupersontargetedid': 'id'},
+    # the assertion is JSON, so its values are unicode
+    normalisers={'cn': ['utf8'],
+                 'displayname': ['utf8'],
+                 'givenname': ['utf8'],
+                 'surname': ['utf8'],
+                 'mail': ['utf8', 'lower'],
+                 'edupersontargetedid': ['utf8']}))
+
+
+def update_session(session, values):
+    """Set `values` in the session, only saving it if one changed.
+
+    Beaker writes a saved session once, when the response starts, and
+    otherwise leaves the stored one alone. Return whether it was saved.
+    """
+    changed = False
+    for key, value in values.items():
+        if key not in session or session[key] != value:
+            session[key] = value
+            changed = True
+    if changed:
+        session.save()
+    return changed
+
+
+def mark_written(session):
+    """Read the user's state from the primary until the replica has it."""
+    if READ_YOUR_WRITES:
+        update_session(session, {
+            'read_primary_until': time.time() + READ_YOUR_WRITES})
+
+
+def reader(session, db, read_db):
+    """Return the database session to read the user's state from."""
+    if read_db is None or \
+            session.get('read_primary_until', 0) > time.time():
+        return db
+    return read_db
 
 
 @route('/static/:filepath')
 def static(filepath):
-    return static_file(filepath, root=STATIC_FILES)
+    if ASSETS is None:
+        return static_file(filepath, root=STATIC_FILES)
+    return ASSETS.response(filepath, request.environ)
 
 
 @route('/')
 @route('/', method='POST')
 def root(db):
+    # redirects are responses rather than errors
+    with metrics.stage('root', ignore=(HTTPResponse,)):
+        return _root(db)
+
+
+def _root(db):
     session = request.environ['beaker.session']
     LOG.debug('The env vars are: %s.' % request.environ)
-    shib_attrs = ShibbolethAttrMap.parse(request.environ)
+    attr_map = attrmap.get('shibboleth')
+    shib_attrs = attr_map.parse(request.environ)
+    rapid_connect_attrs = None
+    if 'id' not in shib_attrs and session:
+        rapid_connect_attrs = get_rapid_connect_attrs(session)
+    if rapid_connect_attrs:
+        # logged in through AAF Rapid Connect rather than the SP
+        attr_map = attrmap.get('rapid_connect')
+        shib_attrs = rapid_connect_attrs
     LOG.info('The AAF responded with: %s.' % shib_attrs)
 
     errors = {}
     for field in ['id', 'mail', 'fullname']:
         if field not in shib_attrs:
             errors[field] = ("Required field '%s' can't be found." %
-                             ShibbolethAttrMap.get_attr(field))
+                             attr_map.get_attr(field))
 
     if errors:
         LOG.error('The AAF IdP is not returning the required '
@@ -128,42 +231,27 @@ def root(db):
             'errors': error_values}
         return template('error', **data)
 
+    session_values = {'user_id': shib_attrs['id']}
     if request.forms.get('csrfmiddlewaretoken', ''):
-        session['csrfmiddlewaretoken'] = \
+        session_values['csrfmiddlewaretoken'] = \
             request.forms.get('csrfmiddlewaretoken')
-        session.save()
+    update_session(session, session_values)
 
     shib_user = db.query(models.User).filter_by(
         user_id=shib_attrs["id"]).first()
     if not shib_user:
         shib_user = utils.create_db_user(db, shib_attrs)
 
-    session['user_id'] = shib_attrs['id']
-    session.save()
-
     if request.forms.get('agree') and shib_user.state == 'new':
         password = utils.create_password()
         shib_user.terms = datetime.now()
         shib_user.state = 'registered'
         shib_user.password = password
         utils.update_db_user(db, shib_user, shib_attrs)
-        db.commit()
-
-        try:
-            utils.create_user(db, shib_attrs, password)
-        except Exception as e:
-            LOG.exception(e)
-            data = {
-                'title': 'Error',
-                'subject': 'There was an error creating your local account',
-                'message': 'We encountered an unknown error while trying to'
-                           'create your local account for this service'
-                           '<br />Please contact <a href="'
-                           ''+ CONFIG['support_url'] + '">support</a> '
-                           'to resolve this issue.',
-                'errors': [str(e)],
-            }
-            return template('error', **data)
+        utils.cache_user_state(shib_user, db)
+        mark_written(session)
+        # the account itself is created by the provisioning workers
+        provisioning.enqueue(db, shib_attrs)
 
     if not shib_user.terms:
         data = {'title': 'Terms and Conditions.'}
@@ -174,6 +262,19 @@ def root(db):
                 'support_url': CONFIG['support_url']}
         return template('creating_account', **data)
 
+    if shib_user.state == 'error':
+        # the provisioning workers gave up
+        data = {
+            'title': 'Error',
+            'subject': 'There was an error creating your local account',
+            'message': 'We encountered an unknown error while trying to '
+                       'create your local account for this service'
+                       '<br />Please contact <a href="' +
+                       CONFIG['support_url'] + '">support</a> '
+                       'to resolve this issue.',
+            'errors': ['Local account creation failed']}
+        return template('error', **data)
+
     if shib_user.state == 'created':
         if not utils.user_exists(shib_attrs['id']):
             LOG.exception('Incomplete user creation error')
@@ -200,28 +301,147 @@ def root(db):
         return template('index')
 
 
+def rapid_connect_enabled():
+    """Whether a Rapid Connect secret and audience are configured."""
+    secret = CONFIG.get('rapid_connect_secret')
+    return bool(secret and secret != RAPID_CONNECT_PLACEHOLDER_SECRET and
+                CONFIG.get('rapid_connect_audience'))
+
+
+def get_rapid_connect_attrs(session):
+    """Return the Rapid Connect attributes of the session.
+
+    They are dropped once the login is `rapid_connect_session_lifetime`
+    seconds old.
+    """
+    attrs = session.get('rapid_connect_attrs')
+    if not attrs:
+        return None
+    if session.get('rapid_connect_expires', 0) < time.time():
+        session.pop('rapid_connect_attrs', None)
+        session.pop('rapid_connect_expires', None)
+        session.save()
+        return None
+    return attrs
+
+
+@route('/rapid_connect', method='POST')
+def rapid_connect():
+    """Accept an AAF Rapid Connect assertion.
+
+    The verified attributes are kept in the session and the user carries
+    on through `root`, as if they had come through the Shibboleth SP. The
+    assertion only lives a couple of minutes, so the login is given its
+    own lifetime, long enough to outlast the creation of the account.
+    """
+    if not rapid_connect_enabled():
+        return HTTPError(404, 'Not found: %r' % request.path)
+    session = request.environ['beaker.session']
+    try:
+        claims = jwt.decode(
+            request.forms.get('assertion', ''),
+            CONFIG['rapid_connect_secret'],
+            audience=CONFIG['rapid_connect_audience'],
+            issuer=CONFIG.get('rapid_connect_issuer', RAPID_CONNECT_ISSUER),
+            replay_store=RAPID_CONNECT_REPLAY_STORE)
+        if not isinstance(claims.get('exp'), (int, long, float)):
+            raise jwt.DecodeError('Assertion has no expiry')
+    except (jwt.DecodeError, jwt.ExpiredSignature) as e:
+        LOG.warning('Rejected Rapid Connect assertion: %s', e)
+        data = {
+            'title': 'Error',
+            'message': 'Your login through the AAF could not be verified.'
+                       '<br />Please try again, or contact <a href="' +
+                       CONFIG['support_url'] + '">support</a> if the '
+                       'problem persists.',
+            'errors': [str(e)]}
+        return template('error', **data)
+
+    attributes = claims.get('https://aaf.edu.au/attributes')
+    if not isinstance(attributes, dict):
+        attributes = {}
+    update_session(session, {
+        'rapid_connect_attrs': attrmap.get('rapid_connect').parse(attributes),
+        'rapid_connect_expires': time.time() + float(
+            CONFIG.get('rapid_connect_session_lifetime', 3600))})
+    redirect(request.script_name)
+
+
 @route('/account_status', method='GET')
-def account_status(db):
+def account_status(db, read_db=None):
     session = request.environ['beaker.session']
-    state = None
-    shib_user = db.query(models.User).filter_by(
-        user_id=session['user_id']).first()
+    state, terms = utils.get_user_state(reader(session, db, read_db),
+                                        session['user_id'])
+    data = {'state': state}
+    return json.dumps(data)
+
 
-    if shib_user:
-        state = shib_user.state
+@route('/account_status/wait', method='GET')
+def account_status_wait(db, read_db=None):
+    """Long-poll variant of `account_status`.
+
+    Hold the request until the user's state differs from the `state`
+    query parameter or `account_status_timeout` seconds pass. Each waiter
+    holds a server thread, so once `account_status_max_waiters` are
+    waiting the state is returned straight away and the page polls again.
+    """
+    max_waiters = int(CONFIG.get('account_status_max_waiters', 50))
+    if notify.USER_STATES.waiting() >= max_waiters:
+        return account_status(db, read_db)
+    session = request.environ['beaker.session']
+    user_id = session['user_id']
+    known_state = request.query.get('state')
+    timeout = float(CONFIG.get('account_status_timeout', 25))
+    db = reader(session, db, read_db)
+
+    with notify.USER_STATES.subscribe(user_id) as waiter:
+        state, terms = utils.get_user_state(db, user_id)
+        if state == known_state:
+            # don't hold a database connection while waiting
+            db.close()
+            if waiter.wait(timeout):
+                state = waiter.state
+            else:
+                # the change may have been made by another process
+                state, terms = utils.get_user_state(db, user_id,
+                                                    cached=False)
     data = {'state': state}
     return json.dumps(data)
 
 
+def metrics_allowed():
+    """Whether the request may read the metrics.
+
+    With a `metrics_token` it must carry it as a bearer token, otherwise
+    it must come from this host.
+    """
+    token = CONFIG.get('metrics_token')
+    if token:
+        return hmac.compare_digest(
+            str(request.environ.get('HTTP_AUTHORIZATION', '')),
+            'Bearer ' + str(token))
+    # not request.remote_addr, which trusts X-Forwarded-For
+    return request.environ.get('REMOTE_ADDR') in LOOPBACK_ADDRESSES
+
+
+@route('/metrics')
+def metrics_text():
+    if not metrics_allowed():
+        return HTTPError(403, 'Forbidden')
+    response.content_type = 'text/plain; version=0.0.4'
+    return metrics.render()
+
+
 @route('/terms')
 def terms(db):
-    return template('terms_form')
+    return cached_page('terms_form')
+
 
 @route('/creating')
-def terms(db):
+def creating(db):
     data = {'title': 'Creating Account...',
             'support_url': CONFIG['support_url']}
-    return template('creating_account', **data)
+    return cached_page('creating_account', **data)
 
 
 def error_template(head_html, exception, extra):
@@ -236,4 +456,7 @@ def error_template(head_html, exception, extra):
     return template('error', **data)
 
 
-errormiddleware.error_template = error_template
+def install_error_template():
+    """Render the errors caught by WebError's middleware as our page."""
+    from weberror import errormiddleware
+    errormiddleware.error_template = error_template
@@ -3,12 +3,18 @@ from logging.config import fileConfig
 
 import bottle
 from paste import deploy
-import sqlalchemy
 
 from bottle_sqlalchemy import SQLAlchemyPlugin
 import models
+from shibble import assets
+from shibble import attrmap
 from shibble import cfg
-import views  # noqa: F401
+from shibble import db
+from shibble import profiler
+from shibble import provisioning
+from shibble import replay
+from shibble import utils
+import views
 
 
 CONF = cfg.CONF
@@ -20,7 +26,7 @@ bottle.TEMPLATE_PATH.append(path.join(path.dirname(__file__), "./templates/"))
 support_url = ""
 
 
-def make_app(global_conf, database_uri, **kw):
+def make_app(global_conf, database_uri, read_database_uri=None, **kw):
     # This is a WSGI application:
     app = bottle.default_app()
 
@@ -43,23 +49,74 @@ def make_app(global_conf, database_uri, **kw):
         bottle.debug(True)
 
     if "disable_error_handler" in conf:
+        # errors are left to WebError's middleware, only load it then
         app.catchall = False
+        views.install_error_template()
 
     # configure shibboleth database
-    engine = sqlalchemy.create_engine(database_uri,
-                                      pool_size=5,
-                                      pool_recycle=60,
-                                      poolclass=sqlalchemy.pool.QueuePool)
-    plugin = SQLAlchemyPlugin(engine, models.Base.metadata)
+    engine = db.create_engine(database_uri, **db.pool_settings(conf))
+    # the model helpers only flush, each request is committed once by the
+    # plugin when the route returns
+    plugin = SQLAlchemyPlugin(engine, models.Base.metadata, commit=True)
     app.install(plugin)
+    # read-only routes also take a read_db session, on a replica if there
+    # is one
+    read_engine = engine
+    if read_database_uri:
+        read_engine = db.create_engine(read_database_uri, name='replica',
+                                       **db.pool_settings(conf, 'read_db_'))
+        views.READ_YOUR_WRITES = float(conf.get('read_your_writes_window',
+                                                30))
+    app.install(SQLAlchemyPlugin(read_engine, keyword='read_db',
+                                 commit=False))
 
     config_file = conf['__file__']
-    # Required for OSLO RPC.
+    # Required for OSLO RPC, parsed when first used.
     OSLO_CONF([], default_config_files=[config_file])
     # Local config.
     CONF.read(config_file)
+    attrmap.load_config(CONF)
+    views.configure_templates(conf.get('template_cache_dir'))
+    views.ASSETS = assets.AssetIndex(
+        build_dir=conf.get('static_build_dir', assets.BUILD_DIR))
 
     models.Base.metadata.create_all(engine)
+    # connect ahead of the first requests
+    warm = conf.get('db_pool_warm')
+    db.warm_up(engine, int(warm) if warm is not None else None)
+    if read_engine is not engine:
+        warm = conf.get('read_db_pool_warm')
+        db.warm_up(read_engine, int(warm) if warm is not None else None)
+
+    # reject replayed Rapid Connect assertions
+    views.RAPID_CONNECT_REPLAY_STORE = replay.SQLReplayStore(engine)
+
+    utils.configure_user_state_cache(
+        maxsize=int(conf.get('user_state_cache_size', 10000)),
+        ttl=int(conf.get('user_state_cache_ttl', 300)),
+        transient_ttl=int(conf.get('user_state_cache_transient_ttl', 5)),
+        verify_rate=float(conf.get('user_state_cache_verify_rate', 0)))
+
+    # create local accounts in the background
+    workers = int(conf.get('provisioning_workers', 2))
+    if workers:
+        pool = provisioning.WorkerPool(
+            engine, workers=workers,
+            poll_interval=float(conf.get('provisioning_poll_interval', 5)),
+            job_timeout=int(conf.get('provisioning_job_timeout', 300)),
+            max_attempts=int(conf.get('provisioning_max_attempts', 5)),
+            retry_delay=float(conf.get('provisioning_retry_delay', 30)))
+        pool.start()
+
+    if conf.get('profile_dir'):
+        slower_than = conf.get('profile_slower_than')
+        app = profiler.ProfilerMiddleware(
+            app, conf['profile_dir'],
+            rate=float(conf.get('profile_rate', 0)),
+            slower_than=float(slower_than) if slower_than else None,
+            mode=conf.get('profile_mode', 'cprofile'),
+            interval=float(conf.get('profile_interval', 0.005)),
+            max_profiles=int(conf.get('profile_max_profiles', 1000)))
 
     # ConfigMiddleware means that paste.deploy.CONFIG will,
     # during this request (threadsafe) represent the